@@ -5,3 +5,13 @@ from django.apps import AppConfig
 
 class BooksConfig(AppConfig):
     name = 'books'
+
+    def ready(self):
+        # Connect the signal handlers that keep the search index, the status
+        # counters, the feed and download caches and the cover thumbnails
+        # updated.
+        import counters  # NOQA
+        import download_cache  # NOQA
+        import feed_cache  # NOQA
+        import search_index  # NOQA
+        import thumbnails  # NOQA
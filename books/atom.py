@@ -34,6 +34,8 @@ import re
 from xml.sax.saxutils import XMLGenerator
 from datetime import datetime
 
+TOMBSTONES_NS = u'http://purl.org/atompub/tombstones/1.0'
+
 GENERATOR_TEXT = 'django-atompub'
 GENERATOR_ATTR = {
     'uri': 'http://code.google.com/p/django-atompub/',
@@ -41,6 +43,22 @@ GENERATOR_ATTR = {
 }
 
 
+class _ChunkBuffer(object):
+    """File-like object collecting the output of `AtomFeed.iter_write()`
+    until it is yielded.
+    """
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+
+    def pop(self):
+        data = ''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
 # based on django.utils.xmlutils.SimplerXMLGenerator
 class SimplerXMLGenerator(XMLGenerator):
     def add_quick_element(self, name, contents=None, attrs=None, tabs=1):
@@ -209,40 +227,66 @@ class AtomFeed(object):
                  authors=[], categories=[], contributors=[], links=[],
                  extra_attrs={}, dc_language=None, dc_publisher=[],
                  dc_issued=None, dc_identifier=None):
+        self.items.append(self.make_item(
+            atom_id, title, updated, content=content, published=published,
+            rights=rights, source=source, summary=summary, authors=authors,
+            categories=categories, contributors=contributors, links=links,
+            extra_attrs=extra_attrs, dc_language=dc_language,
+            dc_publisher=dc_publisher, dc_issued=dc_issued,
+            dc_identifier=dc_identifier))
+
+    @staticmethod
+    def make_item(atom_id, title, updated, content=None, published=None,
+                  rights=None, source=None, summary=None,
+                  authors=[], categories=[], contributors=[], links=[],
+                  extra_attrs={}, dc_language=None, dc_publisher=[],
+                  dc_issued=None, dc_identifier=None):
+        """Return the dict of an entry, as stored by `add_item()`. It can be
+        used for building the items passed to `iter_write()`.
+        """
         if atom_id is None:
             raise LookupError('Feed has no item_id method')
         if title is None:
             raise LookupError('Feed has no item_title method')
         if updated is None:
             raise LookupError('Feed has no item_updated method')
-        self.items.append({'id': atom_id,
-                           'title': title,
-                           'updated': updated,
-                           'content': content,
-                           'published': published,
-                           'rights': rights,
-                           'source': source,
-                           'summary': summary,
-                           'authors': authors,
-                           'categories': categories,
-                           'contributors': contributors,
-                           'links': links,
-                           'extra_attrs': extra_attrs,
-                           'dc_language': dc_language,
-                           'dc_publisher': dc_publisher,
-                           'dc_issued': dc_issued,
-                           'dc_identifier': dc_identifier,
-                           })
+        return {'id': atom_id,
+                'title': title,
+                'updated': updated,
+                'content': content,
+                'published': published,
+                'rights': rights,
+                'source': source,
+                'summary': summary,
+                'authors': authors,
+                'categories': categories,
+                'contributors': contributors,
+                'links': links,
+                'extra_attrs': extra_attrs,
+                'dc_language': dc_language,
+                'dc_publisher': dc_publisher,
+                'dc_issued': dc_issued,
+                'dc_identifier': dc_identifier,
+                }
+
+    @staticmethod
+    def make_tombstone(ref, when):
+        """Return the dict of a deleted entry (RFC 6721), to be used as an
+        item. The feed must declare the `at` namespace prefix
+        (`TOMBSTONES_NS`) in its `extra_attrs`.
+
+        :param ref: atom id of the deleted entry
+        :param when: time of the deletion
+        """
+        return {'tombstone': True, 'id': ref, 'updated': when}
 
     def latest_updated(self):
         """
         Returns the latest item's updated or the current time if there are no
         items.
         """
-        updates = [item['updated'] for item in self.items]
-        if len(updates) > 0:
-            updates.sort()
-            return updates[-1]
+        if self.items:
+            return max(item['updated'] for item in self.items)
         else:
             # @@@ really we should allow a feed to define its "start" for this
             # case
@@ -327,7 +371,24 @@ class AtomFeed(object):
             handler.add_quick_element(u'content', data)
 
     def write(self, outfile, encoding):
-        handler = SimplerXMLGenerator(outfile, encoding)
+        for chunk in self.iter_write(encoding):
+            outfile.write(chunk)
+
+    def iter_write(self, encoding, items=None):
+        """Serialize the feed, yielding the encoded document in chunks (one
+        for the feed header and one for each entry).
+
+        :param encoding: output encoding
+        :param items: iterable of item dicts (see `make_item()`) to be used
+        instead of `self.items`. As the feed updated date is written before
+        the entries, it must be set on the feed if `items` is given.
+        :returns: generator of strings
+        """
+        if items is not None and not self.feed['updated']:
+            raise LookupError('Feed has no updated date for the items')
+
+        buf = _ChunkBuffer()
+        handler = SimplerXMLGenerator(buf, encoding)
         handler.startDocument()
         feed_attrs = {u'xmlns': self.ns}
         if self.feed.get('extra_attrs'):
@@ -364,62 +425,74 @@ class AtomFeed(object):
             handler.add_quick_element(u'generator', GENERATOR_TEXT,
                                       GENERATOR_ATTR, tabs=2)
 
-        self.write_items(handler)
+        for item in (self.items if items is None else items):
+            yield buf.pop()
+            self.write_item(handler, item)
 
         handler.endElement(u'feed')
+        yield buf.pop()
 
     def write_items(self, handler):
         for item in self.items:
-            entry_attrs = item.get('extra_attrs', {})
-            handler.characters("\t")
-            handler.startElement(u'entry', entry_attrs)
+            self.write_item(handler, item)
 
-            handler.characters("\n")
+    def write_item(self, handler, item):
+        if item.get('tombstone'):
+            handler.add_quick_element(
+                u'at:deleted-entry', None,
+                {u'ref': item['id'], u'when': rfc3339_date(item['updated'])})
+            return
 
-            handler.add_quick_element(u'id', item['id'], tabs=2)
-            self.write_text_construct(handler, u'title', item['title'], tabs=2)
-            handler.add_quick_element(u'updated',
-                                      rfc3339_date(item['updated']), tabs=2)
-            if item.get('published'):
-                handler.add_quick_element(u'published',
-                                          rfc3339_date(item['published']),
-                                          tabs=2)
-            if item.get('rights'):
-                self.write_text_construct(handler, u'rights', item['rights'],
-                                          tabs=2)
-            if item.get('source'):
-                self.write_source(handler, item['source'])
-
-            for author in item['authors']:
-                self.write_person_construct(handler, u'author', author)
-            for contributor in item['contributors']:
-                self.write_person_construct(handler, u'contributor',
-                                            contributor)
-            for category in item['categories']:
-                self.write_category_construct(handler, category)
-            for link in item['links']:
-                self.write_link_construct(handler, link, tabs=2)
-            if item.get('summary'):
-                self.write_text_construct(handler, u'summary', item['summary'])
-            if item.get('content'):
-                self.write_content(handler, item['content'])
-
-            if item.get('dc_language'):
-                handler.add_quick_element(u'dcterms:language',
-                                          item['dc_language'], tabs=2)
-            for publisher in item['dc_publisher']:
-                handler.add_quick_element(u'dcterms:publisher',
-                                          publisher, tabs=2)
-            if item.get('dc_issued'):
-                handler.add_quick_element(u'dcterms:issued', item['dc_issued'],
-                                          tabs=2)
-            if item.get('dc_identifier'):
-                handler.add_quick_element(u'dcterms:identifier',
-                                          item['dc_identifier'], tabs=2)
+        entry_attrs = item.get('extra_attrs', {})
+        handler.characters("\t")
+        handler.startElement(u'entry', entry_attrs)
 
-            handler.characters("\t")
-            handler.endElement(u'entry')
-            handler.characters("\n")
+        handler.characters("\n")
+
+        handler.add_quick_element(u'id', item['id'], tabs=2)
+        self.write_text_construct(handler, u'title', item['title'], tabs=2)
+        handler.add_quick_element(u'updated',
+                                  rfc3339_date(item['updated']), tabs=2)
+        if item.get('published'):
+            handler.add_quick_element(u'published',
+                                      rfc3339_date(item['published']),
+                                      tabs=2)
+        if item.get('rights'):
+            self.write_text_construct(handler, u'rights', item['rights'],
+                                      tabs=2)
+        if item.get('source'):
+            self.write_source(handler, item['source'])
+
+        for author in item['authors']:
+            self.write_person_construct(handler, u'author', author)
+        for contributor in item['contributors']:
+            self.write_person_construct(handler, u'contributor',
+                                        contributor)
+        for category in item['categories']:
+            self.write_category_construct(handler, category)
+        for link in item['links']:
+            self.write_link_construct(handler, link, tabs=2)
+        if item.get('summary'):
+            self.write_text_construct(handler, u'summary', item['summary'])
+        if item.get('content'):
+            self.write_content(handler, item['content'])
+
+        if item.get('dc_language'):
+            handler.add_quick_element(u'dcterms:language',
+                                      item['dc_language'], tabs=2)
+        for publisher in item['dc_publisher']:
+            handler.add_quick_element(u'dcterms:publisher',
+                                      publisher, tabs=2)
+        if item.get('dc_issued'):
+            handler.add_quick_element(u'dcterms:issued', item['dc_issued'],
+                                      tabs=2)
+        if item.get('dc_identifier'):
+            handler.add_quick_element(u'dcterms:identifier',
+                                      item['dc_identifier'], tabs=2)
+
+        handler.characters("\t")
+        handler.endElement(u'entry')
+        handler.characters("\n")
 
     def validate(self):
         def validate_text_construct(obj):
@@ -457,6 +530,8 @@ class AtomFeed(object):
             feed_author = False
 
         for item in self.items:
+            if item.get('tombstone'):
+                continue
             if not feed_author and not item.get('authors'):
                 if item.get('source') and item['source'].get('authors'):
                     pass
@@ -0,0 +1,152 @@
+"""Changes of the catalog, for the incremental sync feed.
+
+The changes are the books ordered by `a_updated`, merged with the tombstones
+of the deleted books (`DeletedBook`) ordered by `deleted_at`. The position
+on that list is the key (time, kind, pk), and it is passed between requests
+as an opaque cursor, so each request only reads the changes after it.
+
+The tombstones older than `settings.DELETED_BOOKS_RETENTION_DAYS` are removed
+by `prune_tombstones()` (the `prune_tombstones` command), and the positions
+before that time are rejected, so the clients know that they must fetch the
+whole catalog again.
+"""
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from books.export import parse_since
+from books.models import Book, DeletedBook
+from books.pagination import NEXT, InvalidCursor, decode_cursor, \
+    encode_cursor
+
+# Kinds of changes, in the order they are listed when they have the same time.
+BOOK, TOMBSTONE = 0, 1
+
+
+class Change(object):
+    """A change of the catalog: either an updated `book`, or the removal of
+    the book with the atom id `a_id` (if `book` is None).
+    """
+    def __init__(self, time, kind, pk, a_id, book=None):
+        self.time = time
+        self.kind = kind
+        self.pk = pk
+        self.a_id = a_id
+        self.book = book
+
+    @property
+    def key(self):
+        return (self.time, self.kind, self.pk)
+
+    def cursor(self):
+        """Return the cursor for the changes after this one."""
+        return encode_cursor(NEXT, self.key)
+
+
+def parse_position(value):
+    """Return the position (time, kind, pk) for `value`, either a cursor
+    returned by `Change.cursor()` or a ISO 8601 date or datetime (for the
+    changes after it), raising `InvalidCursor` if it is not valid.
+
+    :param value: cursor or date string
+    :returns: position
+    """
+    try:
+        # Before any change at the time.
+        return (parse_since(value), BOOK - 1, 0)
+    except ValueError:
+        pass
+
+    direction, values = decode_cursor(value)
+    if direction != NEXT or len(values) != 3:
+        raise InvalidCursor(value)
+    try:
+        return (parse_since(values[0]), int(values[1]), int(values[2]))
+    except (TypeError, ValueError):
+        raise InvalidCursor(value)
+
+
+def _after(time_field, kind, position):
+    """Return a Q for the rows of `kind` with a key greater than
+    `position`.
+    """
+    time, position_kind, pk = position
+    if position_kind < kind:
+        return Q(**{'%s__gte' % time_field: time})
+    if position_kind > kind:
+        return Q(**{'%s__gt' % time_field: time})
+    return (Q(**{'%s__gt' % time_field: time}) |
+            Q(**{time_field: time, 'pk__gt': pk}))
+
+
+def get_changes(position=None, limit=None, published_only=True):
+    """Return the changes after `position`, in order.
+
+    Unpublished books are listed as removed if `published_only` is True, so
+    the clients are notified when a book stops being visible.
+
+    :param position: position (see `parse_position()`), or None for all the
+    changes
+    :param limit: maximum number of changes
+    :param published_only: whether the client can only see the published
+    books
+    :returns: list of changes
+    """
+    if limit is None:
+        limit = settings.BOOKS_PER_PAGE
+
+    books = Book.objects.select_related('dc_language').\
+        prefetch_related('authors', 'publishers')
+    tombstones = DeletedBook.objects.all()
+    if position is not None:
+        books = books.filter(_after('a_updated', BOOK, position))
+        tombstones = tombstones.filter(
+            _after('deleted_at', TOMBSTONE, position))
+
+    # The first `limit` changes are among the first `limit` of each kind.
+    changes = [Change(b.a_updated, BOOK, b.pk, b.a_id, b) for b in
+               books.order_by('a_updated', 'pk')[:limit]]
+    changes.extend(Change(t.deleted_at, TOMBSTONE, t.pk, t.a_id) for t in
+                   tombstones.order_by('deleted_at', 'pk')[:limit])
+    changes.sort(key=lambda change: change.key)
+
+    if published_only:
+        for change in changes:
+            if change.book and \
+                    change.book.a_status_id != settings.BOOK_PUBLISHED:
+                change.book = None
+
+    return changes[:limit]
+
+
+def retention_cutoff():
+    """Return the time before which the tombstones are removed, or None if
+    they are kept forever.
+    """
+    days = settings.DELETED_BOOKS_RETENTION_DAYS
+    if days is None:
+        return None
+    return timezone.now() - timedelta(days=days)
+
+
+def is_expired(position):
+    """Return whether the deletions after `position` might have been removed
+    already, so the changes after it can not be listed.
+    """
+    cutoff = retention_cutoff()
+    return cutoff is not None and position[0] < cutoff
+
+
+def prune_tombstones():
+    """Remove the tombstones older than the retention period.
+
+    :returns: number of tombstones removed
+    """
+    cutoff = retention_cutoff()
+    if cutoff is None:
+        return 0
+    deleted, _ = DeletedBook.objects.filter(deleted_at__lt=cutoff).delete()
+    return deleted
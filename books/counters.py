@@ -0,0 +1,89 @@
+"""Counters of books by status.
+
+The number of books with each `Status` is stored on `StatusCounter`, and kept
+updated by the Book signal handlers below, so that the list views can show
+the published/unpublished totals without counting the whole books table on
+each request. The counters can be recomputed from scratch with `rebuild()`
+(or the `rebuild_counters` management command).
+"""
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+
+from books.models import Book, Status, StatusCounter
+
+
+def get_counts():
+    """Return the number of books for each status.
+
+    :returns: dict mapping status pks to number of books
+    """
+    return dict(StatusCounter.objects.values_list('status_id', 'count'))
+
+
+def get_published_counts():
+    """Return the number of published and unpublished books.
+
+    :returns: tuple (published, unpublished)
+    """
+    counts = get_counts()
+    published = counts.pop(settings.BOOK_PUBLISHED, 0)
+    return published, sum(counts.values())
+
+
+def increment(status_id, delta=1):
+    """Add `delta` to the counter of the status `status_id`. If the counter
+    does not exist yet, it is created from the actual number of books.
+
+    :param status_id: pk of the status
+    :param delta: amount to add to the counter
+    """
+    updated = StatusCounter.objects.filter(status_id=status_id).\
+        update(count=F('count') + delta)
+    if not updated and Status.objects.filter(pk=status_id).exists():
+        StatusCounter.objects.get_or_create(
+            status_id=status_id,
+            defaults={'count': Book.objects.filter(
+                a_status_id=status_id).count()})
+
+
+def rebuild():
+    """Recompute all the counters from the books table."""
+    counts = dict(Book.objects.order_by().values_list('a_status_id').
+                  annotate(Count('pk')))
+    with transaction.atomic():
+        StatusCounter.objects.all().delete()
+        StatusCounter.objects.bulk_create(
+            [StatusCounter(status_id=pk, count=counts.get(pk, 0))
+             for pk in Status.objects.values_list('pk', flat=True)])
+
+
+# Signal handlers for keeping the counters updated.
+@receiver(post_init, sender=Book)
+def book_post_init_counter_handler(**kwargs):
+    # Remember the status the Book was loaded with. The instance __dict__ is
+    # used so deferred fields are not fetched from the database.
+    instance = kwargs['instance']
+    instance._counted_status_id = instance.__dict__.get('a_status_id')
+
+
+@receiver(post_save, sender=Book)
+def book_post_save_counter_handler(**kwargs):
+    instance = kwargs['instance']
+    old_status_id = instance._counted_status_id
+    if kwargs['created']:
+        increment(instance.a_status_id)
+    elif old_status_id is not None and \
+            old_status_id != instance.a_status_id:
+        increment(old_status_id, -1)
+        increment(instance.a_status_id)
+    instance._counted_status_id = instance.a_status_id
+
+
+@receiver(post_delete, sender=Book)
+def book_post_delete_counter_handler(**kwargs):
+    instance = kwargs['instance']
+    increment(instance._counted_status_id or instance.a_status_id, -1)
@@ -1,8 +1,20 @@
 # -*- coding: utf-8 -*-
+from hashlib import sha1
+
 from django.conf import settings
 from django.contrib.auth import REDIRECT_FIELD_NAME
 from django.contrib.auth.decorators import user_passes_test
+from django.contrib.messages import get_messages
 from django.core.exceptions import PermissionDenied
+from django.db.models import Max
+from django.utils.encoding import force_bytes, force_text
+from django.utils.http import urlencode
+from django.utils.translation import get_language
+from django.views.decorators.http import condition
+
+from books import counters
+from books.feed_cache import get_version_info
+from books.models import Book
 
 
 def login_or_public_browse_required(function=None,
@@ -69,3 +81,50 @@ def staff_or_allow_user_edit(login_url=None):
             return False
 
     return user_passes_test(check_perms, login_url=login_url)
+
+
+def _catalog_state(request):
+    """Return a tuple (etag, last_modified) describing the state of the
+    catalog (or book list) requested, computed once per request. Both are
+    None if the page should not be cached by the client (ie. if it shows
+    pending messages).
+    """
+    if hasattr(request, '_catalog_state'):
+        return request._catalog_state
+
+    state = (None, None)
+    if not len(get_messages(request)):
+        books = Book.objects.all()
+        if not request.user.is_authenticated():
+            books = books.filter(a_status=settings.BOOK_PUBLISHED)
+        last_updated = books.aggregate(last=Max('a_updated'))['last']
+        version, changed = get_version_info(request)
+        # The counters change on deletions, which are not reflected on the
+        # last update time.
+        counts = sorted(counters.get_counts().items())
+
+        query = urlencode(sorted(request.GET.lists()), doseq=True)
+        key = '|'.join(force_text(part) for part in
+                       [request.path, query, request.user.pk, get_language(),
+                        version, last_updated, counts])
+        state = (sha1(force_bytes(key)).hexdigest(),
+                 max(filter(None, [last_updated, changed])))
+
+    request._catalog_state = state
+    return state
+
+
+def catalog_condition(function):
+    """
+    Decorator for the views that return book lists or OPDS catalogs, adding
+    ETag and Last-Modified headers and answering the conditional requests
+    with 304 (Not Modified) before building the list.
+    """
+    def etag(request, *args, **kwargs):
+        return _catalog_state(request)[0]
+
+    def last_modified(request, *args, **kwargs):
+        return _catalog_state(request)[1]
+
+    return condition(etag_func=etag,
+                     last_modified_func=last_modified)(function)
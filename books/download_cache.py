@@ -0,0 +1,143 @@
+"""Cache of the information needed for serving the downloads of the books.
+
+`download_book` only needs the path of the file, its name, sha256 sum and
+whether the book is published, so instead of loading the Book on each
+download, this information is kept on a small LRU cache on each process, and
+on the shared cache defined by `settings.DOWNLOAD_CACHE` (an entry of
+`settings.CACHES`, or None) for `settings.DOWNLOAD_CACHE_TIMEOUT` seconds.
+
+The entries are removed from both caches by the signal handlers below when
+a Book is saved or deleted, and again once the transaction is committed (a
+download served before the commit could have cached the old row again). As the local caches of the other processes can
+not be reached, their entries are only used for
+`settings.DOWNLOAD_CACHE_LOCAL_TIMEOUT` seconds. The queryset updates of the
+cached fields (ie. by `relayout_books`) must call `invalidate()`; anyway, an
+entry whose file no longer exists is loaded again from the database.
+"""
+
+from collections import OrderedDict, namedtuple
+from functools import partial
+import mimetypes
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from books.models import Book
+from books.storage import is_content_address
+
+DownloadInfo = namedtuple('DownloadInfo', ['path', 'attachment_filename',
+                                           'mimetype', 'sha256', 'published'])
+
+
+class LocalCache(object):
+    """LRU cache of at most `max_entries`, whose entries expire after
+    `timeout` seconds.
+    """
+    def __init__(self, max_entries=1000, timeout=30):
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                return None
+            self._entries[key] = entry
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.timeout, value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+local_cache = LocalCache(settings.DOWNLOAD_CACHE_LOCAL_SIZE,
+                         settings.DOWNLOAD_CACHE_LOCAL_TIMEOUT)
+
+
+def _shared_cache():
+    return caches[settings.DOWNLOAD_CACHE] if settings.DOWNLOAD_CACHE else None
+
+
+def _cache_key(book_id):
+    return 'downloads:book:%s' % book_id
+
+
+def load_info(book_id):
+    """Return the `DownloadInfo` of the book `book_id` from the database, or
+    None if it does not exist.
+    """
+    row = Book.objects.filter(pk=book_id).values_list(
+        'book_file', 'original_path', 'file_sha256sum', 'a_status_id').first()
+    if row is None or not row[0]:
+        return None
+    name, original_path, sha256, status_id = row
+    path = Book._meta.get_field('book_file').storage.path(name)
+
+    # Content addressed files are downloaded with their original name.
+    attachment_filename = os.path.basename(name)
+    if is_content_address(name) and original_path:
+        attachment_filename = os.path.basename(original_path)
+    return DownloadInfo(
+        path, attachment_filename,
+        mimetypes.guess_type(path)[0] or 'application/octet-stream', sha256,
+        status_id == settings.BOOK_PUBLISHED)
+
+
+def get_info(book_id):
+    """Return the `DownloadInfo` of the book `book_id`, from the caches if
+    possible, or None if it does not exist.
+    """
+    book_id = int(book_id)
+    key = _cache_key(book_id)
+    shared = _shared_cache()
+    info = local_cache.get(key)
+    if info is None and shared is not None:
+        info = shared.get(key)
+        if info is not None:
+            info = DownloadInfo(*info)
+    if info is not None and os.path.exists(info.path):
+        local_cache.set(key, info)
+        return info
+
+    info = load_info(book_id)
+    if info is not None:
+        local_cache.set(key, info)
+        if shared is not None:
+            shared.set(key, tuple(info), settings.DOWNLOAD_CACHE_TIMEOUT)
+    return info
+
+
+def invalidate(book_id):
+    """Remove the information of the book `book_id` from the caches."""
+    key = _cache_key(book_id)
+    local_cache.delete(key)
+    shared = _shared_cache()
+    if shared is not None:
+        shared.delete(key)
+
+
+# Signal handlers for invalidating the cache.
+@receiver(post_save, sender=Book)
+@receiver(post_delete, sender=Book)
+def book_download_cache_handler(**kwargs):
+    invalidate(kwargs['instance'].pk)
+    transaction.on_commit(partial(invalidate, kwargs['instance'].pk))
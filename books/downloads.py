@@ -0,0 +1,168 @@
+"""Counter of the downloads of the books.
+
+The downloads are added to `Book.downloads` with `UPDATE ... SET downloads =
+downloads + n` queries, so concurrent downloads are not lost and `a_updated`
+(and with it, the version of the cached catalogs) is not modified.
+
+If `settings.DOWNLOADS_LOG` is set, each download is only appended to that
+file (one book pk per line), which is shared by all the processes of the
+server, and the log is added to the books by `flush()` at most every
+`settings.DOWNLOADS_FLUSH_INTERVAL` seconds, with one query for each distinct
+number of downloads. The log is kept on disk, so the downloads are not lost
+if a process is restarted before flushing them; the `flush_downloads`
+command can be run periodically for flushing the downloads of an idle
+server.
+
+For flushing, the log is renamed to a unique "segment" name (the following
+downloads create a new log) and deleted once its downloads are saved. The
+processes that opened the log before it was renamed hold a shared lock while
+writing, and check that the name still refers to the file they opened once
+they have the lock, so the exclusive lock taken by the flush waits for their
+pending writes. A segment left by an interrupted flush is saved by the next
+one: if the process was stopped right after saving it, but before deleting
+it, its downloads are counted twice.
+"""
+
+from collections import Counter, defaultdict
+import errno
+import logging
+import os
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows: the downloads are saved immediately.
+    fcntl = None
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils.crypto import get_random_string
+
+from books.importer import LOOKUP_SIZE
+from books.models import Book
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_SUFFIX = '.flushing'
+
+# Time of the last flush made by this process.
+_last_flush = [0]
+
+
+def record(book_id):
+    """Count a download of the book `book_id`.
+
+    :param book_id: pk of the book
+    """
+    path = settings.DOWNLOADS_LOG
+    if not path or fcntl is None:
+        increment({book_id: 1})
+        return
+
+    append(path, book_id)
+    if time.time() - _last_flush[0] >= settings.DOWNLOADS_FLUSH_INTERVAL:
+        try:
+            flush(path)
+        except Exception:
+            # The log is flushed again later, the download is not affected.
+            logger.exception('Error while flushing the downloads log')
+
+
+def increment(counts):
+    """Add the downloads of `counts` to the books, with a single query for
+    the books that have the same number of downloads.
+
+    :param counts: dict mapping book pks to number of downloads
+    """
+    pks_by_count = defaultdict(list)
+    for pk, count in counts.items():
+        if count:
+            pks_by_count[count].append(pk)
+    with transaction.atomic():
+        for count, pks in pks_by_count.items():
+            for i in range(0, len(pks), LOOKUP_SIZE):
+                Book.objects.filter(pk__in=pks[i:i + LOOKUP_SIZE]).update(
+                    downloads=F('downloads') + count)
+
+
+def append(path, book_id):
+    """Append a download of the book `book_id` to the log at `path`."""
+    line = b'%d\n' % book_id
+    while True:
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            try:
+                current = os.stat(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                current = None
+            if current is None or current.st_ino != os.fstat(fd).st_ino:
+                # Renamed by a flush after it was opened: use the new log.
+                continue
+            os.write(fd, line)
+            return
+        finally:
+            # Also releases the lock.
+            os.close(fd)
+
+
+def flush(path=None):
+    """Add the downloads of the log at `path` (`settings.DOWNLOADS_LOG` by
+    default) to the books, along with the ones of the segments left by
+    interrupted flushes. Nothing is done if another process is flushing the
+    same log.
+
+    :param path: path of the log
+    :returns: number of downloads added, or None if the log is being flushed
+    by another process
+    """
+    path = path or settings.DOWNLOADS_LOG
+    _last_flush[0] = time.time()
+
+    lock_fd = os.open(path + '.lock', os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return None
+
+        directory, name = os.path.split(path)
+        segments = [os.path.join(directory, segment)
+                    for segment in sorted(os.listdir(directory or '.'))
+                    if segment.startswith(name + '.') and
+                    segment.endswith(SEGMENT_SUFFIX)]
+        segment = '%s.%s%s' % (path, get_random_string(), SEGMENT_SUFFIX)
+        try:
+            os.rename(path, segment)
+            segments.append(segment)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+        return sum(_flush_segment(segment) for segment in segments)
+    finally:
+        os.close(lock_fd)
+
+
+def _flush_segment(segment):
+    """Add the downloads of the log `segment` to the books, deleting it."""
+    fd = os.open(segment, os.O_RDONLY)
+    with os.fdopen(fd, 'rb') as f:
+        # Wait for the writers that opened the log before it was renamed.
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        counts = Counter()
+        for line in f:
+            try:
+                counts[int(line)] += 1
+            except ValueError:
+                # Truncated line.
+                pass
+    increment(counts)
+    os.remove(segment)
+    return sum(counts.values())
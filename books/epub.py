@@ -15,10 +15,12 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
+from io import BytesIO
 import logging
 import os.path
 import shutil
 import tempfile
+import time
 import zipfile
 from sys import version_info
 
@@ -27,6 +29,41 @@ from lxml import etree
 
 import epubinfo
 
+# Covers up to this size (in bytes) are read in memory by
+# `Epub.get_cover_image()`, the bigger ones are copied to a temporary file.
+MAX_COVER_IN_MEMORY = 4 * 1024 * 1024
+
+IMAGE_EXTENSIONS = ('.bmp', '.gif', '.jpg', '.jpeg', '.png')
+
+
+class Cover(object):
+    """Cover image extracted from an Epub, either kept in memory (`data`) or
+    on a temporary file (`path`) if it is too big.
+    """
+    def __init__(self, name, data=None, path=None):
+        self.name = name
+        self.data = data
+        self.path = path
+
+    @property
+    def extension(self):
+        return os.path.splitext(self.name)[1]
+
+    def open(self):
+        """Return a file object with the contents of the image."""
+        if self.data is not None:
+            return BytesIO(self.data)
+        return open(self.path, 'rb')
+
+    def delete(self):
+        """Delete the temporary file, if any."""
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+        self.path = None
+
+    def __str__(self):
+        return self.path or self.name
+
 
 class Epub(object):
     def __init__(self, _file):
@@ -40,23 +77,41 @@ class Epub(object):
         self._base_path = None
         self._mimetype = None
 
-        try:
-            # Lazy approach to ensure the Epub is really initialized.
-            self._tempdir = tempfile.mkdtemp()
+        # The temporary dir is only created if files need to be extracted.
+        self._tempdir = None
 
+        # Duration (in seconds) of opening the zip file, parsing the OPF and
+        # extracting the cover, for `addepub --profile`.
+        self.timings = {}
+
+        try:
+            start = time.time()
             if not self._verify():
                 print 'Warning: This does not seem to be a valid ePub file'
 
             self._get_opf()
-            self._get_ncx()
+            self.timings['zip_open'] = time.time() - start
 
+            # The OPF is only parsed once, by EpubInfo.
+            start = time.time()
             opf_file = self._zobject.open(self._opf_path)
-            self._info = epubinfo.EpubInfo(opf_file)
+            try:
+                self._info = epubinfo.EpubInfo(opf_file)
+            finally:
+                opf_file.close()
+            self._get_ncx()
+            self.timings['opf_parse'] = time.time() - start
         except Exception as e:
             self.close()
             raise e
 
+    def _get_tempdir(self):
+        if self._tempdir is None:
+            self._tempdir = tempfile.mkdtemp()
+        return self._tempdir
+
     def _unzip_file(self, name):
+        self._get_tempdir()
         # Use safe version (2.7+) if possible, that escapes dangerous names.
         if version_info >= (2, 7, 4):
             self._zobject.extract(name, path=self._tempdir)
@@ -100,19 +155,9 @@ class Epub(object):
         container_file.close()
 
     def _get_ncx(self):
-        opffile = self._zobject.open(self._opf_path)
-
-        tree = etree.parse(opffile)
-        root = tree.getroot()
-
-        spine = root.find('.//{http://www.idpf.org/2007/opf}spine')
-        tocid = spine.get('toc')
-
-        for element in root.iterfind('.//{http://www.idpf.org/2007/opf}item'):
-            if element.get('id') == tocid:
-                self._ncx_path = self._base_path + element.get('href')
-
-        opffile.close()
+        item = self._info.get_item(self._info.toc_id)
+        if item is not None and item.get('href'):
+            self._ncx_path = self._base_path + item.get('href')
 
     def _verify(self):
         """
@@ -142,7 +187,7 @@ class Epub(object):
         Returns the base directory where the contents of the
         ePub has been unzipped
         """
-        return self._tempdir
+        return self._get_tempdir()
 
     def get_info(self):
         """
@@ -150,32 +195,25 @@ class Epub(object):
         """
         return self._info
 
-    def get_cover_image_path(self):
+    def _get_cover_member(self):
         """
-        Epubinfo returns cover_image as either an image or xhtml. If xhtml,
-        parse to find image
+        Return the name of the cover image on the zip file, or None if not
+        found. Epubinfo returns cover_image as either an image or xhtml. If
+        xhtml, it is parsed (in memory) to find the image.
         """
         if not self._info.cover_image:
             return None
 
-        cover_image = os.path.join(self._tempdir,
-                                   self._base_path,
-                                   self._info.cover_image)
-
-        try:
-            self._unzip_file(self._base_path + self._info.cover_image)
-            if self._info.cover_image.lower().endswith(('.bmp',
-                                                        '.gif',
-                                                        '.jpg',
-                                                        '.jpeg',
-                                                        '.png')):
-                return cover_image
-        except Exception as e:
-            logging.exception(e)
+        namelist = self._zobject.namelist()
+        member = self._base_path + self._info.cover_image
+        if member not in namelist:
+            logging.error('There is no item named %r in the archive' % member)
             return None
+        if self._info.cover_image.lower().endswith(IMAGE_EXTENSIONS):
+            return member
 
         # Begin XHTML handling
-        parent = lxml.html.parse(cover_image)
+        parent = lxml.html.fromstring(self._zobject.read(member))
 
         # img tag
         images = parent.xpath('//img/@src')
@@ -185,46 +223,89 @@ class Epub(object):
             image_path = os.path.normpath(image_base_path + '/' + img)
 
             # In case of leading or trailing slash
-            joined_path = (self._base_path + image_path).replace('//', '/')
-            try:
-                self._unzip_file(joined_path)
-                return os.path.join(self._tempdir, joined_path)
-            except Exception as e:
-                logging.exception(e)
+            member = (self._base_path + image_path).replace('//', '/')
+        else:
+            # SVG image
+            svg_image = parent.xpath('//image')
+            if not svg_image:
+                # https://stackoverflow.com/questions/2932408
+                # TODO cover as svg string
                 return None
-
-        # SVG image
-        svg_image = parent.xpath('//image')
-        if svg_image:
-            image_path = os.path.normpath(
+            member = os.path.normpath(
                 self._base_path +
                 os.path.dirname(self._info.cover_image) + '/' +
                 svg_image[0].attrib['xlink:href']
             )
-            try:
-                self._unzip_file(image_path)
-                return os.path.join(self._tempdir, image_path)
-            except Exception as e:
-                logging.exception(e)
+
+        if member not in namelist:
+            logging.error('There is no item named %r in the archive' % member)
+            return None
+        return member
+
+    def get_cover_image_path(self):
+        """
+        Extract the cover image to the temporary directory, returning its
+        path (or None if not found).
+        """
+        try:
+            member = self._get_cover_member()
+            if member is None:
                 return None
+            self._unzip_file(member)
+            return os.path.join(self._tempdir, member)
+        except Exception as e:
+            logging.exception(e)
+            return None
 
-        # https://stackoverflow.com/questions/2932408
-        # TODO cover as svg string
-        # SVG String - cairosvg requires Python 3.4+, untested
-        # svg = parent.xpath('//svg')
-        # if svg:
-        #     logging.warning(svg[0])
-        #     image_path = open(os.path.join(self._tempdir + cover.png'),'w')
-        #     cairosvg.svg2png(bytestring=svg,write_to=fout)
-        #     image_path.close()
-        #     # return image_path
-
-    def as_model_dict(self):
+    def get_cover_image(self, max_size=MAX_COVER_IN_MEMORY):
+        """
+        Return the cover image as a `Cover` (or None if not found), read in
+        memory if it is not bigger than `max_size` bytes, or copied to a
+        temporary file otherwise. The temporary file is *not* deleted upon
+        close().
+        """
+        start = time.time()
+        try:
+            return self._get_cover_image(max_size)
+        finally:
+            self.timings['cover_extract'] = time.time() - start
+
+    def _get_cover_image(self, max_size):
+        try:
+            member = self._get_cover_member()
+            if member is None:
+                return None
+            if self._zobject.getinfo(member).file_size <= max_size:
+                return Cover(os.path.basename(member),
+                             data=self._zobject.read(member))
+        except Exception as e:
+            logging.exception(e)
+            return None
+
+        # Fall back to extracting the cover to disk.
+        path = self._copy_to_tempfile(self.get_cover_image_path())
+        return Cover(os.path.basename(path), path=path) if path else None
+
+    @staticmethod
+    def _copy_to_tempfile(path):
+        """Copy `path` to a new temporary file, returning its path."""
+        if not path:
+            return None
+        suffix = os.path.splitext(path)[1]
+        tmp_file = tempfile.NamedTemporaryFile(suffix=suffix, delete=False)
+        tmp_file.close()
+        tmp_path = os.path.abspath(tmp_file.name)
+        shutil.copy2(path, tmp_path)
+        return tmp_path
+
+    def as_model_dict(self, in_memory=False):
         """Return a tuple with:
         - the fields used for building a `Book` model, as a dict.
-        - the path of the temporary file that contains the cover (or None
-        if it could not be found). The file is *not* deleted from disk upon
-        close().
+        - the cover: if `in_memory` is False, the path of the temporary file
+        that contains the cover, or a `Cover` otherwise (see
+        `get_cover_image()`). In both cases it is None if the cover could
+        not be found, and temporary files are *not* deleted upon close().
+        - the subjects.
 
         TODO: this method should be moved to other layer in order to decouple
         it from the specific Epub implementation on a future refactoring.
@@ -232,18 +313,12 @@ class Epub(object):
         """
         info = self.get_info()
 
-        # Copy the cover to a temporary file, as otherwise it would be deleted
-        # during self.close().
-        cover_image_path = self.get_cover_image_path()
-        if cover_image_path:
-            suffix = os.path.splitext(cover_image_path)[1]
-            ret_cover = tempfile.NamedTemporaryFile(suffix=suffix,
-                                                    delete=False)
-            ret_cover.close()
-            ret_cover_path = os.path.abspath(ret_cover.name)
-            shutil.copy2(cover_image_path, ret_cover_path)
+        if in_memory:
+            ret_cover = self.get_cover_image()
         else:
-            ret_cover_path = None
+            # Copy the cover to a temporary file, as otherwise it would be
+            # deleted during self.close().
+            ret_cover = self._copy_to_tempfile(self.get_cover_image_path())
 
         # Add identifier.
         # TODO: .strip('urn:uuid:') needed ?
@@ -251,7 +326,7 @@ class Epub(object):
 
         # Print some info about the info found.
         # TODO: move to logging.
-        for name, obj in [('Cover image', ret_cover_path),
+        for name, obj in [('Cover image', ret_cover),
                           ('Authors', info.creators),
                           ('Publishers', info.publishers),
                           ('Language', info.language)]:
@@ -270,7 +345,7 @@ class Epub(object):
                  'authors': info.creators,
                  'publishers': info.publishers,
                  },
-                ret_cover_path, info.subjects)
+                ret_cover, info.subjects)
 
     def close(self):
         """
@@ -281,4 +356,6 @@ class Epub(object):
         """
         if self._zobject:
             self._zobject.close()
-        shutil.rmtree(self._tempdir)
+        if self._tempdir:
+            shutil.rmtree(self._tempdir)
+            self._tempdir = None
@@ -17,173 +17,140 @@
 
 from lxml import etree
 
+OPF_NS = '{http://www.idpf.org/2007/opf}'
+DC_NS = '{http://purl.org/dc/elements/1.1/}'
 
-class EpubInfo:  # TODO: Cover the entire DC range
-    def __init__(self, opf_file):
-        self._tree = etree.parse(opf_file)
-        self._root = self._tree.getroot()
-        self._e_metadata = self._root.find(
-            '{http://www.idpf.org/2007/opf}metadata')
-
-        self.title = self._get_title()
-        self.creators = self._get_creators()
-        self.publishers = self._get_publishers()
-
-        self.date = self._get_date()
-        self.subjects = self._get_subject()
-        self.source = self._get_source()
-        self.rights = self._get_rights()
-        self.identifier = self._get_identifier()
-        self.language = self._get_language()
-        self.summary = self._get_description()
-        self.cover_image = self._get_cover_image()
+METADATA = OPF_NS + 'metadata'
+META = OPF_NS + 'meta'
+ITEM = OPF_NS + 'item'
+REFERENCE = OPF_NS + 'reference'
+SPINE = OPF_NS + 'spine'
 
-    def _get_data(self, tagname):
-        element = self._e_metadata.find(tagname)
-        return element.text
+# Elements read from the OPF, the others are skipped by the parser.
+PARSED_TAGS = (DC_NS + '*', METADATA, META, ITEM, REFERENCE, SPINE)
 
-    def _get_description(self):
-        try:
-            ret = self._get_data(
-                './/{http://purl.org/dc/elements/1.1/}description')
-        except AttributeError:
-            return None
-
-        return ret
-
-    def _get_title(self):
-        try:
-            ret = self._get_data('.//{http://purl.org/dc/elements/1.1/}title')
-        except AttributeError:
-            return None
-
-        return ret
-
-    def _get_creators(self):
-        try:
-            creators = []
-            for element in self._e_metadata.iterfind(
-                    './/{http://purl.org/dc/elements/1.1/}creator'):
-                creators.append(element.text)
-        except AttributeError:
-            return None
-        return creators
-
-    def _get_publishers(self):
-        try:
-            publishers = []
-            for element in self._e_metadata.iterfind(
-                    './/{http://purl.org/dc/elements/1.1/}publisher'):
-                publishers.append(element.text)
-        except AttributeError:
-            return None
-        return publishers
-
-    def _get_date(self):
-        # TODO: iter
-        try:
-            ret = self._get_data('.//{http://purl.org/dc/elements/1.1/}date')
-        except AttributeError:
-            return None
 
-        return ret
-
-    def _get_source(self):
-        try:
-            ret = self._get_data('.//{http://purl.org/dc/elements/1.1/}source')
-        except AttributeError:
-            return None
+class EpubInfo:  # TODO: Cover the entire DC range
+    """Metadata of an ePub, read from its OPF file.
 
-        return ret
+    The OPF is parsed in a single pass with `iterparse()`: the Dublin Core
+    elements, the manifest items, the guide references and the meta elements
+    are collected when their end tag is reached, and cleared afterwards.
+    """
+    def __init__(self, opf_file):
+        # Dublin Core elements of the metadata, as lists of (text, attributes)
+        # by name.
+        self.dc = {}
+        # Manifest items, guide references and meta elements (the children
+        # of metadata), as lists of attribute dicts.
+        self.manifest = []
+        self.guide = []
+        self.metas = []
+        # id of the manifest item of the NCX.
+        self.toc_id = None
+
+        self._has_metadata = False
+        self._parse(opf_file)
+
+        self.title = self._get_data('title')
+        self.creators = self._get_list('creator')
+        self.publishers = self._get_list('publisher')
+
+        self.date = self._get_data('date')
+        self.subjects = self._get_list('subject')
+        self.source = self._get_data('source')
+        self.rights = self._get_data('rights')
+        self.identifier = self._get_identifier()
+        self.language = self._get_data('language')
+        self.summary = self._get_data('description')
+        self.cover_image = self._get_cover_image()
 
-    def _get_rights(self):
-        try:
-            ret = self._get_data('.//{http://purl.org/dc/elements/1.1/}rights')
-        except AttributeError:
+    def _parse(self, opf_file):
+        for _, element in etree.iterparse(opf_file, events=('end',),
+                                          tag=PARSED_TAGS):
+            tag = element.tag
+            # Ordered by frequency.
+            if tag == ITEM:
+                self.manifest.append(dict(element.items()))
+            elif tag.startswith(DC_NS):
+                if self._in_metadata(element):
+                    self.dc.setdefault(tag[len(DC_NS):], []).append(
+                        (element.text, dict(element.items())))
+            elif tag == META:
+                if element.getparent().tag == METADATA:
+                    self.metas.append(dict(element.items()))
+            elif tag == REFERENCE:
+                self.guide.append(dict(element.items()))
+            elif tag == SPINE:
+                if self.toc_id is None:
+                    self.toc_id = element.get('toc')
+            elif tag == METADATA:
+                self._has_metadata = True
+            element.clear()
+
+    @staticmethod
+    def _in_metadata(element):
+        for _ in element.iterancestors(METADATA):
+            return True
+        return False
+
+    def _get_data(self, name):
+        values = self.dc.get(name)
+        return values[0][0] if values else None
+
+    def _get_list(self, name):
+        if not self._has_metadata:
             return None
-
-        return ret
+        return [text for text, _ in self.dc.get(name, [])]
 
     def _get_identifier(self):
         # TODO: iter
-        element = self._e_metadata.find(
-            './/{http://purl.org/dc/elements/1.1/}identifier')
-
-        if element is not None:
-            return {'id': element.get('id'), 'value': element.text}
+        values = self.dc.get('identifier')
+        if values:
+            text, attrib = values[0]
+            return {'id': attrib.get('id'), 'value': text}
         else:
             return None
 
-    def _get_language(self):
-        # print "Language: % " %
-        #     self._get_data('.//{http://purl.org/dc/elements/1.1/}language')
-        try:
-            ret = self._get_data(
-                './/{http://purl.org/dc/elements/1.1/}language')
-        except AttributeError:
-            return None
-
-        return ret
-
-    def _get_subject(self):
-        try:
-            subject_list = []
-            for element in self._e_metadata.iterfind(
-                    './/{http://purl.org/dc/elements/1.1/}subject'):
-                subject_list.append(element.text)
-        except AttributeError:
-            return None
-
-        return subject_list
+    def get_item(self, item_id):
+        """Return the attributes of the manifest item with id `item_id`, or
+        None if there is none.
+        """
+        for item in self.manifest:
+            if item.get('id') == item_id:
+                return item
+        return None
 
     def _get_cover_image(self):
         cover = None
 
-        if cover is None:
-            for node in self._tree.iter():
-                if node.tag == '{http://www.idpf.org/2007/opf}reference':
-                    # Guide, EPUB 2 spec
-                    if node.attrib['type'] == 'cover':
-                        cover = node.attrib['href'].split('#')[0]
-                        break
-                    # Guide, non-standard as title attribute
-                    if node.attrib['title'] == 'Cover':
-                        cover = node.attrib['href'].split('#')[0]
-                        break
-                    # Guide title page if no cover
-                    if node.attrib['type'] in ['title-page', 'tp']:
-                        cover = node.attrib['href'].split('#')[0]
-                        break
+        for reference in self.guide:
+            # Guide, EPUB 2 spec
+            # Guide, non-standard as title attribute
+            # Guide title page if no cover
+            if (reference.get('type') in ('cover', 'title-page', 'tp') or
+                    reference.get('title') == 'Cover'):
+                cover = reference.get('href', '').split('#')[0]
+                break
 
         if cover is None:
-            for node in self._tree.iter():
-                if node.tag == '{http://www.idpf.org/2007/opf}item':
-                    # Spine item with id = "cover-image"
-                    if node.attrib['id'] == 'cover-image':
-                        cover = node.attrib['href']
-                        break
-                    # Spine item with id = "cover"
-                    if node.attrib['id'] == 'cover':
-                        cover = node.attrib['href']
-                        break
-                    # ePub 3
-                    if node.get('properties') == 'cover-image':
-                        cover = node.attrib['href']
-                        break
+            for item in self.manifest:
+                # Spine item with id = "cover-image" or "cover", or ePub 3
+                if (item.get('id') in ('cover-image', 'cover') or
+                        item.get('properties') == 'cover-image'):
+                    cover = item.get('href')
+                    break
 
         # ePub 2 metadata
         meta_content_cover = None
-        for element in self._e_metadata.iterfind(
-                '{http://www.idpf.org/2007/opf}meta'):
-            if element.get('name') == 'cover':
-                meta_content_cover = element.get('content')
+        for meta in self.metas:
+            if meta.get('name') == 'cover':
+                meta_content_cover = meta.get('content')
 
         if meta_content_cover:
-            for node in self._tree.iter():
-                if node.tag == '{http://www.idpf.org/2007/opf}item':
-                    if node.attrib['id'] == meta_content_cover:
-                        cover = node.attrib['href']
-                        break
+            item = self.get_item(meta_content_cover)
+            if item is not None:
+                cover = item.get('href')
             # In case meta tag refers to cover itself
             if cover is None:
                 cover = meta_content_cover
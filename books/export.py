@@ -0,0 +1,159 @@
+"""Bulk export of the catalog, for mirrors and offline copies.
+
+The whole catalog (or the books updated after a given date) is serialized as
+a single OPDS acquisition feed or as JSON lines, optionally gzip-compressed.
+The books are read with `iterator()` and their relations fetched for each
+chunk, so the memory used does not depend on the size of the catalog.
+"""
+
+from itertools import islice
+import json
+import zlib
+
+from django.conf import settings
+from django.core.urlresolvers import reverse
+from django.db.models import Max
+from django.db.models.query import prefetch_related_objects
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from books.atom import AtomFeed
+from books.models import Book
+from books.opds import ATTRS, book_item
+
+FORMATS = {
+    'atom': 'application/atom+xml',
+    'jsonl': 'application/x-ndjson',
+}
+
+# Number of books read for each chunk.
+CHUNK_SIZE = 1000
+
+
+def parse_since(value):
+    """Return the aware datetime for `value`, a ISO 8601 date or datetime,
+    raising ValueError if it is not valid.
+
+    :param value: date string
+    :returns: datetime
+    """
+    since = parse_datetime(value)
+    if since is None:
+        date = parse_date(value)
+        if date is None:
+            raise ValueError('%s is not a valid date' % value)
+        since = timezone.datetime(date.year, date.month, date.day)
+    if timezone.is_naive(since):
+        since = timezone.make_aware(since)
+    return since
+
+
+def export_queryset(since=None, published_only=True):
+    """Return the books to be exported, in the order they are exported.
+
+    :param since: if given, only the books updated after it are exported
+    :param published_only: export only the published books
+    :returns: queryset
+    """
+    books = Book.objects.select_related('dc_language', 'a_status')
+    if published_only:
+        books = books.filter(a_status=settings.BOOK_PUBLISHED)
+    if since is not None:
+        books = books.filter(a_updated__gt=since)
+    return books.order_by('a_updated', 'pk')
+
+
+def iter_books(books, chunk_size=CHUNK_SIZE):
+    """Iterate over the `books` queryset without caching the results,
+    fetching the authors, publishers and tags for each chunk of
+    `chunk_size` books with a single query each.
+
+    :param books: queryset
+    :param chunk_size: number of books of each chunk
+    :returns: generator of books
+    """
+    rows = books.iterator()
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        prefetch_related_objects(chunk, ['authors', 'publishers', 'tags'])
+        for book in chunk:
+            yield book
+
+
+def iter_opds(books, chunk_size=CHUNK_SIZE):
+    """Serialize `books` as a single OPDS acquisition feed.
+
+    :param books: queryset
+    :param chunk_size: number of books of each chunk
+    :returns: generator of encoded chunks
+    """
+    updated = books.aggregate(updated=Max('a_updated'))['updated']
+    feed = AtomFeed(title='Pathagar Bookserver OPDS feed',
+                    atom_id='pathagar:full-catalog',
+                    subtitle='OPDS catalog for the Pathagar book server',
+                    updated=updated or timezone.now(), extra_attrs=ATTRS,
+                    hide_generator=True,
+                    links=[{'title': 'Home', 'type': 'application/atom+xml',
+                            'rel': 'start', 'href': reverse('root_feed')}])
+    items = (book_item(book) for book in iter_books(books, chunk_size))
+    return feed.iter_write('UTF-8', items)
+
+
+def book_as_dict(book):
+    """Return the metadata of `book` as a JSON serializable dict."""
+    return {
+        'id': book.pk,
+        'atom_id': str(book.a_id),
+        'title': book.title,
+        'authors': [a.name for a in book.authors.all()],
+        'publishers': [p.name for p in book.publishers.all()],
+        'tags': [t.name for t in book.tags.all()],
+        'language': book.dc_language.code if book.dc_language else None,
+        'summary': book.summary,
+        'identifier': book.dc_identifier,
+        'issued': book.dc_issued,
+        'rights': book.a_rights,
+        'status': book.a_status.status,
+        'mimetype': book.mimetype,
+        'sha256': book.file_sha256sum,
+        'href': reverse('book_download', kwargs=dict(book_id=book.pk)),
+        'cover': book.cover_img.url if book.cover_img else None,
+        'downloads': book.downloads,
+        'time_added': book.time_added.isoformat(),
+        'updated': book.a_updated.isoformat(),
+    }
+
+
+def iter_jsonl(books, chunk_size=CHUNK_SIZE):
+    """Serialize `books` as JSON lines, one book per line.
+
+    :param books: queryset
+    :param chunk_size: number of books of each chunk
+    :returns: generator of encoded lines
+    """
+    for book in iter_books(books, chunk_size):
+        yield json.dumps(book_as_dict(book), sort_keys=True) + '\n'
+
+
+def iter_export(books, fmt, chunk_size=CHUNK_SIZE):
+    """Serialize `books` in the format `fmt` (a key of `FORMATS`)."""
+    if fmt == 'atom':
+        return iter_opds(books, chunk_size)
+    return iter_jsonl(books, chunk_size)
+
+
+def iter_gzip(chunks, level=6):
+    """Compress the `chunks` as a single gzip stream.
+
+    :param chunks: iterable of strings
+    :param level: compression level
+    :returns: generator of compressed chunks
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
@@ -0,0 +1,169 @@
+"""Cache of the rendered OPDS catalogs.
+
+The serialized catalogs are stored on the cache defined by
+`settings.FEED_CACHE` (an entry of `settings.CACHES`), keyed by the request
+path, the query string (page or cursor, search terms) and whether the user
+can see the unpublished books.
+
+Instead of deleting the entries when the catalog changes, the keys include a
+version stamp that is replaced by the signal handlers below whenever a Book,
+Author, Publisher, Language, Tag or comment is modified, making all the
+previous entries unreachable (they are eventually evicted by the cache
+backend). The version stamp is kept on the database (`CatalogVersion`), so
+the changes made by any process (ie. `addepub`, `watchepubs` or another
+server process) invalidate the catalogs cached by all of them, even if the
+cache is local to each process. It is also part of the ETags of the
+catalogs and book lists (see `books.decorators.catalog_condition`), so it is
+kept even if the feed cache is disabled.
+"""
+
+from functools import wraps
+from hashlib import md5
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import IntegrityError, transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from django.http import HttpResponse
+from django.utils.encoding import force_bytes
+from django.utils import timezone
+from django.utils.http import urlencode
+from taggit.models import Tag, TaggedItem
+import django_comments
+
+from books.models import Author, Book, CatalogVersion, Language, Publisher
+
+# Primary key of the single row of `CatalogVersion`.
+VERSION_PK = 1
+
+
+def get_cache():
+    return caches[settings.FEED_CACHE]
+
+
+def get_version_info(request=None):
+    """Return a tuple (version, changed) with the current version stamp of
+    the catalogs and the time it was created, creating it if needed. If
+    `request` is given, the version is only read once for it.
+    """
+    info = getattr(request, '_catalog_version', None)
+    if info is None:
+        info = CatalogVersion.objects.filter(pk=VERSION_PK).values_list(
+            'version', 'changed').first()
+        if info is None:
+            info = _new_version()
+        if request is not None:
+            request._catalog_version = info
+    return info
+
+
+def get_version(request=None):
+    """Return the current version stamp of the catalogs."""
+    return get_version_info(request)[0]
+
+
+def bump_version():
+    """Replace the version stamp, invalidating all the cached catalogs.
+
+    :returns: the new version stamp
+    """
+    return _new_version()[0]
+
+
+def _new_version():
+    info = (uuid.uuid4().hex, timezone.now())
+    fields = {'version': info[0], 'changed': info[1]}
+    if not CatalogVersion.objects.filter(pk=VERSION_PK).update(**fields):
+        try:
+            with transaction.atomic():
+                CatalogVersion.objects.create(pk=VERSION_PK, **fields)
+        except IntegrityError:
+            # Created meanwhile by another process.
+            CatalogVersion.objects.filter(pk=VERSION_PK).update(**fields)
+    return info
+
+
+def feed_cache_key(request, version):
+    """Return the cache key of the catalog for `request`.
+
+    :param request: request of the catalog
+    :param version: version stamp of the catalogs
+    :returns: cache key
+    """
+    visibility = 'all' if request.user.is_authenticated() else 'published'
+    query = urlencode(sorted(request.GET.lists()), doseq=True)
+    digest = md5(force_bytes('%s?%s' % (request.path, query))).hexdigest()
+    return 'feeds:%s:%s:%s' % (version, visibility, digest)
+
+
+def cache_feed(view):
+    """Decorator for the views that return an OPDS catalog when called with
+    `qtype='feed'`, serving the catalog from the feed cache if possible.
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if kwargs.get('qtype') != 'feed' or not settings.FEED_CACHE or \
+                request.method not in ('GET', 'HEAD'):
+            return view(request, *args, **kwargs)
+
+        cache = get_cache()
+        key = feed_cache_key(request, get_version(request))
+        content = cache.get(key)
+        if content is None:
+            response = view(request, *args, **kwargs)
+            if response.status_code != 200:
+                return response
+            if response.streaming:
+                response.streaming_content = _cache_chunks(
+                    cache, key, response.streaming_content)
+                return response
+            content = response.content
+            cache.set(key, content)
+        return HttpResponse(content, content_type='application/atom+xml')
+    return wrapper
+
+
+def _cache_chunks(cache, key, chunks):
+    """Yield the `chunks` of a streamed catalog, storing the catalog on the
+    cache once it has been sent, unless it is bigger than
+    `settings.FEED_CACHE_MAX_SIZE`.
+    """
+    collected, size = [], 0
+    for chunk in chunks:
+        if collected is not None:
+            size += len(chunk)
+            if size > settings.FEED_CACHE_MAX_SIZE:
+                collected = None
+            else:
+                collected.append(chunk)
+        yield chunk
+    if collected is not None:
+        cache.set(key, b''.join(collected))
+
+
+# Signal handlers for invalidating the cache.
+@receiver(post_save, sender=Book)
+@receiver(post_save, sender=Author)
+@receiver(post_save, sender=Publisher)
+@receiver(post_save, sender=Language)
+@receiver(post_save, sender=Tag)
+@receiver(post_save, sender=TaggedItem)
+@receiver(post_delete, sender=Book)
+@receiver(post_delete, sender=Author)
+@receiver(post_delete, sender=Publisher)
+@receiver(post_delete, sender=Language)
+@receiver(post_delete, sender=Tag)
+@receiver(post_delete, sender=TaggedItem)
+@receiver(post_save, sender=django_comments.get_model())
+@receiver(post_delete, sender=django_comments.get_model())
+def catalog_changed_handler(**kwargs):
+    bump_version()
+
+
+@receiver(m2m_changed, sender=Book.authors.through)
+@receiver(m2m_changed, sender=Book.publishers.through)
+def book_m2m_changed_feed_handler(**kwargs):
+    if kwargs['action'].startswith('post_'):
+        bump_version()
@@ -123,11 +123,20 @@ class BookEditForm(forms.ModelForm):
 class BookUploadForm(forms.Form):
     epub_file = forms.FileField()
 
+    def __init__(self, *args, **kwargs):
+        # sha256 sum of the file, if already known.
+        self.sha256sum = kwargs.pop('sha256sum', None)
+        super(BookUploadForm, self).__init__(*args, **kwargs)
+
     def clean_epub_file(self):
         """Perform basic validation of the epub_file by making sure:
         - no other existing models have the same sha256 hash.
         - it is parseable by `Epub`.
 
+        The sha256 sum is computed by the upload handlers while the file is
+        received (see `books.storage.HashingUploadHandlerMixin`), or passed
+        by the wizard when the form is validated again.
+
         TODO: This method is called twice during the wizard (at step 0, and
         at done()), by Django design. Still, we should look for alternatives
         in order to make sure epub validation only happens once.
@@ -136,7 +145,8 @@ class BookUploadForm(forms.Form):
         data = self.cleaned_data['epub_file']
 
         # Validate sha256 hash.
-        sha256sum = models.sha256_sum(data)
+        sha256sum = (getattr(data, 'sha256', None) or self.sha256sum or
+                     models.sha256_sum(data))
         if models.Book.objects.filter(file_sha256sum=sha256sum).exists():
             raise forms.ValidationError('The file is already on the database')
 
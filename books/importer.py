@@ -0,0 +1,280 @@
+"""Batched writes of imported books, and the manifest of imported files.
+
+Instead of saving each Book and adding its authors, publishers and tags one
+by one (which takes several queries per relation, and a reindex of the book
+for each of them), a batch of books is written with set-based queries: the
+related names are resolved with a single lookup per model, the missing ones
+are created with `bulk_create()`, and the books and their m2m rows are
+inserted in bulk. As `bulk_create()` does not send signals, the search index,
+the status counters and the feed cache version are updated once per batch.
+
+The imported files are recorded on `ImportedFile` with their size,
+modification time and inode, so later imports can skip the files that did
+not change without reading them or querying the books table.
+"""
+
+from contextlib import closing
+import os
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.files import File
+from django.db import transaction
+from django.db.models import Case, CharField, Value, When
+from taggit.models import Tag, TaggedItem
+
+from books import counters
+from books import feed_cache
+from books import thumbnails
+from books.models import Author, Book, ImportedFile, Language, Publisher
+from books.search_index import get_search_backend
+from books.storage import DigestCache
+
+# Maximum number of parameters of the IN lookups (SQLite allows 999 by
+# default).
+LOOKUP_SIZE = 500
+
+
+class BookEntry(object):
+    """A `book` (not saved yet, but with its file already stored), its
+    `books.epub.Cover` and its related objects, to be saved by
+    `save_books()`.
+    """
+    def __init__(self, book, cover=None, authors=(), publishers=(), tags=()):
+        self.book = book
+        self.cover = cover
+        self.authors = authors
+        self.publishers = publishers
+        self.tags = tags
+
+
+def _chunks(values, size=LOOKUP_SIZE):
+    values = list(values)
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+def _pks_by_field(model, field, values):
+    pks = {}
+    for chunk in _chunks(values):
+        pks.update(model.objects.filter(**{'%s__in' % field: chunk}).
+                   values_list(field, 'pk'))
+    return pks
+
+
+def get_or_create_names(model, names):
+    """Return a dict mapping each of `names` to the pk of the `model`
+    instance (`Author` or `Publisher`) with that name, creating the missing
+    ones with a single bulk insert.
+
+    :param model: model with an unique `name` field
+    :param names: iterable of names
+    :returns: dict
+    """
+    names = set(names)
+    pks = _pks_by_field(model, 'name', names)
+    missing = names.difference(pks)
+    if missing:
+        model.objects.bulk_create([model(name=name) for name in missing])
+        pks.update(_pks_by_field(model, 'name', missing))
+    return pks
+
+
+def get_or_create_tags(names):
+    """Return a dict mapping each of `names` to the pk of the `Tag` with that
+    name, creating the missing ones. The tags are created with a bulk insert
+    unless their slug is already taken, in which case taggit is left to find
+    an unique one.
+
+    :param names: iterable of (lowercase) tag names
+    :returns: dict
+    """
+    names = set(names)
+    pks = _pks_by_field(Tag, 'name', names)
+    missing = names.difference(pks)
+    if not missing:
+        return pks
+
+    slugs = dict((name, Tag().slugify(name)) for name in missing)
+    taken = set(_pks_by_field(Tag, 'slug', slugs.values()))
+    new_tags, conflicts = [], []
+    for name in sorted(missing):
+        if slugs[name] in taken:
+            conflicts.append(name)
+        else:
+            taken.add(slugs[name])
+            new_tags.append(Tag(name=name, slug=slugs[name]))
+    Tag.objects.bulk_create(new_tags)
+    pks.update(_pks_by_field(Tag, 'name', [t.name for t in new_tags]))
+    for name in conflicts:
+        pks[name] = Tag.objects.get_or_create(
+            name__iexact=name, defaults={'name': name})[0].pk
+    return pks
+
+
+def get_languages(codes):
+    """Return a dict mapping each of `codes` to its `Language`, creating the
+    missing ones, or to None if the code is not valid.
+
+    :param codes: iterable of language codes
+    :returns: dict
+    """
+    codes = set(codes)
+    languages = dict((language.code, language) for language in
+                     Language.objects.filter(code__in=codes))
+    for code in codes.difference(languages):
+        try:
+            with transaction.atomic():
+                languages[code] = Language.objects.get_or_create_by_code(code)
+        except Exception:
+            languages[code] = None
+    return languages
+
+
+def _save_covers(entries):
+    """Store the covers of the saved `entries`, named after the book pk, and
+    set the `cover_img` of all of them with a single UPDATE.
+    """
+    whens = []
+    for entry in entries:
+        if not entry.cover:
+            continue
+        book = entry.book
+        with closing(entry.cover.open()) as f:
+            book.cover_img.save('%s%s' % (book.pk, entry.cover.extension),
+                                File(f), save=False)
+        whens.append((book.pk, When(pk=book.pk,
+                                    then=Value(book.cover_img.name))))
+    if whens:
+        Book.objects.filter(pk__in=[pk for pk, _ in whens]).update(
+            cover_img=Case(*[when for _, when in whens],
+                           output_field=CharField()))
+        # The update does not send signals.
+        thumbnails.enqueue([pk for pk, _ in whens])
+
+
+def save_books(entries):
+    """Save the books of `entries` and their relations with a fixed number of
+    queries. The books must not be duplicates of the existing ones (ie. have
+    the same `file_sha256sum`). If the save fails, the stored files of the
+    books are deleted and the exception is raised again.
+
+    :param entries: list of `BookEntry`
+    """
+    if not entries:
+        return
+    try:
+        _save_books(entries)
+    except Exception:
+        for entry in entries:
+            entry.book.book_file.delete(save=False)
+            if entry.book.cover_img:
+                entry.book.cover_img.delete(save=False)
+        raise
+
+
+def _save_books(entries):
+    Book.objects.bulk_create([entry.book for entry in entries])
+
+    # bulk_create() does not set the pks on all the backends: fetch them
+    # using the unique sha256 sums.
+    pks = _pks_by_field(Book, 'file_sha256sum',
+                        [entry.book.file_sha256sum for entry in entries])
+    for entry in entries:
+        entry.book.pk = pks[entry.book.file_sha256sum]
+        entry.book._state.adding = False
+        entry.book._state.db = Book.objects.db
+
+    _save_covers(entries)
+
+    # Relations.
+    authors = get_or_create_names(
+        Author, [name for entry in entries for name in entry.authors])
+    publishers = get_or_create_names(
+        Publisher, [name for entry in entries for name in entry.publishers])
+    tags = get_or_create_tags(
+        [name for entry in entries for name in entry.tags])
+    content_type = ContentType.objects.get_for_model(Book)
+
+    author_rows, publisher_rows, tag_rows = [], [], []
+    for entry in entries:
+        book_pk = entry.book.pk
+        for author_pk in set(authors[name] for name in entry.authors):
+            author_rows.append(Book.authors.through(book_id=book_pk,
+                                                    author_id=author_pk))
+        for publisher_pk in set(publishers[name] for name in
+                                entry.publishers):
+            publisher_rows.append(Book.publishers.through(
+                book_id=book_pk, publisher_id=publisher_pk))
+        for tag_pk in set(tags[name] for name in entry.tags):
+            tag_rows.append(TaggedItem(tag_id=tag_pk, object_id=book_pk,
+                                       content_type=content_type))
+    Book.authors.through.objects.bulk_create(author_rows)
+    Book.publishers.through.objects.bulk_create(publisher_rows)
+    TaggedItem.objects.bulk_create(tag_rows)
+
+    # Do the work of the signal handlers once for the whole batch.
+    get_search_backend().index_books(pks.values())
+    statuses = {}
+    for entry in entries:
+        statuses[entry.book.a_status_id] = \
+            statuses.get(entry.book.a_status_id, 0) + 1
+    for status_id, count in statuses.items():
+        counters.increment(status_id, count)
+    feed_cache.bump_version()
+
+
+def file_signature(filename):
+    """Return the (size, mtime, inode) of `filename`, used for detecting if
+    it changed since it was imported.
+    """
+    st = os.stat(filename)
+    return st.st_size, st.st_mtime, st.st_ino
+
+
+def get_manifest(paths=None):
+    """Return a dict mapping the paths of the imported files to their
+    signature when they were imported.
+
+    :param paths: if given, only the entries of these paths are returned
+    :returns: dict
+    """
+    return dict((path, (size, mtime, inode)) for path, size, mtime, inode in
+                _manifest_rows(('path', 'size', 'mtime', 'inode'), paths))
+
+
+def get_digests(paths=None):
+    """Return a `DigestCache` with the sha256 sums of the files on the
+    manifest, which are only used if the files did not change since they were
+    imported.
+
+    :param paths: if given, only the entries of these paths are loaded
+    :returns: `books.storage.DigestCache`
+    """
+    return DigestCache(
+        ((path, size, mtime), sha256) for path, size, mtime, sha256 in
+        _manifest_rows(('path', 'size', 'mtime', 'sha256'), paths))
+
+
+def _manifest_rows(fields, paths=None):
+    if paths is None:
+        return ImportedFile.objects.values_list(*fields).iterator()
+    return (row for chunk in _chunks(paths) for row in
+            ImportedFile.objects.filter(path__in=chunk).values_list(*fields))
+
+
+def record_files(files):
+    """Record the `files` on the manifest, replacing their previous entries.
+    Only the files with the same contents as an existing Book are recorded.
+
+    :param files: iterable of tuples (path, signature, sha256)
+    """
+    files = list(files)
+    books = _pks_by_field(Book, 'file_sha256sum',
+                          set(sha256 for _, _, sha256 in files))
+    entries = [ImportedFile(path=path, size=size, mtime=mtime, inode=inode,
+                            sha256=sha256, book_id=books[sha256])
+               for path, (size, mtime, inode), sha256 in files
+               if sha256 in books]
+    for chunk in _chunks([entry.path for entry in entries]):
+        ImportedFile.objects.filter(path__in=chunk).delete()
+    ImportedFile.objects.bulk_create(entries, batch_size=LOOKUP_SIZE)
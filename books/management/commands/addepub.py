@@ -1,34 +1,56 @@
 from __future__ import unicode_literals
 
-from django.core.management.base import BaseCommand, CommandError
+from django.core.management.base import BaseCommand, CommandError, \
+    OutputWrapper
 from django.core.files import File
 from django.core.exceptions import ValidationError
 
+from functools import partial
+from itertools import imap, islice
+import multiprocessing
 import os
 import sys
 import logging
+import time
+from StringIO import StringIO
 
 from django.conf import settings
+from django.db import transaction
 
+from books import counters
+from books import importer
 from books import models
+from books import thumbnails
 from books.epub import Epub
-from books.storage import LinkableFile
+from books.profiling import Profile
+from books.storage import DigestCache, LinkableFile, StagedFile, stage_file
 from books.utils import fix_authors
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# sha256 sums of the files hashed by this process, for not reading them again
+# if they did not change.
+digest_cache = DigestCache(max_entries=10000)
 
-def get_epubs_paths(paths, skip_original_path=True):
+
+def get_epubs_paths(paths, skip_original_path=True, dry_run=False):
     """Return a list of paths for potential EPUB(s) from a list of file and
     directory names. The returned list contains only files with the '.epub'
     extension, traversing the directories recursively.
 
+    If `skip_original_path` is True, the files that are on the import
+    manifest and have not changed since they were imported are skipped
+    without querying the books table. The remaining files that match a
+    Book.original_path are also skipped (see `exclude_imported_paths()`).
+
     :param paths:
     :param skip_original_path: boolean indicating it the files that match a
     Book.original_path are excluded from the results.
+    :param dry_run: do not record the files found on the manifest.
     :return:
     """
+    manifest = importer.get_manifest() if skip_original_path else {}
 
     def validate_and_add(path, filenames):
         """Check that the `path` has an '.epub' extension, convert it to
@@ -40,14 +62,16 @@ def get_epubs_paths(paths, skip_original_path=True):
         """
         if os.path.splitext(path)[1] == '.epub':
             filename = os.path.abspath(path)
-            if filename not in filenames:
-                if skip_original_path and models.Book.objects.filter(
-                        original_path=filename).exists():
+            if filename not in seen:
+                seen.add(filename)
+                if filename in manifest and manifest[filename] == \
+                        importer.file_signature(filename):
+                    # Unchanged since it was imported.
                     return
                 filenames.append(filename)
 
     print "Finding new ePubs ..."
-    filenames = []
+    filenames, seen = [], set()
     for path in paths:
         if os.path.isdir(path):
             # path is a directory: traverse and add *.epub
@@ -58,9 +82,205 @@ def get_epubs_paths(paths, skip_original_path=True):
             # path is a file: add if *.epub.
             validate_and_add(path, filenames)
 
+    if skip_original_path:
+        filenames = exclude_imported_paths(filenames, manifest, dry_run)
+
     return filenames
 
 
+def exclude_imported_paths(filenames, manifest, dry_run=False):
+    """Return the `filenames` that do not match the Book.original_path of an
+    existing book, looking them up in chunks.
+
+    The files found that are not on the `manifest` (ie. imported before the
+    manifest existed) are added to it. The ones on the manifest changed since
+    they were imported: they are hashed, and recorded again if they still
+    have the contents of their book (ie. they were only touched). The edited
+    ones are not imported again as new books, nor recorded (`resync` updates
+    their books). If `dry_run` is True, nothing is recorded.
+
+    :param filenames: list of absolute paths
+    :param manifest: dict returned by `importer.get_manifest()` for (at
+    least) `filenames`
+    :param dry_run: boolean
+    :return: list of paths
+    """
+    imported = {}
+    for i in range(0, len(filenames), importer.LOOKUP_SIZE):
+        imported.update(models.Book.objects.filter(
+            original_path__in=filenames[i:i + importer.LOOKUP_SIZE]).
+            values_list('original_path', 'file_sha256sum'))
+    unrecorded = [(path, sha256) for path, sha256 in imported.items()
+                  if path not in manifest or
+                  digest_cache.sha256(path) == sha256]
+    if unrecorded and not dry_run:
+        with transaction.atomic():
+            importer.record_files(
+                (path, importer.file_signature(path), sha256)
+                for path, sha256 in unrecorded)
+    return [f for f in filenames if f not in imported]
+
+
+def get_staging_dir():
+    """Return the directory where `parse_epub()` copies the files: a
+    directory of the storage of `Book.book_file`, so the copies can be moved
+    into place instead of copied again.
+    """
+    return models.Book._meta.get_field('book_file').storage.path('.staging')
+
+
+def parse_epub(filename, staging_dir=None):
+    """Parse the EPUB at `filename`, extracting the information needed for
+    creating the `Book` without accessing the database, so it can be run on
+    the worker processes of `addepub --jobs`.
+
+    If `staging_dir` is given, the file is copied there and hashed in the
+    same pass, so it is only read once during the import. Otherwise, it is
+    only hashed (unless it was already hashed by this process and did not
+    change).
+
+    Returns a dict with the keys:
+    - 'filename': the `filename`.
+    - 'info', 'cover', 'subjects': the values returned by
+    `Epub.as_model_dict(in_memory=True)`, the cover being a `books.epub.Cover`
+    (kept in memory unless it is too big).
+    - 'sha256': the sha256 sum of the file.
+    - 'staged': the path of the copy on `staging_dir`, or None.
+    - 'stat': the signature of the file for the import manifest.
+    - 'error': the error message if the file could not be parsed, or None.
+    - 'output': the messages printed while parsing.
+    - 'timings': the duration of the stages of the parsing, in seconds (see
+    `books.profiling`).
+
+    :param filename: ePub file to parse
+    :param staging_dir: directory for the copy of the file, or None
+    :return: dict
+    """
+    result = {'filename': filename, 'info': None, 'cover': None,
+              'subjects': None, 'sha256': None, 'staged': None, 'stat': None,
+              'error': None, 'timings': {}}
+
+    # Collect the messages printed by Epub, so they are not mixed with the
+    # ones of the other files when run in parallel.
+    stdout, sys.stdout = sys.stdout, StringIO()
+    epub = None
+    try:
+        epub = Epub(filename)
+        epub.get_info()
+        # Get the information we need for creating the Model.
+        result['info'], result['cover'], result['subjects'] = \
+            epub.as_model_dict(in_memory=True)
+        assert result['info']
+        result['stat'] = importer.file_signature(filename)
+        start = time.time()
+        if staging_dir:
+            result['staged'], result['sha256'] = stage_file(filename,
+                                                            staging_dir)
+        else:
+            result['sha256'] = digest_cache.sha256(filename)
+        result['timings']['hash'] = time.time() - start
+    except Exception as e:
+        result['error'] = unicode(e)
+        # TODO: this is not 100% reliable yet. Further modifications to
+        # epub.py are needed.
+        delete_temporary(result)
+        result['cover'] = None
+        result['staged'] = None
+    finally:
+        if epub is not None:
+            epub.close()
+            result['timings'].update(epub.timings)
+        result['output'] = sys.stdout.getvalue()
+        sys.stdout = stdout
+
+    return result
+
+
+def write_profile(profile, output, stdout, **extra):
+    """Write the JSON summary of `profile` (with the items of `extra`) on the
+    file `output`, or on `stdout` if it is '-'.
+    """
+    summary = profile.to_json(**extra)
+    if output == '-':
+        stdout.write(summary)
+    else:
+        with open(output, 'w') as f:
+            f.write(summary + '\n')
+
+
+def delete_temporary(parsed):
+    """Delete the temporary files of the EPUB parsed by `parse_epub()`: its
+    cover and the copy of the file, if it was not moved to the storage.
+    """
+    if parsed['cover']:
+        parsed['cover'].delete()
+    if parsed['staged'] and os.path.exists(parsed['staged']):
+        os.remove(parsed['staged'])
+
+
+def book_file_for(parsed, use_symlink=False):
+    """Return the `File` for saving the EPUB parsed by `parse_epub()` on
+    `Book.book_file`: a symlink to the original file if `use_symlink`, or
+    its copy on the staging directory, which is moved into place. If there
+    is no copy, the original file is copied.
+    """
+    filename = parsed['filename']
+    if use_symlink:
+        return LinkableFile(open(filename, 'rb'))
+    if parsed['staged'] and os.path.exists(parsed['staged']):
+        return StagedFile(parsed['staged'])
+    return File(open(filename, 'rb'))
+
+
+def split_authors(authors):
+    """Return the list of author names from the `authors` found on an EPUB,
+    splitting the ones that contain several names and normalizing them with
+    `fix_authors()`.
+
+    :param authors: list of strings
+    :return: list of names
+    """
+    names = []
+    for author in authors:
+        if author is None:
+            continue
+        for auth in author.strip().replace(' and ', ';').replace(
+                '&', ';').split(';'):
+            auth = fix_authors(auth)
+            if not auth:
+                continue
+            for name in [auth] if isinstance(auth, basestring) else auth:
+                if name not in names:
+                    names.append(name)
+    return names
+
+
+def split_subjects(subjects):
+    """Return the list of tag names from the `subjects` found on an EPUB.
+
+    :param subjects: list of strings
+    :return: list of (lowercase) tag names
+    """
+    tags = []
+    for subject in (subjects or []):
+        # workaround for ePubs with description as subject
+        if not subject or len(subject) > 80:
+            break
+
+        subject_split = subject.replace('/', ',') \
+            .replace(';', ',') \
+            .replace(':', '') \
+            .replace('\n', ',') \
+            .replace(' ,', ',') \
+            .replace(' ,', ',') \
+            .split(',')
+        for tag in subject_split:
+            tag = tag.lower().strip()
+            if tag and tag not in tags:
+                tags.append(tag)
+    return tags
+
+
 class Command(BaseCommand):
     help = 'Import ePubs from the local file system into the database.'
 
@@ -87,211 +307,363 @@ class Command(BaseCommand):
             default=True,
             help=('Do not take into account the file path when checking for '
                   'duplicates.'))
+        parser.add_argument(
+            '--jobs', '-j',
+            type=int,
+            dest='jobs',
+            default=1,
+            help=('Number of processes used for parsing, copying and '
+                  'hashing the files (default: 1). The books are still saved '
+                  'to the database by a single process.'))
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            dest='batch_size',
+            default=100,
+            help=('Number of files saved to the database on each transaction '
+                  '(default: 100).'))
+        parser.add_argument(
+            '--dry-run', '-n',
+            action='store_true',
+            dest='dry_run',
+            default=False,
+            help=('Parse and hash the files, and check for duplicates, '
+                  'without copying them or writing to the database.'))
+        parser.add_argument(
+            '--profile',
+            nargs='?',
+            const='-',
+            dest='profile',
+            default=None,
+            help=('Report the duration of each stage of the import and the '
+                  'throughput as JSON, on the given file or on the standard '
+                  'output.'))
 
     def handle(self, *args, **options):
+        profile = Profile() if options['profile'] else None
+        start = time.time()
         epub_filenames = get_epubs_paths(options['item'],
-                                         options['skip_original_path'])
+                                         options['skip_original_path'],
+                                         options['dry_run'])
+        if profile:
+            profile.add('walk', time.time() - start)
 
         if not epub_filenames:
             raise CommandError('No .epub files found on the specified paths.')
 
+        self.stdout.write('Importing %s items ...' % len(epub_filenames))
+        counter = self.import_files(epub_filenames, options['use_symlink'],
+                                    options['batch_size'], options['jobs'],
+                                    options['dry_run'], profile)
+
+        if options['dry_run']:
+            self.stdout.write('{} files would be imported, {} files would not '
+                              'be imported.'.format(counter['success'],
+                                                    counter['fail']))
+        else:
+            self.stdout.write('{} files imported, {} files not imported.'.
+                              format(counter['success'], counter['fail']))
+
+            # Wait for the thumbnails of the covers, generated on the
+            # background while importing.
+            thumbnails.queue.join()
+
+            # The counters are updated on each save, but a failed import can
+            # leave them out of sync: recompute them once at the end.
+            counters.rebuild()
+
+        if profile:
+            write_profile(profile, options['profile'], self.stdout,
+                          command='addepub', dry_run=options['dry_run'],
+                          jobs=options['jobs'],
+                          batch_size=options['batch_size'],
+                          use_symlink=options['use_symlink'])
+
+    def import_files(self, epub_filenames, use_symlink=False, batch_size=100,
+                     jobs=1, dry_run=False, profile=None):
+        """Import the EPUBs at `epub_filenames`, in batches of `batch_size`
+        files, reporting the result of each file and recording the imported
+        ones on the manifest.
+
+        :param epub_filenames: list of paths
+        :param use_symlink: symlink ePub to FileField or process normally
+        :param batch_size: number of files saved on each transaction
+        :param jobs: number of processes used for parsing the files
+        :param dry_run: only parse and hash the files, and check for
+        duplicates, without saving anything
+        :param profile: `books.profiling.Profile` for the timings, or None
+        :return: dict with the number of files imported ('success') and not
+        imported ('fail')
+        """
         # Keep track of some basic stats.
         counter = {'success': 0, 'fail': 0}
         width = len(str(len(epub_filenames)))
-        self.stdout.write('Importing %s items ...' % len(epub_filenames))
+        seen = set()
+
+        # Parse the files on a pool of worker processes if requested, saving
+        # the results from this process in the same order. Unless they are
+        # linked, the files are copied to the storage by the workers.
+        parse = partial(parse_epub, staging_dir=None if use_symlink or dry_run
+                        else get_staging_dir())
+        pool = None
+        if jobs > 1:
+            pool = multiprocessing.Pool(jobs)
+            results = pool.imap(parse, epub_filenames)
+        else:
+            results = imap(parse, epub_filenames)
 
-        for i, filename in enumerate(epub_filenames):
-            self.stdout.write(self.style.HTTP_INFO(
-                '[{i: {width}}/{total: {width}}] {f}'.format(
-                    i=i+1,
-                    total=len(epub_filenames),
-                    width=width,
-                    f=filename)))
+        try:
+            i = 0
+            while True:
+                batch = list(islice(results, batch_size))
+                if not batch:
+                    break
+                start = time.time()
+                if dry_run:
+                    outcomes = self.check_batch(batch, seen)
+                else:
+                    with transaction.atomic():
+                        outcomes = self.import_batch(batch, use_symlink)
+                        importer.record_files(
+                            (parsed['filename'], parsed['stat'],
+                             parsed['sha256'])
+                            for parsed in batch if parsed['error'] is None)
+                if profile:
+                    profile.add('db', time.time() - start)
+                    for parsed in batch:
+                        profile.add_timings(parsed['timings'])
+                        profile.count('files')
+                        if parsed['stat']:
+                            profile.count('bytes', parsed['stat'][0])
+                for parsed, (success, output) in zip(batch, outcomes):
+                    i += 1
+                    self.stdout.write(self.style.HTTP_INFO(
+                        '[{i: {width}}/{total: {width}}] {f}'.format(
+                            i=i,
+                            total=len(epub_filenames),
+                            width=width,
+                            f=parsed['filename'])))
+                    self.stdout.write(output, ending='')
+
+                    if success:
+                        counter['success'] += 1
+                        self.stdout.write(self.style.HTTP_REDIRECT(
+                            'File would be imported' if dry_run else
+                            'File imported'))
+                    else:
+                        counter['fail'] += 1
+                        self.stdout.write(self.style.NOTICE(
+                            'File would NOT be imported' if dry_run else
+                            'File NOT imported'))
+                    self.stdout.write('')
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
 
-            success = True
-            try:
-                success = self.process_epub(filename, options['use_symlink'])
-            except Exception as e:
-                self.stdout.write(self.style.ERROR(
-                    'Unhandled exception while importing:\n%s' % e))
-                success = False
+        return counter
+
+    def check_batch(self, batch, seen):
+        """Check a batch of EPUBs parsed by `parse_epub()` for duplicates,
+        without saving them (for `--dry-run`).
 
-            if success:
-                counter['success'] += 1
-                self.stdout.write(self.style.HTTP_REDIRECT('File imported'))
+        :param batch: list of dicts returned by `parse_epub()`
+        :param seen: set of the sha256 sums of the previous files, which is
+        updated with the ones of the batch
+        :return: list of tuples (success, messages), one for each file
+        """
+        existing = set(models.Book.objects.filter(
+            file_sha256sum__in=[parsed['sha256'] for parsed in batch
+                                if parsed['error'] is None]).
+            values_list('file_sha256sum', flat=True))
+        outcomes = []
+        for parsed in batch:
+            out = OutputWrapper(StringIO())
+            if parsed['output']:
+                out.write(parsed['output'], ending='')
+            delete_temporary(parsed)
+
+            if parsed['error'] is not None:
+                out.write(self.style.ERROR(
+                    "Error while parsing '%s':\n%s" % (parsed['filename'],
+                                                       parsed['error'])))
+                outcomes.append((False, out._out.getvalue()))
+            elif parsed['sha256'] in existing or parsed['sha256'] in seen:
+                out.write(self.style.WARNING(
+                    'The book (%s) would not be saved because the file '
+                    'already exists in the database.' % parsed['filename']))
+                outcomes.append((False, out._out.getvalue()))
             else:
-                counter['fail'] += 1
-                self.stdout.write(self.style.NOTICE('File NOT imported'))
-            self.stdout.write('')
+                seen.add(parsed['sha256'])
+                outcomes.append((True, out._out.getvalue()))
+        return outcomes
 
-        self.stdout.write('{} files imported, {} files not imported.'.format(
-            counter['success'], counter['fail']))
+    def import_batch(self, batch, use_symlink=False):
+        """Save a batch of EPUBs parsed by `parse_epub()`, resolving the
+        related objects and inserting the books with a fixed number of queries
+        (see `books.importer`). If the bulk save fails, the files are
+        imported one by one instead.
 
-    def process_epub(self, filename, use_symlink=False):
-        """Import a single EPUB from `filename`, creating a new `Book` based
-        on the information parsed from the epub.
-
-        :param filename: ePub file to process
+        :param batch: list of dicts returned by `parse_epub()`
         :param use_symlink: symlink ePub to FileField or process normally
-        :return: success result
+        :return: list of tuples (success, messages), one for each file
         """
-
-        # Try to parse the epub file, extracting the relevant info.
-        info_dict = {}
-        tmp_cover_path = None
+        entries, outputs = [], []
         try:
-            epub = Epub(filename)
-            epub.get_info()
-            # Get the information we need for creating the Model.
-            info_dict, tmp_cover_path, subjects = epub.as_model_dict()
-            assert info_dict
-        except Exception as e:
-            self.stdout.write(self.style.ERROR(
-                "Error while parsing '%s':\n%s" % (filename, unicode(e))))
+            status, languages, existing = self.lookup_batch(batch)
+            for parsed in batch:
+                out = OutputWrapper(StringIO())
+                if parsed['output']:
+                    out.write(parsed['output'], ending='')
+                entry = self.prepare_book(parsed, use_symlink, status,
+                                          languages, existing, out)
+                entries.append(entry)
+                outputs.append(out)
 
-            # TODO: this is not 100% reliable yet. Further modifications to
-            # epub.py are needed.
             try:
-                if tmp_cover_path:
-                    os.remove(tmp_cover_path)
-                # close() can fail itself it _zobject failed to be initialized.
-                epub.close()
-            except:
-                pass
-            return False
+                with transaction.atomic():
+                    importer.save_books([e for e in entries if e])
+            except Exception as e:
+                self.stdout.write(self.style.WARNING(
+                    'Error while saving the batch, importing the files one '
+                    'by one:\n%s' % e))
+                return [self._import_single(parsed, use_symlink)
+                        for parsed in batch]
+        finally:
+            # Delete the temporary files.
+            for parsed in batch:
+                delete_temporary(parsed)
 
-        # Prepare some model fields that require extra care.
-        # Language (dc_language).
-        try:
-            language = models.Language.objects.get_or_create_by_code(
-                info_dict['dc_language']
-            )
-            info_dict['dc_language'] = language
-        except:
-            info_dict['dc_language'] = None
-
-        # Original filename (original_path).
-        info_dict['original_path'] = filename
-        # Published status (a_status).
-        info_dict['a_status'] = models.Status.objects.get(
-            status=settings.DEFAULT_BOOK_STATUS)
+        return [(entry is not None, out._out.getvalue())
+                for entry, out in zip(entries, outputs)]
 
-        # Remove authors and publishers from dict.
-        authors = info_dict.pop('authors', [])
-        publishers = info_dict.pop('publishers', [])
+    def lookup_batch(self, batch):
+        """Return the objects needed by `prepare_book()` for the EPUBs of
+        `batch`, with a fixed number of queries: a tuple (status, languages,
+        existing).
 
-        # Create and save the Book.
+        :param batch: list of dicts returned by `parse_epub()`
+        :return: tuple
+        """
+        status = models.Status.objects.get(
+            status=settings.DEFAULT_BOOK_STATUS)
+        parsed_ok = [parsed for parsed in batch if parsed['error'] is None]
+        languages = importer.get_languages(
+            parsed['info']['dc_language'] for parsed in parsed_ok)
+        existing = set(models.Book.objects.filter(
+            file_sha256sum__in=[parsed['sha256'] for parsed in parsed_ok]).
+            values_list('file_sha256sum', flat=True))
+        return status, languages, existing
+
+    def _import_single(self, parsed, use_symlink=False):
+        out = OutputWrapper(StringIO())
+        if parsed['output']:
+            out.write(parsed['output'], ending='')
+        success = self.import_epub(parsed, use_symlink, out)
+        return success, out._out.getvalue()
+
+    def prepare_book(self, parsed, use_symlink, status, languages, existing,
+                     out):
+        """Validate the EPUB parsed by `parse_epub()` and store its file,
+        returning the `importer.BookEntry` for saving it, or None if it can
+        not be imported.
+
+        :param parsed: dict returned by `parse_epub()`
+        :param use_symlink: symlink ePub to FileField or process normally
+        :param status: `Status` of the new book
+        :param languages: dict returned by `importer.get_languages()`
+        :param existing: set of the sha256 sums already in the database,
+        which is updated with the sum of the book
+        :param out: `OutputWrapper` for the messages
+        :return: `importer.BookEntry` or None
+        """
+        filename = parsed['filename']
+        if parsed['error'] is not None:
+            out.write(self.style.ERROR(
+                "Error while parsing '%s':\n%s" % (filename, parsed['error'])))
+            return None
+
+        if parsed['sha256'] in existing:
+            out.write(self.style.WARNING(
+                'The book (%s) was not saved because the file already '
+                'exists in the database.' % filename))
+            return None
+
+        info_dict = dict(parsed['info'])
+        info_dict['dc_language'] = languages.get(info_dict['dc_language'])
+        info_dict['original_path'] = filename
+        info_dict['a_status'] = status
+        authors = split_authors(info_dict.pop('authors', []))
+        publishers = [p for p in info_dict.pop('publishers', []) if p]
+
+        # Validate before storing the file. The uniqueness and the foreign
+        # keys have already been checked for the whole batch.
+        book = models.Book(**info_dict)
+        book.file_sha256sum = parsed['sha256']
         try:
-            # Prepare the Book.
-            book = models.Book(**info_dict)
-            # Use a symlink or copy the file depending on options.
-            if use_symlink:
-                f = LinkableFile(open(filename))
-            else:
-                f = File(open(filename))
+            book.full_clean(exclude=['book_file', 'a_status', 'dc_language'],
+                            validate_unique=False)
+        except ValidationError as e:
+            out.write(self.style.ERROR(
+                'The book (%s) was not saved because it is not valid:\n%s' %
+                (filename, e)))
+            return None
+
+        # Use a symlink or move the copy depending on options.
+        with book_file_for(parsed, use_symlink) as f:
             book.book_file.save(os.path.basename(filename), f, save=False)
-            book.file_sha256sum = models.sha256_sum(book.book_file)
-
-            # Validate and save.
-            book.full_clean()
-            book.save()
-
-            # Handle info that needs existing book instance thru book.save.
-            # authors, publishers, cover, and tags
-
-            # Add authors
-            for author in authors:
-                if author is not None:
-                    author_split = author.strip().replace(
-                        ' and ', ';').replace('&', ';').split(';')
-                    for auth in author_split:
-                        auth = fix_authors(auth)
-                        if auth:
-                            for a in auth if not \
-                                    isinstance(auth, basestring) \
-                                    else [auth]:
-                                self.stdout.write(self.style.NOTICE(
-                                    'Found author: "%s"' % a))
-                                book.authors.add(
-                                    models.Author.objects.get_or_create(
-                                        name=a)[0].pk)
-
-            # Add publishers
-            for publisher in publishers:
-                self.stdout.write(self.style.NOTICE(
-                    'Found publisher: "%s"' % publisher))
-                book.publishers.add(
-                    models.Publisher.objects.get_or_create(
-                        name=publisher)[0].pk)
-
-            # Add cover image (cover_image). It is handled here as the filename
-            # depends on instance.pk (which is only present after Book.save()).
-            if tmp_cover_path:
-                try:
-                    cover_filename = '%s%s' % (
-                        book.pk, os.path.splitext(tmp_cover_path)[1]
-                    )
-                    book.cover_img.save(cover_filename,
-                                        File(open(tmp_cover_path)),
-                                        save=True)
-                except Exception as e:
-                    self.stdout.write(self.style.WARNING(
-                        'Error while saving cover image %s:\n%s' % (
-                            tmp_cover_path, str(e))))
-                    tmp_cover_path = None
-
-            # Add subjects as tags
-            for subject in (subjects or []):
-                # workaround for ePubs with description as subject
-                if not subject or len(subject) > 80:
-                    break
-
-                subject_split = subject.replace('/', ',') \
-                    .replace(';', ',') \
-                    .replace(':', '') \
-                    .replace('\n', ',') \
-                    .replace(' ,', ',') \
-                    .replace(' ,', ',') \
-                    .split(',')
-                for tag in subject_split:
-                    if tag is not ' ':
-                        # The specs recommend using unicode for the tags, but
-                        # do not enforce it. As a result, tags in exotic
-                        # encodings might cause taggit to crash while trying to
-                        # create the slug.
-                        self.stdout.write(self.style.NOTICE(
-                            'Found subject (tag): "%s"' % tag))
-                        try:
-                            book.tags.add(tag.lower().strip())
-                        except:
-                            try:
-                                book.tags.add(
-                                    tag.encode('utf-8').lower().strip())
-                            except:
-                                # No further efforts are made, and the tag is
-                                # not added.
-                                self.stdout.write(self.style.WARNING(
-                                    'Tag could not be added'))
+        existing.add(book.file_sha256sum)
+
+        for author in authors:
+            out.write(self.style.NOTICE('Found author: "%s"' % author))
+        for publisher in publishers:
+            out.write(self.style.NOTICE('Found publisher: "%s"' % publisher))
+        tags = split_subjects(parsed['subjects'])
+        for tag in tags:
+            out.write(self.style.NOTICE('Found subject (tag): "%s"' % tag))
+
+        return importer.BookEntry(book, parsed['cover'], authors, publishers,
+                                  tags)
+
+    def import_epub(self, parsed, use_symlink=False, out=None):
+        """Save the EPUB parsed by `parse_epub()` as a batch of a single book,
+        reporting the result. The changes are done in a savepoint, so a
+        failed file does not affect the rest of the batch. The temporary
+        files are not deleted.
+
+        :param parsed: dict returned by `parse_epub()`
+        :param use_symlink: symlink ePub to FileField or process normally
+        :param out: `OutputWrapper` for the messages (defaults to stdout)
+        :return: success result
+        """
+        out = out or self.stdout
+        try:
+            with transaction.atomic():
+                status, languages, existing = self.lookup_batch([parsed])
+                entry = self.prepare_book(parsed, use_symlink, status,
+                                          languages, existing, out)
+                if entry is None:
+                    return False
+                importer.save_books([entry])
+                return True
         except Exception as e:
-            # Delete .epub file in media/, if `book` is a valid object.
-            try:
-                if os.path.isfile(book.book_file.path):
-                    os.remove(book.book_file.path)
-            except:
-                pass
+            out.write(self.style.ERROR(
+                'Unhandled exception while importing:\n%s' % e))
+            return False
 
-            if isinstance(e, ValidationError) and 'already exists' in str(e):
-                self.stdout.write(self.style.WARNING(
-                    'The book (%s) was not saved because the file already '
-                    'exists in the database:\n%s' % (filename, str(e))))
-                return False
-            else:
-                # TODO: check for possible risen exceptions at a finer grain.
-                raise e
-        finally:
-            # Delete the temporary files.
-            epub.close()
-            if tmp_cover_path:
-                os.remove(tmp_cover_path)
+    def process_epub(self, filename, use_symlink=False):
+        """Import a single EPUB from `filename`, creating a new `Book` based
+        on the information parsed from the epub.
 
-        return True
+        :param filename: ePub file to process
+        :param use_symlink: symlink ePub to FileField or process normally
+        :return: success result
+        """
+        parsed = parse_epub(filename,
+                            None if use_symlink else get_staging_dir())
+        try:
+            if parsed['output']:
+                self.stdout.write(parsed['output'], ending='')
+            return self.import_epub(parsed, use_symlink)
+        finally:
+            delete_temporary(parsed)
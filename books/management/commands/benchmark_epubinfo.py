@@ -0,0 +1,173 @@
+from __future__ import unicode_literals
+
+from io import BytesIO
+import os
+import time
+import zipfile
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from lxml import etree
+
+from books.epub import Epub
+from books.epubinfo import EpubInfo
+
+SAMPLES_DIR = os.path.join(settings.BASE_DIR, 'resources/epubsamples')
+
+OPF = '{http://www.idpf.org/2007/opf}'
+DC = '{http://purl.org/dc/elements/1.1/}'
+
+# Fields of EpubInfo compared between the legacy parsing and the current one.
+FIELDS = ('title', 'creators', 'publishers', 'date', 'subjects', 'source',
+          'rights', 'identifier', 'language', 'summary', 'cover_image')
+
+
+def legacy_epub_info(opf_data):
+    """The parsing of the OPF used before the single pass `EpubInfo`, kept as
+    the baseline of the benchmark: the OPF was parsed once for finding the
+    NCX and again by `EpubInfo`, which looked up each field with a separate
+    XPath query and walked the whole tree up to three times for the cover.
+    Returns a dict with the `FIELDS` and the NCX href.
+    """
+    # Epub._get_ncx()
+    root = etree.fromstring(opf_data)
+    toc_id = root.find('.//%sspine' % OPF).get('toc')
+    ncx = None
+    for element in root.iterfind('.//%sitem' % OPF):
+        if element.get('id') == toc_id:
+            ncx = element.get('href')
+
+    # EpubInfo.__init__()
+    tree = etree.ElementTree(etree.fromstring(opf_data))
+    metadata = tree.getroot().find('%smetadata' % OPF)
+
+    def text(name):
+        element = metadata.find('.//%s%s' % (DC, name))
+        return element.text if element is not None else None
+
+    def texts(name):
+        return [e.text for e in metadata.iterfind('.//%s%s' % (DC, name))]
+
+    info = dict((name, text(name)) for name in
+                ('title', 'date', 'source', 'rights', 'language'))
+    info.update(creators=texts('creator'), publishers=texts('publisher'),
+                subjects=texts('subject'), summary=text('description'))
+    element = metadata.find('.//%sidentifier' % DC)
+    info['identifier'] = ({'id': element.get('id'), 'value': element.text}
+                          if element is not None else None)
+
+    cover = None
+    for node in tree.iter('%sreference' % OPF):
+        if (node.get('type') in ('cover', 'title-page', 'tp') or
+                node.get('title') == 'Cover'):
+            cover = node.get('href').split('#')[0]
+            break
+    if cover is None:
+        for node in tree.iter('%sitem' % OPF):
+            if (node.get('id') in ('cover-image', 'cover') or
+                    node.get('properties') == 'cover-image'):
+                cover = node.get('href')
+                break
+    meta_cover = None
+    for element in metadata.iterfind('%smeta' % OPF):
+        if element.get('name') == 'cover':
+            meta_cover = element.get('content')
+    if meta_cover:
+        for node in tree.iter('%sitem' % OPF):
+            if node.get('id') == meta_cover:
+                cover = node.get('href')
+                break
+        if cover is None:
+            cover = meta_cover
+    info['cover_image'] = cover or None
+    return info, ncx
+
+
+def current_epub_info(opf_data):
+    """Return the same values as `legacy_epub_info()`, using `EpubInfo`."""
+    info = EpubInfo(BytesIO(opf_data))
+    item = info.get_item(info.toc_id)
+    return (dict((name, getattr(info, name)) for name in FIELDS),
+            item.get('href') if item is not None else None)
+
+
+def read_opf(filename):
+    """Return the contents of the OPF file of the EPUB `filename`."""
+    epub = Epub(filename)
+    try:
+        return epub._zobject.read(epub._opf_path)
+    finally:
+        epub.close()
+
+
+class Command(BaseCommand):
+    help = ('Benchmark the parsing of the OPF files of EPUBs (by default, the '
+            'sample EPUBs of the tests), comparing the legacy parsing with '
+            'the single pass EpubInfo.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'item',
+            nargs='*',
+            default=[SAMPLES_DIR],
+            help='EPUB files, or directories containing them.')
+        parser.add_argument(
+            '--repeat', '-r',
+            type=int,
+            dest='repeat',
+            default=200,
+            help='Number of times each OPF is parsed (the best time is '
+                 'used).')
+
+    def get_opfs(self, items):
+        opfs = []
+        for item in items:
+            if os.path.isdir(item):
+                filenames = sorted(os.path.join(item, name) for name in
+                                   os.listdir(item) if name.endswith('.epub'))
+            else:
+                filenames = [item]
+            for filename in filenames:
+                try:
+                    opfs.append((os.path.basename(filename),
+                                 read_opf(filename)))
+                except (zipfile.BadZipfile, KeyError, AttributeError,
+                        etree.LxmlError):
+                    # Not an EPUB, or without an OPF.
+                    self.stdout.write('Skipping %s' % filename)
+        return opfs
+
+    def measure(self, func, opf_data, repeat):
+        """Return the best time of parsing `opf_data` with `func`."""
+        best = None
+        for _ in range(repeat):
+            start = time.time()
+            func(opf_data)
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    def handle(self, *args, **options):
+        row = '{:<36} {:>8} {:>12} {:>12} {:>8}'
+        self.stdout.write(row.format('epub', 'opf', 'before', 'after',
+                                     'speedup'))
+        total_before = total_after = 0
+        for name, opf_data in self.get_opfs(options['item']):
+            if legacy_epub_info(opf_data) != current_epub_info(opf_data):
+                self.stdout.write(self.style.ERROR(
+                    '%s: the results differ' % name))
+            before = self.measure(legacy_epub_info, opf_data,
+                                  options['repeat'])
+            after = self.measure(current_epub_info, opf_data,
+                                 options['repeat'])
+            total_before += before
+            total_after += after
+            self.stdout.write(row.format(
+                name[:36], '%.1f KB' % (len(opf_data) / 1024.0),
+                '%.3f ms' % (before * 1000), '%.3f ms' % (after * 1000),
+                '%.1fx' % (before / after)))
+        if total_after:
+            self.stdout.write(row.format(
+                'total', '', '%.3f ms' % (total_before * 1000),
+                '%.3f ms' % (total_after * 1000),
+                '%.1fx' % (total_before / total_after)))
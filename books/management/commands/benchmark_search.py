@@ -0,0 +1,193 @@
+from __future__ import unicode_literals
+
+import random
+import time
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import Q
+from django.test.utils import CaptureQueriesContext
+
+from books import models
+from books import search_index
+from books.search import advanced_search
+
+# Queries used for the benchmark, in the syntax supported by both the legacy
+# and the current search. {w*} are replaced by words of the catalog.
+QUERIES = ['{w0}',
+           '{w0} AND {w1}',
+           'title:{w0}',
+           'author:{w2} AND title:{w0}',
+           'author:{w2} AND publisher:{w3} AND {w1}',
+           'publisher:{w3} AND summary:{w1} AND {w0}']
+
+
+def legacy_advanced_search(queryset, searchterms):
+    """The `advanced_search()` used before the search index, kept as the
+    baseline of the benchmark.
+    """
+    q_objects = []
+    results = queryset
+
+    subterms = searchterms.split('AND')
+    for subterm in subterms:
+        if ':' in subterm:
+            key, word = subterm.split(':')
+            key = key.strip()
+            if key == 'title':
+                q_objects.append(Q(title__icontains=word))
+            if key == 'author':
+                q_objects.append(Q(authors__name__icontains=word))
+            if key == 'publisher':
+                q_objects.append(Q(publishers__name__icontains=word))
+            if key == 'identifier':
+                q_objects.append(Q(dc_identifier__icontains=word))
+            if key == 'summary':
+                q_objects.append(Q(summary__icontains=word))
+        else:
+            word = subterm
+            results = results.filter(Q(title__icontains=word) |
+                                     Q(authors__name__icontains=word) |
+                                     Q(publishers__name__icontains=word) |
+                                     Q(dc_identifier__icontains=word) |
+                                     Q(summary__icontains=word)).distinct()
+
+    for q_object in q_objects:
+        results = results.filter(q_object)
+    return results
+
+
+class Command(BaseCommand):
+    help = ('Benchmark the book search on a generated catalog, comparing the '
+            'number of joins and the latency of the legacy search with the '
+            'search index. A temporary test database is used.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--books', '-b',
+            type=int,
+            dest='books',
+            default=100000,
+            help='Number of books of the generated catalog.')
+        parser.add_argument(
+            '--repeat', '-r',
+            type=int,
+            dest='repeat',
+            default=3,
+            help='Number of times each query is run (the best time is used).')
+        parser.add_argument(
+            '--backend',
+            choices=['fts', 'inverted'],
+            dest='backend',
+            default='fts',
+            help='Search backend to benchmark.')
+
+    def handle(self, *args, **options):
+        old_name = connection.creation.create_test_db(verbosity=0,
+                                                      autoclobber=True,
+                                                      serialize=False)
+        try:
+            call_command('loaddata', 'initial_data.json', verbosity=0)
+            if options['backend'] == 'fts':
+                backend = search_index.SQLiteFTSBackend()
+            else:
+                backend = search_index.InvertedIndexBackend()
+            if not backend.is_available():
+                self.stderr.write('Backend not available on this database.')
+                return
+            search_index._backend = backend
+
+            self.stdout.write('Generating %s books ...' % options['books'])
+            words = self.generate_catalog(options['books'])
+            self.stdout.write('Building the search index (%s) ...' %
+                              type(backend).__name__)
+            backend.rebuild()
+
+            self.run_queries(words, options['repeat'])
+        finally:
+            search_index._backend = None
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def generate_catalog(self, count, chunk_size=5000):
+        """Populate the database with `count` random books, with authors and
+        publishers, returning the sample words used on the queries.
+        """
+        rnd = random.Random(42)
+        vocabulary = ['%s%s' % (rnd.choice('bcdfghjklmnprstvz'),
+                                ''.join(rnd.choice('aeiourstln')
+                                        for _ in range(rnd.randint(3, 8))))
+                      for _ in range(5000)]
+
+        def text(n):
+            return ' '.join(rnd.choice(vocabulary) for _ in range(n))
+
+        models.Author.objects.bulk_create(
+            [models.Author(name='%s %d' % (text(2), i))
+             for i in range(max(count // 10, 1))])
+        models.Publisher.objects.bulk_create(
+            [models.Publisher(name='%s %d' % (text(1), i))
+             for i in range(500)])
+        # bulk_create() does not set the pks on all databases.
+        author_pks = list(models.Author.objects.values_list('pk', flat=True))
+        publisher_pks = list(models.Publisher.objects.
+                             values_list('pk', flat=True))
+
+        for start in range(0, count, chunk_size):
+            size = min(chunk_size, count - start)
+            models.Book.objects.bulk_create(
+                [models.Book(title=text(rnd.randint(1, 6)),
+                             summary=text(rnd.randint(10, 40)),
+                             book_file='books/%d.epub' % (start + i),
+                             file_sha256sum='%064x' % (start + i),
+                             a_status_id=1)
+                 for i in range(size)])
+        book_pks = list(models.Book.objects.values_list('pk', flat=True))
+
+        for start in range(0, len(book_pks), chunk_size):
+            chunk = book_pks[start:start + chunk_size]
+            models.Book.authors.through.objects.bulk_create(
+                [models.Book.authors.through(book_id=pk,
+                                             author_id=rnd.choice(author_pks))
+                 for pk in chunk])
+            models.Book.publishers.through.objects.bulk_create(
+                [models.Book.publishers.through(
+                    book_id=pk, publisher_id=rnd.choice(publisher_pks))
+                 for pk in chunk])
+
+        book = models.Book.objects.prefetch_related(
+            'authors', 'publishers').order_by('?')[0]
+        return {'w0': book.title.split()[0],
+                'w1': book.summary.split()[0],
+                'w2': book.authors.all()[0].name.split()[0],
+                'w3': book.publishers.all()[0].name.split()[0]}
+
+    def measure(self, func, query, repeat):
+        """Run the search like `_book_list` does (a COUNT and the first page),
+        returning the best time, the number of joins and of subqueries.
+        """
+        best = None
+        for _ in range(repeat):
+            with CaptureQueriesContext(connection) as ctx:
+                start = time.time()
+                queryset = func(models.Book.objects.all(), query)
+                queryset.count()
+                list(queryset[:50])
+                elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        sql = ' '.join(q['sql'].upper() for q in ctx.captured_queries[-2:])
+        return best, sql.count(' JOIN '), sql.count('(SELECT ')
+
+    def run_queries(self, words, repeat):
+        # Joins and subqueries are counted on both the COUNT and the page.
+        row = '{:<48} {:>6} {:>6} {:>10} {:>6} {:>6} {:>10}'
+        self.stdout.write(row.format('query', 'joins', 'subq', 'before',
+                                     'joins', 'subq', 'after'))
+        for template in QUERIES:
+            query = template.format(**words)
+            before = self.measure(legacy_advanced_search, query, repeat)
+            after = self.measure(advanced_search, query, repeat)
+            self.stdout.write(row.format(
+                query[:48],
+                before[1], before[2], '%.1f ms' % (before[0] * 1000),
+                after[1], after[2], '%.1f ms' % (after[0] * 1000)))
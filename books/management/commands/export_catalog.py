@@ -0,0 +1,67 @@
+from __future__ import unicode_literals
+
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from books import export
+
+
+class Command(BaseCommand):
+    help = ('Export the whole catalog as a single OPDS acquisition feed or '
+            'as JSON lines, for mirrors and offline copies. The output is '
+            'gzip-compressed if its name ends with ".gz".')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'output',
+            help='Output file ("-" for the standard output).')
+        parser.add_argument(
+            '--format', '-f',
+            choices=sorted(export.FORMATS),
+            dest='format',
+            default='atom',
+            help='Export format (default: atom).')
+        parser.add_argument(
+            '--since', '-s',
+            dest='since',
+            default=None,
+            help=('Export only the books updated after this ISO 8601 date '
+                  'or datetime.'))
+        parser.add_argument(
+            '--all',
+            action='store_true',
+            dest='all',
+            default=False,
+            help='Export also the unpublished books.')
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            dest='chunk_size',
+            default=export.CHUNK_SIZE,
+            help='Number of books read from the database at a time.')
+
+    def handle(self, *args, **options):
+        since = None
+        if options['since']:
+            try:
+                since = export.parse_since(options['since'])
+            except ValueError as e:
+                raise CommandError(e)
+
+        books = export.export_queryset(since, not options['all'])
+        chunks = export.iter_export(books, options['format'],
+                                    options['chunk_size'])
+        if options['output'].endswith('.gz'):
+            chunks = export.iter_gzip(chunks)
+
+        if options['output'] == '-':
+            output = sys.stdout
+        else:
+            output = open(options['output'], 'wb')
+        try:
+            for chunk in chunks:
+                output.write(chunk)
+        finally:
+            if output is not sys.stdout:
+                output.close()
@@ -0,0 +1,26 @@
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from books import downloads
+
+
+class Command(BaseCommand):
+    help = ('Add the downloads logged on DOWNLOADS_LOG to the books. The '
+            'server flushes the log periodically while it receives '
+            'downloads: this command can be run from cron for flushing the '
+            'last ones.')
+
+    def handle(self, *args, **options):
+        if not settings.DOWNLOADS_LOG:
+            raise CommandError('DOWNLOADS_LOG is not set: the downloads are '
+                               'added to the books immediately.')
+
+        count = downloads.flush()
+        if count is None:
+            self.stdout.write(self.style.WARNING(
+                'The log is being flushed by another process.'))
+        else:
+            self.stdout.write(self.style.HTTP_REDIRECT(
+                '{} downloads flushed.'.format(count)))
@@ -0,0 +1,35 @@
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+
+from books.models import Book
+from books.thumbnails import BATCH_SIZE, generate_thumbnails
+
+
+class Command(BaseCommand):
+    help = ('Generate the thumbnails of the book covers that do not have '
+            'them yet (ie. the books imported before the thumbnails were '
+            'generated on import), or of all of them with --all.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--all', '-a',
+            action='store_true',
+            dest='all',
+            default=False,
+            help='Generate the thumbnails of all the covers again.')
+
+    def handle(self, *args, **options):
+        books = Book.objects.exclude(cover_img='').exclude(cover_img=None).\
+            only('pk', 'cover_img', 'cover_thumbnails').order_by('pk')
+        pks = [book.pk for book in books.iterator() if options['all'] or
+               book.get_cover_thumbnails().get('source') !=
+               book.cover_img.name]
+
+        updated = 0
+        for i in range(0, len(pks), BATCH_SIZE):
+            updated += generate_thumbnails(pks[i:i + BATCH_SIZE])
+            self.stdout.write('{}/{} covers'.format(
+                min(i + BATCH_SIZE, len(pks)), len(pks)))
+        self.stdout.write(self.style.HTTP_REDIRECT(
+            'Thumbnails generated for {} covers.'.format(updated)))
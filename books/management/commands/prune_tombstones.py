@@ -0,0 +1,21 @@
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from books import changes
+
+
+class Command(BaseCommand):
+    help = ('Remove the tombstones of the books deleted more than '
+            'DELETED_BOOKS_RETENTION_DAYS ago, which are no longer listed on '
+            'the changes feed.')
+
+    def handle(self, *args, **options):
+        if settings.DELETED_BOOKS_RETENTION_DAYS is None:
+            raise CommandError('DELETED_BOOKS_RETENTION_DAYS is not set: the '
+                               'tombstones are kept forever.')
+
+        count = changes.prune_tombstones()
+        self.stdout.write(self.style.HTTP_REDIRECT(
+            '{} tombstones removed.'.format(count)))
@@ -0,0 +1,16 @@
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+
+from books import counters
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the counters of books by status from scratch.'
+
+    def handle(self, *args, **options):
+        counters.rebuild()
+        published, unpublished = counters.get_published_counts()
+        self.stdout.write(self.style.HTTP_REDIRECT(
+            'Counters rebuilt: {} published books, {} unpublished '
+            'books.'.format(published, unpublished)))
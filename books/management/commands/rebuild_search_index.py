@@ -0,0 +1,18 @@
+from __future__ import unicode_literals
+
+from django.core.management.base import BaseCommand
+
+from books import models
+from books.search_index import get_search_backend
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text search index from scratch.'
+
+    def handle(self, *args, **options):
+        backend = get_search_backend()
+        self.stdout.write('Rebuilding the search index (%s) for %s books ...' %
+                          (type(backend).__name__,
+                           models.Book.objects.count()))
+        backend.rebuild()
+        self.stdout.write(self.style.HTTP_REDIRECT('Search index rebuilt.'))
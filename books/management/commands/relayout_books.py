@@ -0,0 +1,118 @@
+from __future__ import unicode_literals
+
+import errno
+import os
+import shutil
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils.crypto import get_random_string
+
+from books import download_cache
+from books.models import Book
+from books.storage import content_address
+
+
+class Command(BaseCommand):
+    help = ('Move the book files to the content addressed layout, where the '
+            'files are named after their sha256 sum on sharded directories '
+            '(books/ab/cd/abcd...ef.epub). New files are only stored on this '
+            'layout if CONTENT_ADDRESSED_BOOKS is enabled.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run', '-n',
+            action='store_true',
+            dest='dry_run',
+            default=False,
+            help='Only show the files that would be moved.')
+
+    def handle(self, *args, **options):
+        if not settings.CONTENT_ADDRESSED_BOOKS:
+            self.stdout.write(self.style.WARNING(
+                'CONTENT_ADDRESSED_BOOKS is not enabled: the new books will '
+                'still be stored by their names.'))
+
+        storage = Book._meta.get_field('book_file').storage
+        counter = {'moved': 0, 'skipped': 0, 'failed': 0}
+        books = Book.objects.order_by('pk').values_list(
+            'pk', 'book_file', 'file_sha256sum')
+        for pk, name, sha256sum in books.iterator():
+            if not name:
+                counter['failed'] += 1
+                self.stdout.write(self.style.ERROR(
+                    'Book #%s has no file.' % pk))
+                continue
+            target = content_address(
+                'books', sha256sum, os.path.splitext(name)[1].lower() or
+                '.epub')
+            if name == target:
+                counter['skipped'] += 1
+                continue
+
+            self.stdout.write('%s -> %s' % (name, target))
+            if options['dry_run']:
+                counter['moved'] += 1
+                continue
+            try:
+                self.move(storage.path(name), storage.path(target))
+            except (IOError, OSError) as e:
+                counter['failed'] += 1
+                self.stdout.write(self.style.ERROR(
+                    'Book #%s could not be moved: %s' % (pk, e)))
+                continue
+
+            # The old name is only removed once the book points to the new
+            # one, so an interrupted run can be resumed. The update does not
+            # modify `a_updated`, as the book did not change for the clients.
+            Book.objects.filter(pk=pk).update(book_file=target)
+            download_cache.invalidate(pk)
+            storage.delete(name)
+            counter['moved'] += 1
+
+        self.stdout.write('{} files moved, {} already moved, {} failed.'.
+                          format(counter['moved'], counter['skipped'],
+                                 counter['failed']))
+
+    def move(self, src, dst):
+        """Make `dst` refer to the same file as `src` (recreating the symbolic
+        links), without removing `src`. `dst` is only created once complete.
+        """
+        if os.path.lexists(dst):
+            # Already created by an interrupted run, or a file with the same
+            # contents.
+            return
+        if not os.path.lexists(src):
+            raise IOError(errno.ENOENT, 'No such file', src)
+
+        directory = os.path.dirname(dst)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        if not os.path.islink(src):
+            try:
+                # A hard link does not copy the data.
+                os.link(src, dst)
+                return
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                    raise
+
+        tmp_path = os.path.join(directory, '.%s.tmp' % get_random_string())
+        try:
+            if os.path.islink(src):
+                target = os.readlink(src)
+                if not os.path.isabs(target):
+                    target = os.path.normpath(os.path.join(
+                        os.path.dirname(src), target))
+                os.symlink(target, tmp_path)
+            else:
+                shutil.copy2(src, tmp_path)
+            os.rename(tmp_path, dst)
+        finally:
+            if os.path.lexists(tmp_path):
+                os.remove(tmp_path)
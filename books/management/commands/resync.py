@@ -1,16 +1,43 @@
 from __future__ import unicode_literals
 
+from itertools import imap, islice
+import multiprocessing
 import os
 import sys
+import time
 
 from django.conf import settings
 from django.core.files import File
 from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
 
+from books import counters
+from books import importer
 from books import models
+from books import storage
+from books.profiling import Profile
 from books.storage import LinkableFile
 
-from addepub import get_epubs_paths
+from addepub import get_epubs_paths, write_profile
+
+
+def hash_epub(item):
+    """Return the sha256 sum of a file, so they can be hashed on the worker
+    processes of `resync --jobs`.
+
+    :param item: tuple (filename, sha256), where sha256 is the cached sum of
+    the file or None if it has to be hashed
+    :return: tuple (filename, sha256, error, seconds), where sha256 is None
+    and error is the error message if the file could not be read
+    """
+    filename, digest = item
+    start = time.time()
+    try:
+        if digest is None:
+            digest = storage.file_sha256(filename)
+        return filename, digest, None, time.time() - start
+    except (IOError, OSError) as e:
+        return filename, None, unicode(e), time.time() - start
 
 
 class Command(BaseCommand):
@@ -19,6 +46,11 @@ class Command(BaseCommand):
             "specified items if the database contains a Book that is "
             "considered a duplicate (having the same sha256 hash).")
 
+    # sha256 sums of the files, see `handle()`.
+    digests = None
+    # `books.profiling.Profile` of `--profile`, or None.
+    profile = None
+
     def add_arguments(self, parser):
         # Positional arguments
         parser.add_argument(
@@ -40,72 +72,206 @@ class Command(BaseCommand):
                   'the file), "original" (default, use the same as '
                   'the original Book is using).')
         )
+        parser.add_argument(
+            '--dry-run', '-n',
+            action='store_true',
+            dest='dry_run',
+            default=False,
+            help=('Hash the files and look for the books, without modifying '
+                  'them.'))
+        parser.add_argument(
+            '--profile',
+            nargs='?',
+            const='-',
+            dest='profile',
+            default=None,
+            help=('Report the duration of each stage of the resync and the '
+                  'throughput as JSON, on the given file or on the standard '
+                  'output.'))
+        parser.add_argument(
+            '--jobs', '-j',
+            type=int,
+            dest='jobs',
+            default=1,
+            help=('Number of processes used for hashing the files (default: '
+                  '1). The books are still updated by a single process.'))
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            dest='batch_size',
+            default=100,
+            help=('Number of files looked up and updated on each transaction '
+                  '(default: 100).'))
 
     def handle(self, *args, **options):
+        self.profile = Profile() if options['profile'] else None
+        start = time.time()
         epub_filenames = get_epubs_paths(options['item'],
                                          skip_original_path=False)
+        if self.profile:
+            self.profile.add('walk', time.time() - start)
 
         if not epub_filenames:
             raise CommandError('No .epub files found on the specified paths.')
 
+        # The files that did not change since they were imported are not
+        # hashed again.
+        self.digests = importer.get_digests(epub_filenames)
+
         # Keep track of some basic stats.
         counter = {'success': 0, 'fail': 0, 'not_found': 0}
         width = len(str(len(epub_filenames)))
         self.stdout.write('Importing %s items ...' % len(epub_filenames))
 
-        for i, filename in enumerate(epub_filenames):
-            self.stdout.write(self.style.HTTP_INFO(
-                '[{i: {width}}/{total: {width}}] {f}'.format(
-                    i=i+1,
-                    total=len(epub_filenames),
-                    width=width,
-                    f=filename)))
-
-            book, success = (None, False)
-            try:
-                book, success = self.process_epub(filename,
-                                                  options['replace_strategy'])
-            except Exception as e:
-                self.stdout.write(self.style.ERROR(
-                    'Unhandled exception while importing:\n%s' % e))
-
-            if book:
-                if success:
-                    counter['success'] = counter['success'] + 1
-                    self.stdout.write(self.style.HTTP_REDIRECT(
-                        'Book #%s (%s) modified (%s).' % (book.pk, book,
-                                                          book.original_path)))
-                else:
-                    counter['fail'] = counter['fail'] + 1
-                    self.stdout.write(self.style.NOTICE(
-                        'Book #%s (%s) NOT modified.' % (book.pk, book)))
-            else:
-                counter['not_found'] = counter['not_found'] + 1
-                self.stdout.write(self.style.NOTICE(
-                    'No match found.'))
-            self.stdout.write('')
+        # Hash the files on a pool of worker processes if requested, looking
+        # up and updating the books from this process in batches, in the same
+        # order. The cache is looked up beforehand, as the pool consumes the
+        # items from another thread.
+        items = [(filename, self.cached_sha256(filename))
+                 for filename in epub_filenames]
+        pool = None
+        if options['jobs'] > 1:
+            pool = multiprocessing.Pool(options['jobs'])
+            results = pool.imap(hash_epub, items, chunksize=8)
+        else:
+            results = imap(hash_epub, items)
+
+        try:
+            i = 0
+            while True:
+                batch = list(islice(results, options['batch_size']))
+                if not batch:
+                    break
+                outcomes = self.process_batch(batch,
+                                              options['replace_strategy'],
+                                              options['dry_run'])
+                for (filename, _, _, _), (book, success, error) in zip(
+                        batch, outcomes):
+                    i += 1
+                    self.report(i, len(epub_filenames), width, filename, book,
+                                success, error, counter, options['dry_run'])
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
 
         self.stdout.write('{} books updated, {} books failed to update, '
                           '{} items not mached.'.format(counter['success'],
                                                         counter['fail'],
                                                         counter['not_found']))
 
-    def process_epub(self, filename, replace_strategy='original'):
-        """Parse a single EPUB from `filename`, updating `Book` if `filename`
-        already exists on the database:
+        if not options['dry_run']:
+            # The counters are updated on each save, but a failed import can
+            # leave them out of sync: recompute them once at the end.
+            counters.rebuild()
+
+        if self.profile:
+            write_profile(self.profile, options['profile'], self.stdout,
+                          command='resync', dry_run=options['dry_run'],
+                          jobs=options['jobs'],
+                          batch_size=options['batch_size'],
+                          replace_strategy=options['replace_strategy'])
+
+    def cached_sha256(self, filename):
+        """Return the cached sha256 sum of `filename`, or None if it has to
+        be hashed (or can not be read).
+        """
+        try:
+            return self.digests.get(filename)
+        except OSError:
+            return None
+
+    def report(self, i, total, width, filename, book, success, error,
+               counter, dry_run=False):
+        """Print the result of the resync of a file, updating `counter`."""
+        self.stdout.write(self.style.HTTP_INFO(
+            '[{i: {width}}/{total: {width}}] {f}'.format(
+                i=i,
+                total=total,
+                width=width,
+                f=filename)))
+        if error:
+            self.stdout.write(self.style.ERROR(
+                'Unhandled exception while importing:\n%s' % error))
+
+        if book:
+            if success and dry_run:
+                counter['success'] = counter['success'] + 1
+                self.stdout.write(self.style.HTTP_REDIRECT(
+                    'Book #%s (%s) would be modified (%s).' % (
+                        book.pk, book, filename)))
+            elif success:
+                counter['success'] = counter['success'] + 1
+                self.stdout.write(self.style.HTTP_REDIRECT(
+                    'Book #%s (%s) modified (%s).' % (book.pk, book,
+                                                      book.original_path)))
+            else:
+                counter['fail'] = counter['fail'] + 1
+                self.stdout.write(self.style.NOTICE(
+                    'Book #%s (%s) NOT modified.' % (book.pk, book)))
+        else:
+            counter['not_found'] = counter['not_found'] + 1
+            self.stdout.write(self.style.NOTICE(
+                'No match found.'))
+        self.stdout.write('')
+
+    def process_batch(self, batch, replace_strategy='original',
+                      dry_run=False):
+        """Look up the books of a batch of files hashed by `hash_epub()` with
+        a single query, and update them on a single transaction (each book
+        on its own savepoint, so a failure does not affect the others).
+
+        :param batch: list of tuples returned by `hash_epub()`
+        :param replace_strategy: see `update_book()`
+        :param dry_run: only look up the books, without updating them
+        :return: list of tuples (Book, success, error), one for each file,
+        where Book is None if not found
+        """
+        start = time.time()
+        for filename, digest, _, seconds in batch:
+            if digest is not None:
+                self.digests.add(filename, digest)
+            if self.profile:
+                self.profile.add('hash', seconds)
+                self.profile.count('files')
+                if digest is not None:
+                    self.profile.count('bytes', os.path.getsize(filename))
+
+        books = dict(
+            (book.file_sha256sum, book) for book in models.Book.objects.filter(
+                file_sha256sum__in=set(digest for _, digest, _, _ in batch
+                                       if digest is not None)))
+        outcomes = []
+        with transaction.atomic():
+            for filename, digest, error, _ in batch:
+                book = books.get(digest)
+                if error or book is None or dry_run:
+                    outcomes.append((book, book is not None, error))
+                    continue
+                try:
+                    with transaction.atomic():
+                        outcomes.append((self.update_book(
+                            book, filename, replace_strategy), True, None))
+                except Exception as e:
+                    outcomes.append((book, False, unicode(e)))
+        if self.profile:
+            self.profile.add('db', time.time() - start)
+        return outcomes
+
+    def update_book(self, book, filename, replace_strategy='original'):
+        """Update `book` to point to the file `filename`, with the same
+        contents:
             - the `original_path` is updated to point to `filename`.
             - if `book_file` is a symlink, the old symlink is deleted and a new
             one pointing at `filename` is created.
 
-        Returns a tuple (Book, success), where Book will be None if not found.
-        """
-        # Check the sha256sum and try to find the Book.
-        file_sha256sum = models.sha256_sum(File(open(filename)))
-        try:
-            book = models.Book.objects.get(file_sha256sum=file_sha256sum)
-        except models.Book.DoesNotExist:
-            return None, False
+        `replace_strategy` is one of:
+            - 'always-link': always replace the file with a symlink.
+            - 'always-copy': replace the symlinks with a copy of the file.
+            - 'original': replace the symlinks with a new symlink.
 
+        Returns the Book.
+        """
         # Prepare the changes.
         info_dict = {'original_path': filename}
         if replace_strategy == 'always-link':
@@ -137,11 +303,8 @@ class Command(BaseCommand):
                                     save=False)
             book.original_path = info_dict['original_path']
             book.save()
-            book.refresh_from_db()
 
-            return book, True
+            return book
         except Exception as e:
             # TODO: check for possible risen exceptions at a finer grain.
             raise e
-
-        return book, False
@@ -0,0 +1,136 @@
+from __future__ import unicode_literals
+
+import logging
+import os
+import sys
+import time
+
+from django.core.management.base import CommandError
+from django.db import close_old_connections
+
+from books import importer
+from books.watcher import Debouncer, PollingWatcher, get_watcher
+
+from addepub import (Command as AddEpubCommand, exclude_imported_paths,
+                     get_epubs_paths)
+
+logger = logging.getLogger(__name__)
+
+
+class Command(AddEpubCommand):
+    help = ('Watch directories for new ePubs, importing them into the '
+            'database as soon as they are completely written.')
+
+    def add_arguments(self, parser):
+        # Positional arguments.
+        parser.add_argument(
+            'item', nargs='+',
+            type=lambda s: s.decode(sys.getfilesystemencoding()),
+            help='A directory to watch (recursively) for .epub files.')
+
+        # Named (optional) arguments.
+        parser.add_argument(
+            '--link', '-l',
+            action='store_true',
+            dest='use_symlink',
+            default=False,
+            help='Use symbolic links instead of copying the files.')
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            dest='batch_size',
+            default=10,
+            help=('Number of files saved to the database on each transaction '
+                  '(default: 10).'))
+        parser.add_argument(
+            '--settle',
+            type=float,
+            dest='settle',
+            default=2.0,
+            help=('Seconds a file must stay unchanged before being imported, '
+                  'so partially written files are skipped (default: 2).'))
+        parser.add_argument(
+            '--poll',
+            action='store_true',
+            dest='poll',
+            default=False,
+            help=('Walk the directories periodically instead of using '
+                  'inotify (which is used by default if available).'))
+        parser.add_argument(
+            '--interval',
+            type=float,
+            dest='interval',
+            default=5.0,
+            help='Seconds between the walks when polling (default: 5).')
+
+    def handle(self, *args, **options):
+        for path in options['item']:
+            if not os.path.isdir(path):
+                raise CommandError('%s is not a directory.' % path)
+
+        watcher = get_watcher(options['item'], options['poll'],
+                              options['interval'])
+        debouncer = Debouncer(options['settle'])
+        self.stdout.write('Watching %s (%s) ...' % (
+            ', '.join(options['item']),
+            'polling' if isinstance(watcher, PollingWatcher) else 'inotify'))
+
+        # Import the files added while the command was not running. As the
+        # watcher was started before, no file is missed.
+        debouncer.add(get_epubs_paths(options['item']))
+
+        try:
+            while True:
+                # Block until there are changes, or until the pending files
+                # may have settled.
+                timeout = options['settle'] if len(debouncer) else None
+                debouncer.add(watcher.changes(timeout))
+                self.import_settled(debouncer, options)
+        except KeyboardInterrupt:
+            self.stdout.write('Stopped.')
+        finally:
+            watcher.close()
+
+    def import_settled(self, debouncer, options):
+        """Import the files of `debouncer` that are ready. If the import fails
+        (ie. the database is locked by the server), the error is logged and
+        the files are queued again, so they are retried once they settle
+        again instead of stopping the command.
+        """
+        filenames = debouncer.ready()
+        try:
+            self.import_ready(filenames, options)
+        except Exception:
+            logger.exception('Error while importing %s files, they will be '
+                             'retried', len(filenames))
+            debouncer.add(filenames)
+        finally:
+            # Discard the connection if it is broken or too old, as the
+            # server does between requests.
+            close_old_connections()
+
+    def import_ready(self, filenames, options):
+        """Import the settled `filenames` that are not on the manifest with
+        the same signature, and are not the original file of an existing
+        book (see `exclude_imported_paths()`).
+        """
+        manifest = importer.get_manifest(filenames)
+        changed = []
+        for filename in filenames:
+            try:
+                if manifest.get(filename) != \
+                        importer.file_signature(filename):
+                    changed.append(filename)
+            except OSError:
+                # Removed after settling.
+                pass
+        changed = exclude_imported_paths(changed, manifest)
+        if not changed:
+            return
+
+        self.stdout.write('[%s] Importing %s items ...' % (
+            time.strftime('%Y-%m-%d %H:%M:%S'), len(changed)))
+        counter = self.import_files(changed, options['use_symlink'],
+                                    options['batch_size'])
+        self.stdout.write('{} files imported, {} files not imported.'.format(
+            counter['success'], counter['fail']))
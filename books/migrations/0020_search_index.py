@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.4 on 2026-10-17 20:29
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+# The SQL of `books.search_index.SQLiteFTSBackend` when this migration was
+# written, so later changes of the backend do not change the migration.
+FTS_CREATE_SQL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS books_book_fts USING fts5("
+    "title, authors, publishers, identifier, summary, "
+    "tokenize='unicode61', prefix='2 3')")
+FTS_INSERT_SQL = (
+    "INSERT INTO books_book_fts(rowid, title, authors, publishers, "
+    "identifier, summary) "
+    "SELECT b.id, b.title, "
+    "(SELECT group_concat(t.name, ' ') FROM books_author t "
+    "INNER JOIN books_book_authors m ON m.author_id = t.id "
+    "WHERE m.book_id = b.id), "
+    "(SELECT group_concat(t.name, ' ') FROM books_publisher t "
+    "INNER JOIN books_book_publishers m ON m.publisher_id = t.id "
+    "WHERE m.book_id = b.id), "
+    "b.dc_identifier, b.summary FROM books_book b")
+FTS_DROP_SQL = 'DROP TABLE IF EXISTS books_book_fts'
+
+
+def create_fts_table(apps, schema_editor):
+    """Create and populate the FTS5 table used by `SQLiteFTSBackend`. It is
+    skipped if the database is not SQLite, or does not support FTS5, in which
+    case the `InvertedIndexBackend` will be used.
+    """
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    try:
+        schema_editor.execute(FTS_CREATE_SQL)
+    except Exception:
+        return
+    schema_editor.execute(FTS_INSERT_SQL)
+
+
+def drop_fts_table(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute(FTS_DROP_SQL)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0019_auto_20160318_1222'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SearchTerm',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('field', models.CharField(max_length=16)),
+                ('term', models.CharField(max_length=64)),
+                ('weight', models.FloatField(default=1.0)),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_terms', to='books.Book')),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='searchterm',
+            index_together=set([('term', 'field')]),
+        ),
+        migrations.RunPython(create_fts_table, drop_fts_table),
+    ]
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.4 on 2026-10-17 20:37
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import Count
+
+
+def populate_counters(apps, schema_editor):
+    Book = apps.get_model('books', 'Book')
+    Status = apps.get_model('books', 'Status')
+    StatusCounter = apps.get_model('books', 'StatusCounter')
+    counts = dict(Book.objects.order_by().values_list('a_status_id').
+                  annotate(Count('pk')))
+    StatusCounter.objects.bulk_create(
+        [StatusCounter(status_id=pk, count=counts.get(pk, 0))
+         for pk in Status.objects.values_list('pk', flat=True)])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0020_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StatusCounter',
+            fields=[
+                ('status', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='counter', serialize=False, to='books.Status')),
+                ('count', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(populate_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.4 on 2026-10-17 20:40
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0021_status_counter'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='book',
+            index_together=set([('time_added', 'id'), ('title', 'id'), ('downloads', 'id')]),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.4 on 2026-10-17 20:50
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0023_a_updated_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeletedBook',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('a_id', models.CharField(max_length=36, verbose_name=b'atom:id')),
+                ('deleted_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='book',
+            index_together=set([('time_added', 'id'), ('title', 'id'), ('a_updated', 'id'), ('downloads', 'id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='deletedbook',
+            index_together=set([('deleted_at', 'id')]),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.4 on 2026-10-17 21:14
+from __future__ import unicode_literals
+
+import books.models
+import books.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0025_imported_file'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='book',
+            name='book_file',
+            field=models.FileField(storage=books.storage.LinkOrFileSystemStorage(), upload_to=books.models.book_file_path),
+        ),
+    ]
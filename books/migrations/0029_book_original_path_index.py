@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.4 on 2026-10-17 22:08
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0028_catalog_version'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='book',
+            name='original_path',
+            field=models.CharField(db_index=True, max_length=1016, verbose_name='file'),
+        ),
+    ]
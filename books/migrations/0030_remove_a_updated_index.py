@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.4 on 2026-10-17 22:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('books', '0029_book_original_path_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='book',
+            name='a_updated',
+            field=models.DateTimeField(auto_now=True, verbose_name='atom:updated'),
+        ),
+    ]
@@ -16,7 +16,10 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
 from hashlib import sha256
+import json
+import os
 
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.db import models
 from django.db.models.signals import post_delete
@@ -26,7 +29,7 @@ from django.utils.translation import ugettext_lazy as _
 from taggit.managers import TaggableManager
 
 from langlist import langs_by_code
-from storage import LinkOrFileSystemStorage
+from storage import LinkOrFileSystemStorage, content_address
 from uuidfield import UUIDField
 from books.utils import standardize_language
 
@@ -38,6 +41,30 @@ def sha256_sum(_file):  # used to generate sha256 sum of book files
     return s.hexdigest()
 
 
+def cover_thumbnail_key(alias, density=1, extension='jpg'):
+    """Return the key of the thumbnail `alias` of a cover for the pixel
+    `density` and the format `extension` on `Book.cover_thumbnails`: 'thumb',
+    'thumb@2x', 'thumb.webp', 'thumb@2x.webp'...
+    """
+    key = alias if density == 1 else '%s@%dx' % (alias, density)
+    return key if extension == 'jpg' else '%s.%s' % (key, extension)
+
+
+def book_file_path(instance, filename):
+    """Return the name of the file of the Book `instance` (`upload_to` of
+    `Book.book_file`): its content address if `CONTENT_ADDRESSED_BOOKS` is
+    enabled and its sha256 sum is known, or `filename` on the books
+    directory otherwise.
+    """
+    if settings.CONTENT_ADDRESSED_BOOKS and instance.file_sha256sum:
+        return content_address(
+            'books', instance.file_sha256sum,
+            os.path.splitext(filename)[1].lower() or '.epub')
+    storage = instance._meta.get_field('book_file').storage
+    return os.path.join('books', os.path.normpath(
+        storage.get_valid_name(os.path.basename(filename))))
+
+
 class ImageField(models.ImageField):
     """Custom ImageField that automatically deletes the old image when it is
     modified via a ModelForm (either by clicking on the "clear" checkbox, or
@@ -89,9 +116,11 @@ class LanguageManager(models.Manager):
             long_name = "%s%s" % (std.description[0],
                                   ' (%s)' % ', '.join(std.description[1:]) if
                                   len(std.description) > 1 else '')
-            language = self.create(code=std.code,
-                                   label=std.description[0],
-                                   long_name=long_name)
+            # The standardized code might be on DB already (ie. "en-us" for
+            # "en-US").
+            language, _ = self.get_or_create(
+                code=std.code, defaults={'label': std.description[0],
+                                         'long_name': long_name})
             return language
 
         raise ValueError('%s is not a valid language code' % code)
@@ -156,14 +185,21 @@ class Book(models.Model):
     """
 
     # File related fields.
-    book_file = models.FileField(upload_to='books', null=False,
+    book_file = models.FileField(upload_to=book_file_path, null=False,
                                  storage=LinkOrFileSystemStorage())
     # TODO: OS X 10.10 1016 chars? remove max_length entirely?
-    original_path = models.CharField(_('file'), max_length=1016)
+    original_path = models.CharField(_('file'), max_length=1016,
+                                     db_index=True)
     file_sha256sum = models.CharField(max_length=64, unique=True)
     mimetype = models.CharField(max_length=200, null=True)
     cover_img = ImageField(_('cover'), upload_to='covers',
                            blank=True, null=True)
+    # JSON object with the names of the thumbnails of the cover for each
+    # alias, density and format (see `cover_thumbnail_key()`), and the name
+    # and sha256 sum of the cover they were made from as 'source' and
+    # 'sha256' (see books.thumbnails).
+    cover_thumbnails = models.TextField(blank=True, default='',
+                                        editable=False)
 
     # General fields
     title = models.CharField(_('title'), max_length=255, null=False)
@@ -175,6 +211,7 @@ class Book(models.Model):
 
     # ePub atom fields
     a_id = UUIDField('atom:id')
+    # Indexed by the ('a_updated', 'id') index of `Meta.index_together`.
     a_updated = models.DateTimeField(_('atom:updated'), auto_now=True)
     a_category = models.CharField(_('atom:category'),
                                   max_length=200, blank=True, null=True)
@@ -201,6 +238,10 @@ class Book(models.Model):
         verbose_name_plural = _('books')
         ordering = ('-time_added',)
         get_latest_by = "time_added"
+        # Keys of the cursor pagination of the OPDS catalogs, and of the
+        # changes feed.
+        index_together = [('time_added', 'id'), ('title', 'id'),
+                          ('downloads', 'id'), ('a_updated', 'id')]
 
     def __unicode__(self):
         return self.title
@@ -212,6 +253,62 @@ class Book(models.Model):
     def get_authors(self):
         return ", ".join([str(p) for p in self.authors.all()])
 
+    def get_cover_thumbnails(self):
+        """Return the dict stored on `cover_thumbnails`."""
+        try:
+            return json.loads(self.cover_thumbnails or '{}')
+        except ValueError:
+            return {}
+
+    def _current_cover_thumbnails(self):
+        """Return the dict of the thumbnails, if they were made from the
+        current cover, or an empty one.
+        """
+        thumbnails = self.get_cover_thumbnails()
+        if not self.cover_img or \
+                thumbnails.get('source') != self.cover_img.name:
+            return {}
+        return thumbnails
+
+    def cover_thumbnail_url(self, alias):
+        """Return the URL of the thumbnail `alias` of the cover, or of the
+        cover itself if the thumbnail has not been generated yet, without
+        accessing the storage. Returns None if there is no cover.
+        """
+        if not self.cover_img:
+            return None
+        name = self._current_cover_thumbnails().get(alias)
+        if name:
+            return self.cover_img.storage.url(name)
+        return self.cover_img.url
+
+    def cover_thumbnail_srcset(self, alias, extension='jpg'):
+        """Return the `srcset` of the thumbnails `alias` of the cover in the
+        format `extension` for each of `settings.COVER_THUMBNAIL_DENSITIES`
+        (ie. 'a.jpg 1x, b.jpg 2x'), or '' if they have not been generated.
+        """
+        thumbnails = self._current_cover_thumbnails()
+        candidates = []
+        for density in settings.COVER_THUMBNAIL_DENSITIES:
+            name = thumbnails.get(
+                cover_thumbnail_key(alias, density, extension))
+            if name:
+                candidates.append('%s %dx' % (
+                    self.cover_img.storage.url(name), density))
+        return ', '.join(candidates)
+
+    def cover_thumbnail_sources(self, alias):
+        """Return the (type, srcset) of the thumbnails `alias` of the cover
+        generated in the formats of `settings.COVER_THUMBNAIL_FORMATS`, in
+        order of preference (ie. for the <source> elements of a <picture>).
+        """
+        sources = []
+        for extension in settings.COVER_THUMBNAIL_FORMATS:
+            srcset = self.cover_thumbnail_srcset(alias, extension)
+            if srcset:
+                sources.append(('image/%s' % extension, srcset))
+        return sources
+
     # def save(self, *args, **kwargs):
     #     import urllib2
     #     from django.core.files import File
@@ -226,14 +323,92 @@ class Book(models.Model):
     #         super(Book, self).save()
 
 
+class DeletedBook(models.Model):
+    """Tombstone of a deleted Book, used for announcing the deletion on the
+    changes feed (see `books.changes`).
+    """
+    a_id = models.CharField('atom:id', max_length=36)
+    deleted_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        index_together = [('deleted_at', 'id')]
+
+    def __unicode__(self):
+        return self.a_id
+
+
+class ImportedFile(models.Model):
+    """Manifest of the files imported by `addepub`, used for skipping the
+    files that have not changed since the last import (same size,
+    modification time and inode) without reading them. Each entry points to
+    the Book with the same contents, which is either the one created from the
+    file or an existing duplicate.
+    """
+    path = models.CharField(max_length=1016, unique=True)
+    size = models.BigIntegerField()
+    mtime = models.FloatField()
+    inode = models.BigIntegerField()
+    sha256 = models.CharField(max_length=64)
+    book = models.ForeignKey(Book, related_name='imported_files')
+
+    def __unicode__(self):
+        return self.path
+
+
+class StatusCounter(models.Model):
+    """Number of books with each `Status`, maintained by `books.counters` so
+    the totals can be read without a COUNT(*) over the books table.
+    """
+    status = models.OneToOneField(Status, primary_key=True,
+                                  related_name='counter')
+    count = models.IntegerField(default=0)
+
+    def __unicode__(self):
+        return u'%s: %s' % (self.status, self.count)
+
+
+class CatalogVersion(models.Model):
+    """Version stamp of the catalogs, replaced whenever they change (see
+    `books.feed_cache`). It is kept on the database, so the changes made by
+    any process (the import commands, the other server processes) are seen
+    by all of them. There is a single row.
+    """
+    version = models.CharField(max_length=32)
+    changed = models.DateTimeField()
+
+    def __unicode__(self):
+        return self.version
+
+
+class SearchTerm(models.Model):
+    """Posting of the inverted index used by the portable search backend
+    (`books.search_index.InvertedIndexBackend`). There is one row for each
+    (book, field, term) triple, `weight` being the number of occurrences of
+    the term on the field multiplied by the boost of the field.
+    """
+    book = models.ForeignKey(Book, related_name='search_terms')
+    field = models.CharField(max_length=16)
+    term = models.CharField(max_length=64)
+    weight = models.FloatField(default=1.0)
+
+    class Meta:
+        index_together = [('term', 'field')]
+
+    def __unicode__(self):
+        return u'%s:%s' % (self.field, self.term)
+
+
 @receiver(post_delete, sender=Book)
 def book_post_delete_handler(**kwargs):
     """
     Book model post_delete handler to ensure book and cover files are removed
-    with book. Check if optional cover exists to avoid error.
+    with book, and its tombstone recorded. Check if optional cover exists to
+    avoid error.
     """
     book = kwargs['instance']
 
+    DeletedBook.objects.create(a_id=book.a_id)
+
     book.book_file.delete(save=False)
 
     if book.cover_img:
@@ -18,12 +18,18 @@
 from cStringIO import StringIO
 
 from django.core.urlresolvers import reverse
+from django.db.models import Max
+from django.db.models.query import QuerySet
 
-from atom import AtomFeed
+from atom import AtomFeed, TOMBSTONES_NS
+from pagination import KeysetPage
 import mimetypes
 
 import datetime
 
+# Number of books fetched on each query while streaming a catalog.
+STREAM_CHUNK_SIZE = 100
+
 ATTRS = {}
 ATTRS[u'xmlns:dcterms'] = u'http://purl.org/dc/terms/'
 ATTRS[u'xmlns:opds'] = u'http://opds-spec.org/'
@@ -66,6 +72,21 @@ def page_qstring(request, page_number=None):
     return qstring
 
 
+def cursor_qstring(request, cursor):
+    """
+    Return the query string for the URL of the keyset page at `cursor`,
+    replacing the current cursor or page number.
+
+    :param request:
+    :param cursor:
+    :returns:
+    """
+    qdict = request.GET.copy()
+    qdict.pop('page', None)
+    qdict['cursor'] = cursor
+    return '?' + qdict.urlencode()
+
+
 def generate_nav_catalog(subsections, is_root=False):
     links = []
 
@@ -128,57 +149,163 @@ def generate_tags_catalog(tags):
     return generate_nav_catalog(tags_subsections)
 
 
-def generate_catalog(request, page_obj):
+def _catalog_feed(request, page_obj, updated=None):
     links = []
     links.append({'title': 'Home', 'type': 'application/atom+xml',
                   'rel': 'start',
                   'href': reverse('root_feed')})
 
-    if page_obj.has_previous():
-        previous_page = page_obj.previous_page_number()
+    previous_href = next_href = None
+    if isinstance(page_obj, KeysetPage):
+        # Keyset pages are linked with opaque cursors instead of page numbers.
+        previous_cursor = page_obj.previous_cursor()
+        next_cursor = page_obj.next_cursor()
+        if previous_cursor is not None:
+            previous_href = cursor_qstring(request, previous_cursor)
+        if next_cursor is not None:
+            next_href = cursor_qstring(request, next_cursor)
+    else:
+        if page_obj.has_previous():
+            previous_href = page_qstring(request,
+                                         page_obj.previous_page_number())
+        if page_obj.has_next():
+            next_href = page_qstring(request, page_obj.next_page_number())
+
+    if previous_href is not None:
         links.append(
             {'title': 'Previous results', 'type': 'application/atom+xml',
              'rel': 'previous',
-             'href': page_qstring(request, previous_page)})
+             'href': previous_href})
 
-    if page_obj.has_next():
-        next_page = page_obj.next_page_number()
+    if next_href is not None:
         links.append({'title': 'Next results', 'type': 'application/atom+xml',
                       'rel': 'next',
-                      'href': page_qstring(request, next_page)})
+                      'href': next_href})
 
-    feed = AtomFeed(title='Pathagar Bookserver OPDS feed',
+    return AtomFeed(title='Pathagar Bookserver OPDS feed',
                     atom_id='pathagar:full-catalog',
                     subtitle='OPDS catalog for the Pathagar book server',
-                    extra_attrs=ATTRS, hide_generator=True, links=links)
+                    updated=updated, extra_attrs=ATTRS, hide_generator=True,
+                    links=links)
+
+
+def book_item(book):
+    if book.cover_img:
+        linklist = [{'rel': 'http://opds-spec.org/acquisition',
+                     'href': reverse('book_download',
+                                     kwargs=dict(book_id=book.pk)),
+                     'type': __get_mimetype(book)},
+                    {'rel': 'http://opds-spec.org/cover', 'href':
+                        book.cover_img.url},
+                    {'rel': 'http://opds-spec.org/image/thumbnail',
+                     'href': book.cover_thumbnail_url('opds_thumb')}]
+    else:
+        linklist = [{'rel': 'http://opds-spec.org/acquisition',
+                     'href': reverse('book_download',
+                                     kwargs=dict(book_id=book.pk)),
+                     'type': __get_mimetype(book)}]
+
+    add_kwargs = {
+        'content': book.summary,
+        'links': linklist,
+        'authors': [{'name': a.name} for a in book.authors.all()],
+        'dc_publisher': [p.name for p in book.publishers.all()],
+        'dc_issued': book.dc_issued,
+        'dc_identifier': book.dc_identifier,
+    }
 
-    for book in page_obj.object_list:
-        if book.cover_img:
-            linklist = [{'rel': 'http://opds-spec.org/acquisition',
-                         'href': reverse('book_download',
-                                         kwargs=dict(book_id=book.pk)),
-                         'type': __get_mimetype(book)},
-                        {'rel': 'http://opds-spec.org/cover', 'href':
-                            book.cover_img.url}]
+    if book.dc_language is not None:
+        add_kwargs['dc_language'] = book.dc_language.code
+
+    return AtomFeed.make_item(book.a_id, book.title, book.a_updated,
+                              **add_kwargs)
+
+
+def generate_catalog(request, page_obj):
+    feed = _catalog_feed(request, page_obj)
+    feed.items = [book_item(book) for book in page_obj.object_list]
+
+    s = StringIO()
+    feed.write(s, 'UTF-8')
+    return s.getvalue()
+
+
+def iter_books(books, chunk_size=STREAM_CHUNK_SIZE):
+    """Iterate over `books`, fetching them (and their prefetched relations)
+    in chunks of `chunk_size` if it is a queryset, so only one chunk is kept
+    in memory at a time.
+
+    :param books: queryset or list of books
+    :param chunk_size: number of books fetched on each query
+    :returns: generator of books
+    """
+    if not isinstance(books, QuerySet):
+        for book in books:
+            yield book
+        return
+
+    start = 0
+    while True:
+        chunk = list(books[start:start + chunk_size])
+        for book in chunk:
+            yield book
+        if len(chunk) < chunk_size:
+            break
+        start += chunk_size
+
+
+def stream_catalog(request, page_obj, chunk_size=STREAM_CHUNK_SIZE):
+    """Return the same catalog as `generate_catalog()`, as a generator of
+    encoded chunks (one for each entry) suitable for a
+    `StreamingHttpResponse`. The books are fetched in chunks while the
+    catalog is written, so the memory used does not depend on the size of the
+    page.
+    """
+    books = page_obj.object_list
+    # The feed updated date is written before the entries.
+    if isinstance(books, QuerySet):
+        updated = books.aggregate(updated=Max('a_updated'))['updated']
+    else:
+        updated = max([book.a_updated for book in books] or [None])
+
+    feed = _catalog_feed(request, page_obj,
+                         updated or datetime.datetime.now())
+    items = (book_item(book) for book in iter_books(books, chunk_size))
+    return feed.iter_write('UTF-8', items)
+
+
+def generate_changes_catalog(request, changes):
+    """Return the changes feed, with an entry for each updated book and a
+    deleted entry (RFC 6721) for each removed book. The `next` link points to
+    the changes after the last one listed (or after the requested `since`,
+    if there are no changes), so it is included even if there are no more
+    changes yet, and clients can store it for polling later.
+
+    :param request:
+    :param changes: list of `books.changes.Change`
+    :returns:
+    """
+    links = [{'title': 'Home', 'type': 'application/atom+xml',
+              'rel': 'start', 'href': reverse('root_feed')}]
+    qdict = request.GET.copy()
+    if changes:
+        qdict['since'] = changes[-1].cursor()
+    links.append({'title': 'Next changes', 'type': 'application/atom+xml',
+                  'rel': 'next', 'href': '?' + qdict.urlencode()})
+
+    extra_attrs = dict(ATTRS)
+    extra_attrs[u'xmlns:at'] = TOMBSTONES_NS
+    feed = AtomFeed(title='Pathagar Bookserver OPDS feed',
+                    atom_id='pathagar:changes',
+                    subtitle='Changes of the Pathagar book server catalog',
+                    extra_attrs=extra_attrs, hide_generator=True,
+                    links=links)
+    for change in changes:
+        if change.book is not None:
+            feed.items.append(book_item(change.book))
         else:
-            linklist = [{'rel': 'http://opds-spec.org/acquisition',
-                         'href': reverse('book_download',
-                                         kwargs=dict(book_id=book.pk)),
-                         'type': __get_mimetype(book)}]
-
-        add_kwargs = {
-            'content': book.summary,
-            'links': linklist,
-            'authors': [{'name': a.name} for a in book.authors.all()],
-            'dc_publisher': [p.name for p in book.publishers.all()],
-            'dc_issued': book.dc_issued,
-            'dc_identifier': book.dc_identifier,
-        }
-
-        if book.dc_language is not None:
-            add_kwargs['dc_language'] = book.dc_language.code
-
-        feed.add_item(book.a_id, book.title, book.a_updated, **add_kwargs)
+            feed.items.append(AtomFeed.make_tombstone(change.a_id,
+                                                      change.time))
 
     s = StringIO()
     feed.write(s, 'UTF-8')
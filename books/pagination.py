@@ -0,0 +1,176 @@
+"""Keyset (cursor) pagination.
+
+Instead of OFFSET/LIMIT, the pages are fetched by filtering on the ordering
+key of the last (or first) row of the previous page, so the cost of a page
+does not depend on its position on the list, and no COUNT is needed. The
+position is passed between requests as an opaque cursor string.
+
+The ordering key must be unique (ie. end with the pk), and the fields must
+not be nullable.
+"""
+
+import base64
+import datetime
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+
+NEXT, PREVIOUS = 'n', 'p'
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+class CursorEncoder(DjangoJSONEncoder):
+    """JSON encoder that keeps the microseconds of the datetimes, which are
+    truncated by `DjangoJSONEncoder` and are needed for seeking to the exact
+    row.
+    """
+    def default(self, o):
+        if isinstance(o, datetime.datetime):
+            return o.isoformat()
+        return super(CursorEncoder, self).default(o)
+
+
+def encode_cursor(direction, values):
+    """Return the opaque cursor for `values` of the ordering key.
+
+    :param direction: `NEXT` for the rows after `values`, `PREVIOUS` for the
+    rows before them
+    :param values: list of values of the ordering key
+    :returns: cursor string
+    """
+    data = json.dumps([direction] + list(values), cls=CursorEncoder)
+    return base64.urlsafe_b64encode(data).rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Return a tuple (direction, values) from the `cursor` string, raising
+    `InvalidCursor` if it is malformed.
+    """
+    try:
+        padding = '=' * (-len(cursor) % 4)
+        data = json.loads(base64.urlsafe_b64decode(str(cursor) + padding))
+    except (TypeError, ValueError, UnicodeError):
+        raise InvalidCursor(cursor)
+    if not isinstance(data, list) or data[:1] not in ([NEXT], [PREVIOUS]):
+        raise InvalidCursor(cursor)
+    return data[0], data[1:]
+
+
+class KeysetPage(object):
+    """A page of a `KeysetPaginator`, with the subset of the interface of
+    Django pages used by the OPDS catalogs.
+    """
+    def __init__(self, object_list, paginator, has_previous, has_next,
+                 cursor_values=None):
+        self.object_list = object_list
+        self.paginator = paginator
+        self._has_previous = has_previous
+        self._has_next = has_next
+        # Key of the requested position, used for the links of empty pages.
+        self._cursor_values = cursor_values
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_next(self):
+        return self._has_next
+
+    def previous_cursor(self):
+        if not self._has_previous:
+            return None
+        if not self.object_list:
+            return encode_cursor(PREVIOUS, self._cursor_values)
+        return encode_cursor(PREVIOUS,
+                             self.paginator.key_values(self.object_list[0]))
+
+    def next_cursor(self):
+        if not self._has_next or not self.object_list:
+            return None
+        return encode_cursor(NEXT,
+                             self.paginator.key_values(self.object_list[-1]))
+
+
+class KeysetPaginator(object):
+    """Paginate `queryset` ordered by `ordering`, a list of field names in the
+    `order_by()` syntax (ie. `['-time_added', '-pk']`).
+    """
+    def __init__(self, queryset, per_page, ordering):
+        self.queryset = queryset
+        self.per_page = int(per_page)
+        self.ordering = [(f.lstrip('-'), f.startswith('-')) for f in ordering]
+
+    def key_values(self, obj):
+        return [getattr(obj, name) for name, _ in self.ordering]
+
+    def _to_python(self, values):
+        if len(values) != len(self.ordering):
+            raise InvalidCursor(values)
+        model = self.queryset.model
+        try:
+            values = [model._meta.pk.to_python(v) if name == 'pk' else
+                      model._meta.get_field(name).to_python(v)
+                      for (name, _), v in zip(self.ordering, values)]
+        except Exception:
+            raise InvalidCursor(values)
+        # The key fields are not nullable, and None can not be compared.
+        if None in values:
+            raise InvalidCursor(values)
+        return values
+
+    def _seek(self, values, forward):
+        """Return a Q matching the rows after (or before, if `forward` is
+        False) `values` in the list order, ie. for the key (a, b):
+        `a > x OR (a = x AND b > y)`.
+        """
+        q = Q()
+        for i, (name, descending) in enumerate(self.ordering):
+            lookup = 'lt' if descending == forward else 'gt'
+            term = Q(**{'%s__%s' % (name, lookup): values[i]})
+            for j, (prev_name, _) in enumerate(self.ordering[:i]):
+                term &= Q(**{prev_name: values[j]})
+            q |= term
+        return q
+
+    def page(self, cursor=None):
+        """Return the `KeysetPage` for `cursor`, or the first page if it is
+        None. `InvalidCursor` is raised for malformed cursors.
+
+        :param cursor: cursor string, as returned by the pages
+        :returns: page
+        """
+        forward, values = True, None
+        if cursor:
+            direction, values = decode_cursor(cursor)
+            forward = direction == NEXT
+            values = self._to_python(values)
+
+        ordering = ['%s%s' % ('-' if descending == forward else '', name)
+                    for name, descending in self.ordering]
+        queryset = self.queryset.order_by(*ordering)
+        if values is not None:
+            queryset = queryset.filter(self._seek(values, forward))
+
+        # Fetch an extra row, for knowing if there are more pages.
+        object_list = list(queryset[:self.per_page + 1])
+        has_more = len(object_list) > self.per_page
+        object_list = object_list[:self.per_page]
+
+        if forward:
+            return KeysetPage(object_list, self, values is not None, has_more,
+                              values)
+        if not has_more:
+            # Going back reached the start of the list: return the actual
+            # first page, which may have more rows than the ones found.
+            return self.page()
+        object_list.reverse()
+        return KeysetPage(object_list, self, True, True, values)
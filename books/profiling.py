@@ -0,0 +1,90 @@
+"""Timing of the stages of an import, for the `--profile` option of `addepub`
+and `resync`.
+
+The duration of each stage (walking the directories, opening the zip files,
+parsing the OPF, extracting the cover, hashing, and the database work) is
+recorded for every file, or every batch for the database, and summarized as
+a JSON document with the percentiles of the latencies and the throughput.
+The keys are sorted, so the summaries of two runs (ie. before and after an
+upgrade) can be compared with `diff`.
+"""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import json
+import math
+import time
+
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(values, p):
+    """Return the `p` percentile of the sorted list `values`, using the
+    nearest rank method.
+    """
+    if not values:
+        return None
+    rank = int(math.ceil(p / 100.0 * len(values)))
+    return values[max(rank - 1, 0)]
+
+
+class Profile(object):
+    """Durations of the stages of an import, and counters of the files."""
+    def __init__(self):
+        self.started = time.time()
+        self.samples = OrderedDict()
+        self.counters = {}
+
+    def add(self, stage, seconds):
+        self.samples.setdefault(stage, []).append(seconds)
+
+    def add_timings(self, timings):
+        """Add the durations of the dict `timings`, mapping the stages to
+        seconds.
+        """
+        for stage, seconds in timings.items():
+            self.add(stage, seconds)
+
+    @contextmanager
+    def stage(self, name):
+        """Context manager that adds the duration of its block to `name`."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - start)
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self, **extra):
+        """Return the summary of the profile as a dict, including the items
+        of `extra`. The `files` and `bytes` counters are used for the
+        throughput.
+        """
+        elapsed = time.time() - self.started
+        stages = {}
+        for stage, samples in self.samples.items():
+            samples = sorted(samples)
+            stats = {'count': len(samples),
+                     'total_s': round(sum(samples), 3),
+                     'mean_ms': round(sum(samples) / len(samples) * 1000, 3),
+                     'max_ms': round(samples[-1] * 1000, 3)}
+            for p in PERCENTILES:
+                stats['p%s_ms' % p] = round(percentile(samples, p) * 1000, 3)
+            stages[stage] = stats
+
+        files = self.counters.get('files', 0)
+        summary = {'elapsed_s': round(elapsed, 3),
+                   'counters': self.counters,
+                   'stages': stages,
+                   'files_per_sec': round(files / elapsed, 3) if elapsed
+                   else None,
+                   'mb_per_sec': round(self.counters.get('bytes', 0) /
+                                       1048576.0 / elapsed, 3) if elapsed
+                   else None}
+        summary.update(extra)
+        return summary
+
+    def to_json(self, **extra):
+        return json.dumps(self.summary(**extra), indent=2, sort_keys=True)
@@ -15,66 +15,43 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
 
-from django.db.models import Q
-from models import Book
+from search_index import get_search_backend
+from search_query import parse
 
 
 def simple_search(queryset, searchterms,
                   search_title=False, search_author=False):
-    q_objects = []
-    results = queryset
+    """
+    Does a search in the title and/or the authors of the books, using the
+    search index. The words match the terms starting with them (ie. "heft"
+    finds "Hefty"), but not in the middle of the terms.
 
-    subterms = searchterms.split(' ')
-    for subterm in subterms:
-        word = subterm
-        if search_title:
-            q_objects.append(Q(title__icontains=word))
-        if search_author:
-            q_objects.append(Q(authors__name__icontains=word))
+    :param queryset:
+    :param searchterms:
+    :param search_title:
+    :param search_author:
+    :return:
+    """
+    fields = []
+    if search_title:
+        fields.append('title')
+    if search_author:
+        fields.append('authors')
 
-    for q_object in q_objects:
-        results = results.filter(q_object)
-    return results
+    return get_search_backend().search(
+        queryset, parse(searchterms, fields or None, prefix_words=True))
 
 
 def advanced_search(queryset, searchterms):
     """
-    Does an advanced search in several fields of the books.
+    Does an advanced search in several fields of the books, using the search
+    index. The query syntax (field:value, quoted phrases, AND/OR/NOT and
+    prefix*) is described in `books.search_query`; as on `simple_search()`,
+    all the words are prefixes. The results are ranked by relevance.
 
     :param queryset:
     :param searchterms:
     :return:
     """
-    q_objects = []
-    results = queryset
-
-    subterms = searchterms.split('AND')
-    for subterm in subterms:
-        if ':' in subterm:
-            key, word = subterm.split(':')
-            key = key.strip()
-            if key == 'title':
-                q_objects.append(Q(title__icontains=word))
-            if key == 'author':
-                q_objects.append(Q(authors__name__icontains=word))
-            if key == 'publisher':
-                q_objects.append(Q(publishers__name__icontains=word))
-            if key == 'identifier':
-                q_objects.append(Q(dc_identifier__icontains=word))
-            if key == 'summary':
-                q_objects.append(Q(summary__icontains=word))
-        else:
-            word = subterm
-            try:
-                results = results.filter(Q(title__icontains=word) |
-                                         Q(authors__name__icontains=word) |
-                                         Q(publishers__name__icontains=word) |
-                                         Q(dc_identifier__icontains=word) |
-                                         Q(summary__icontains=word)) \
-                    .distinct()
-            except Book.DoesNotExist:
-                results = Book.objects.none()
-
-    for q_object in q_objects:
-        results = results.filter(q_object)
-    return results
+    return get_search_backend().search(
+        queryset, parse(searchterms, prefix_words=True))
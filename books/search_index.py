@@ -0,0 +1,404 @@
+"""Full-text search index for the books.
+
+Two backends are provided:
+* `SQLiteFTSBackend` (default): stores the indexed text on a SQLite FTS5
+virtual table, and delegates the matching and bm25 ranking to SQLite.
+* `InvertedIndexBackend`: tokenizes the text in Python and stores the postings
+on the `SearchTerm` model, so it works on any database.
+
+The backend is selected via `settings.SEARCH_BACKEND`. If it is not usable on
+the current database (ie. not SQLite, or SQLite compiled without FTS5), the
+`InvertedIndexBackend` is used instead.
+
+The index is kept in sync with the `Book`, `Author` and `Publisher` changes
+via the signal handlers at the bottom of this module. It can be rebuilt from
+scratch with the `rebuild_search_index` management command.
+"""
+
+import logging
+import operator
+import re
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+from django.db.models.signals import (m2m_changed, post_delete, post_save,
+                                      pre_delete)
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from models import Author, Book, Publisher, SearchTerm
+from search_query import And, Not, Or, Term, optimize, positive_terms
+
+logger = logging.getLogger(__name__)
+
+# Indexed fields, along with the boost used for ranking the results.
+FIELD_WEIGHTS = [('title', 10.0),
+                 ('authors', 5.0),
+                 ('publishers', 2.0),
+                 ('identifier', 5.0),
+                 ('summary', 1.0)]
+FIELDS = [field for field, _ in FIELD_WEIGHTS]
+
+FTS_TABLE = 'books_book_fts'
+FTS_CREATE_SQL = ("CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5("
+                  "%s, tokenize='unicode61', prefix='2 3')" %
+                  (FTS_TABLE, ', '.join(FIELDS)))
+FTS_DROP_SQL = 'DROP TABLE IF EXISTS %s' % FTS_TABLE
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+MAX_TERM_LENGTH = 64
+
+
+class SubquerySQL(RawSQL):
+    """Raw SQL subquery, for using as the right hand side of `__in` lookups.
+    `RawSQL` wraps the SQL in parenthesis, and `IN ((SELECT ...))` is treated
+    by SQLite as a single value instead of as a subquery.
+    """
+    def as_sql(self, compiler, connection):
+        return self.sql, self.params
+
+
+def tokenize(text):
+    """Return the list of lowercase terms on `text`.
+
+    :param text: string (or None)
+    :returns: list of terms
+    """
+    if not text:
+        return []
+    return [t[:MAX_TERM_LENGTH] for t in TOKEN_RE.findall(text.lower())]
+
+
+class BaseSearchBackend(object):
+    """Interface for the search backends.
+
+    `search()` receives the query tree returned by `search_query.parse()`,
+    and compiles its optimized version into a single queryset.
+    """
+    def is_available(self):
+        return True
+
+    def index_books(self, pks):
+        raise NotImplementedError
+
+    def remove_books(self, pks):
+        raise NotImplementedError
+
+    def rebuild(self):
+        raise NotImplementedError
+
+    def search(self, queryset, query):
+        raise NotImplementedError
+
+    def rank(self, queryset, order_by):
+        """Order `queryset` by relevance, unless the listing already imposes
+        an ordering (by title, by author, ...).
+        """
+        if queryset.query.order_by:
+            return queryset
+        return queryset.extra(order_by=[order_by, '-time_added'])
+
+
+class SQLiteFTSBackend(BaseSearchBackend):
+    """Search backend using a SQLite FTS5 table, which has one row for each
+    Book (sharing the rowid with `Book.pk`) and one column for each field.
+    """
+    def __init__(self):
+        self._available = None
+
+    def is_available(self):
+        if self._available is None:
+            self._available = (
+                connection.vendor == 'sqlite' and
+                FTS_TABLE in connection.introspection.table_names())
+        return self._available
+
+    def _select_sql(self):
+        """Return the SELECT that builds the rows of the FTS table from the
+        books tables, aggregating the author and publisher names.
+        """
+        def names_sql(model, through, column):
+            return ("(SELECT group_concat(t.name, ' ') FROM %s t "
+                    "INNER JOIN %s m ON m.%s = t.id "
+                    "WHERE m.book_id = b.id)" % (model._meta.db_table,
+                                                 through._meta.db_table,
+                                                 column))
+
+        return ('SELECT b.id, b.title, %s, %s, b.dc_identifier, b.summary '
+                'FROM %s b' % (names_sql(Author, Book.authors.through,
+                                         'author_id'),
+                               names_sql(Publisher, Book.publishers.through,
+                                         'publisher_id'),
+                               Book._meta.db_table))
+
+    def _insert_sql(self):
+        return 'INSERT INTO %s(rowid, %s) %s' % (FTS_TABLE, ', '.join(FIELDS),
+                                                 self._select_sql())
+
+    def index_books(self, pks):
+        pks = list(pks)
+        if not pks:
+            return
+        placeholders = ', '.join(['%s'] * len(pks))
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute('DELETE FROM %s WHERE rowid IN (%s)' %
+                           (FTS_TABLE, placeholders), pks)
+            cursor.execute('%s WHERE b.id IN (%s)' %
+                           (self._insert_sql(), placeholders), pks)
+
+    def remove_books(self, pks):
+        pks = list(pks)
+        if not pks:
+            return
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM %s WHERE rowid IN (%s)' %
+                           (FTS_TABLE, ', '.join(['%s'] * len(pks))), pks)
+
+    def rebuild(self):
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute('DELETE FROM %s' % FTS_TABLE)
+            cursor.execute(self._insert_sql())
+
+    def _term_match(self, term):
+        """Return the FTS5 query string for a `Term`. The text is quoted as a
+        FTS5 string, so the user input can not inject FTS5 operators.
+        """
+        expr = '"%s"' % term.text.replace('"', '""')
+        if term.prefix:
+            expr += ' *'
+        if term.fields:
+            expr = '{%s} : %s' % (' '.join(term.fields), expr)
+        return expr
+
+    def match_expression(self, node):
+        """Return the FTS5 query string for the (optimized) query tree, or None
+        if it can not be expressed as a single FTS5 query: FTS5 `NOT` is a
+        binary operator, so negations are only supported in an `And` with
+        at least one positive child.
+        """
+        if isinstance(node, Term):
+            return self._term_match(node)
+        if isinstance(node, Not):
+            return None
+
+        matches = [self.match_expression(child) for child in node.children
+                   if not isinstance(child, Not)]
+        if not matches or None in matches:
+            return None
+        if isinstance(node, Or):
+            if len(matches) < len(node.children):
+                return None
+            return '(%s)' % ' OR '.join(matches)
+
+        negations = [self.match_expression(child.child)
+                     for child in node.children if isinstance(child, Not)]
+        if None in negations:
+            return None
+        return '(%s)%s' % (' AND '.join(matches),
+                           ''.join(' NOT %s' % n for n in negations))
+
+    def _subquery(self, node):
+        """Compile the query tree into a `Q`, using one subquery for each of
+        the largest subtrees that can be expressed as a FTS5 query.
+        """
+        match = self.match_expression(node)
+        if match is not None:
+            return Q(pk__in=SubquerySQL(
+                'SELECT rowid FROM %s WHERE %s MATCH %%s' %
+                (FTS_TABLE, FTS_TABLE), [match]))
+        if isinstance(node, Not):
+            return ~self._subquery(node.child)
+        op = operator.and_ if isinstance(node, And) else operator.or_
+        return reduce(op, [self._subquery(child) for child in node.children])
+
+    def search(self, queryset, query):
+        node = optimize(query)
+        if node is None:
+            return queryset
+
+        match = self.match_expression(node)
+        if match is None:
+            # Not expressible as a single FTS5 query: combine subqueries,
+            # without ranking.
+            return queryset.filter(self._subquery(node))
+
+        weights = ', '.join(str(w) for _, w in FIELD_WEIGHTS)
+        queryset = queryset.extra(
+            select={'search_rank': 'bm25(%s, %s)' % (FTS_TABLE, weights)},
+            tables=[FTS_TABLE],
+            where=['%s.rowid = %s.id' % (FTS_TABLE, Book._meta.db_table),
+                   '%s MATCH %%s' % FTS_TABLE],
+            params=[match])
+        return self.rank(queryset, 'search_rank')
+
+
+class InvertedIndexBackend(BaseSearchBackend):
+    """Portable search backend. The text is tokenized in Python, and the
+    postings are stored on the `SearchTerm` model.
+    """
+    def _postings(self, book):
+        texts = {'title': [book.title],
+                 'authors': [a.name for a in book.authors.all()],
+                 'publishers': [p.name for p in book.publishers.all()],
+                 'identifier': [book.dc_identifier],
+                 'summary': [book.summary]}
+        for field, weight in FIELD_WEIGHTS:
+            counts = {}
+            for text in texts[field]:
+                for term in tokenize(text):
+                    counts[term] = counts.get(term, 0) + 1
+            for term, count in counts.items():
+                yield SearchTerm(book=book, field=field, term=term,
+                                 weight=count * weight)
+
+    def _index(self, books):
+        postings = []
+        for book in books:
+            postings.extend(self._postings(book))
+        SearchTerm.objects.bulk_create(postings, batch_size=500)
+
+    def index_books(self, pks):
+        pks = list(pks)
+        if not pks:
+            return
+        with transaction.atomic():
+            SearchTerm.objects.filter(book__in=pks).delete()
+            self._index(Book.objects.filter(pk__in=pks).
+                        prefetch_related('authors', 'publishers'))
+
+    def remove_books(self, pks):
+        SearchTerm.objects.filter(book__in=list(pks)).delete()
+
+    def rebuild(self, chunk_size=500):
+        with transaction.atomic():
+            SearchTerm.objects.all().delete()
+            pks = list(Book.objects.values_list('pk', flat=True))
+            for i in range(0, len(pks), chunk_size):
+                self._index(Book.objects.
+                            filter(pk__in=pks[i:i + chunk_size]).
+                            prefetch_related('authors', 'publishers'))
+
+    def _term_subquery(self, term):
+        """Compile a `Term` into a `Q` with one subquery on the postings for
+        each of its words, restricted to the fields of the term. Phrases are
+        approximated as all their words appearing on the same field.
+        """
+        words = tokenize(term.text)
+        q = Q()
+        for i, word in enumerate(words):
+            if term.prefix and i == len(words) - 1:
+                postings = SearchTerm.objects.filter(term__startswith=word)
+            else:
+                postings = SearchTerm.objects.filter(term=word)
+            if term.fields:
+                postings = postings.filter(field__in=term.fields)
+            q &= Q(pk__in=postings.values('book_id'))
+        return q
+
+    def _subquery(self, node):
+        if isinstance(node, Term):
+            return self._term_subquery(node)
+        if isinstance(node, Not):
+            return ~self._subquery(node.child)
+        op = operator.and_ if isinstance(node, And) else operator.or_
+        return reduce(op, [self._subquery(child) for child in node.children])
+
+    def search(self, queryset, query):
+        node = optimize(query)
+        if node is None:
+            return queryset
+        queryset = queryset.filter(self._subquery(node))
+
+        # Rank using the weights of the non-negated words (a prefix ranks
+        # the terms equal to it).
+        words = set()
+        for term in positive_terms(node):
+            words.update(tokenize(term.text))
+        if not words:
+            return queryset
+        rank_sql = ('SELECT SUM(st.weight) FROM %s st '
+                    'WHERE st.book_id = %s.id AND st.term IN (%s)' %
+                    (SearchTerm._meta.db_table, Book._meta.db_table,
+                     ', '.join(['%s'] * len(words))))
+        queryset = queryset.extra(select={'search_rank': rank_sql},
+                                  select_params=list(words))
+        return self.rank(queryset, '-search_rank')
+
+
+_backend = None
+
+
+def get_search_backend():
+    """Return the search backend instance, as defined by
+    `settings.SEARCH_BACKEND`, falling back to `InvertedIndexBackend` if it
+    is not available.
+    """
+    global _backend
+    if _backend is None:
+        backend = import_string(settings.SEARCH_BACKEND)()
+        if not backend.is_available():
+            logger.info('Search backend %s not available, using the '
+                        'inverted index' % settings.SEARCH_BACKEND)
+            backend = InvertedIndexBackend()
+        _backend = backend
+    return _backend
+
+
+# Signal handlers for keeping the index updated.
+@receiver(post_save, sender=Book)
+def book_post_save_index_handler(**kwargs):
+    if kwargs.get('raw'):
+        return
+    get_search_backend().index_books([kwargs['instance'].pk])
+
+
+@receiver(post_delete, sender=Book)
+def book_post_delete_index_handler(**kwargs):
+    get_search_backend().remove_books([kwargs['instance'].pk])
+
+
+@receiver(post_save, sender=Author)
+@receiver(post_save, sender=Publisher)
+def name_post_save_index_handler(**kwargs):
+    if kwargs.get('raw') or kwargs.get('created'):
+        return
+    instance = kwargs['instance']
+    get_search_backend().index_books(
+        instance.books.values_list('pk', flat=True))
+
+
+@receiver(pre_delete, sender=Author)
+@receiver(pre_delete, sender=Publisher)
+def name_pre_delete_index_handler(**kwargs):
+    # The m2m rows are deleted without sending m2m_changed: keep track of
+    # the affected books, for reindexing them on post_delete.
+    instance = kwargs['instance']
+    instance._indexed_book_pks = list(
+        instance.books.values_list('pk', flat=True))
+
+
+@receiver(post_delete, sender=Author)
+@receiver(post_delete, sender=Publisher)
+def name_post_delete_index_handler(**kwargs):
+    pks = getattr(kwargs['instance'], '_indexed_book_pks', [])
+    get_search_backend().index_books(pks)
+
+
+@receiver(m2m_changed, sender=Book.authors.through)
+@receiver(m2m_changed, sender=Book.publishers.through)
+def book_m2m_changed_index_handler(**kwargs):
+    action = kwargs['action']
+    instance = kwargs['instance']
+    if not kwargs['reverse']:
+        if action in ('post_add', 'post_remove', 'post_clear'):
+            get_search_backend().index_books([instance.pk])
+    elif action == 'pre_clear':
+        instance._indexed_book_pks = list(
+            instance.books.values_list('pk', flat=True))
+    elif action == 'post_clear':
+        get_search_backend().index_books(
+            getattr(instance, '_indexed_book_pks', []))
+    elif action in ('post_add', 'post_remove'):
+        get_search_backend().index_books(kwargs['pk_set'] or [])
@@ -0,0 +1,289 @@
+"""Parser and planner for the search query syntax.
+
+The syntax supports:
+* words: `verne`, implicitly AND'ed (`jules verne`).
+* field restrictions: `title:leagues`, `author:"jules verne"`,
+`publisher:(hetzel OR gallimard)`. The fields are the keys of
+`FIELD_ALIASES`; unknown keys are treated as regular words.
+* quoted phrases: `"twenty thousand leagues"`.
+* boolean operators: `AND`, `OR`, `NOT` (or a leading `-`), and parenthesis.
+`NOT` binds tighter than `AND`, which binds tighter than `OR`.
+* prefixes: `leag*`. `parse()` can also treat all the words as prefixes,
+as the searches of the book lists do (see `books.search`).
+* backslash escapes for the special characters: `title\\:x`, `\\"`.
+
+`parse()` returns a tree of `Term`, `And`, `Or` and `Not` nodes, and
+`optimize()` normalizes it into the plan that is compiled by the search
+backends (see `books.search_index`). The parser is lenient: unbalanced
+parenthesis and dangling operators are ignored instead of raising errors.
+"""
+
+from collections import namedtuple
+import re
+
+# Nodes of the query tree.
+Term = namedtuple('Term', ('text', 'fields', 'phrase', 'prefix'))
+And = namedtuple('And', ('children',))
+Or = namedtuple('Or', ('children',))
+Not = namedtuple('Not', ('child',))
+
+# Mapping between the keys accepted on the queries and the fields of the
+# search index.
+FIELD_ALIASES = {'title': 'title',
+                 'author': 'authors',
+                 'authors': 'authors',
+                 'publisher': 'publishers',
+                 'publishers': 'publishers',
+                 'identifier': 'identifier',
+                 'isbn': 'identifier',
+                 'summary': 'summary'}
+
+# Lexer tokens.
+Token = namedtuple('Token', ('kind', 'value', 'prefix'))
+LPAREN, RPAREN, AND, OR, NOT, FIELD, WORD, PHRASE = (
+    'LPAREN', 'RPAREN', 'AND', 'OR', 'NOT', 'FIELD', 'WORD', 'PHRASE')
+OPERATORS = {'AND': AND, 'OR': OR, 'NOT': NOT}
+
+WORD_RE = re.compile(r'\w', re.UNICODE)
+
+
+def tokenize_query(text):
+    """Split the query `text` into a list of `Token`s.
+
+    :param text: query string
+    :returns: list of tokens
+    """
+    tokens = []
+    i, length = 0, len(text)
+    while i < length:
+        char = text[i]
+        if char.isspace():
+            i += 1
+        elif char == '(':
+            tokens.append(Token(LPAREN, char, False))
+            i += 1
+        elif char == ')':
+            tokens.append(Token(RPAREN, char, False))
+            i += 1
+        elif char == '"':
+            value, i = _read_until(text, i + 1, '"')
+            prefix = text[i + 1:i + 2] == '*'
+            tokens.append(Token(PHRASE, value, prefix))
+            i += 2 if prefix else 1
+        elif char == '-' and i + 1 < length and not text[i + 1].isspace():
+            tokens.append(Token(NOT, char, False))
+            i += 1
+        else:
+            value, escaped, prefix, i, field = _read_word(text, i)
+            if field is not None:
+                tokens.append(Token(FIELD, field, False))
+            elif value in OPERATORS and not escaped:
+                tokens.append(Token(OPERATORS[value], value, False))
+            elif value:
+                tokens.append(Token(WORD, value, prefix))
+    return tokens
+
+
+def _read_until(text, i, end):
+    """Read a string from `text[i:]` until the unescaped `end` character (or
+    the end of `text`), returning the unescaped string and the index of the
+    `end` character.
+    """
+    chars = []
+    while i < len(text) and text[i] != end:
+        if text[i] == '\\' and i + 1 < len(text):
+            i += 1
+        chars.append(text[i])
+        i += 1
+    return ''.join(chars), i
+
+
+def _read_word(text, i):
+    """Read a word from `text[i:]`, returning a tuple (word, escaped, prefix,
+    index, field), where:
+    * `escaped` is True if the word contains escaped characters (and thus is
+    not an operator).
+    * `prefix` is True if the word ends with an unescaped `*`, which is
+    removed from the word.
+    * `field` is the name of the index field if the word is a valid field
+    restriction, or None.
+    """
+    chars, escaped, prefix = [], False, False
+    while i < len(text) and not text[i].isspace() and text[i] not in '()"':
+        prefix = False
+        if text[i] == '\\' and i + 1 < len(text):
+            i += 1
+            escaped = True
+        elif text[i] == ':' and not escaped:
+            field = FIELD_ALIASES.get(''.join(chars).lower())
+            if field is not None:
+                return '', False, False, i + 1, field
+        elif text[i] == '*':
+            prefix = True
+            i += 1
+            continue
+        chars.append(text[i])
+        i += 1
+    return ''.join(chars), escaped, prefix, i, None
+
+
+class Parser(object):
+    """Recursive descent parser for the query syntax:
+
+        query   := or_expr
+        or_expr := and_expr ('OR' and_expr)*
+        and_expr:= not_expr (['AND'] not_expr)*
+        not_expr:= 'NOT' not_expr | atom
+        atom    := '(' or_expr ')' | FIELD atom | WORD | PHRASE
+    """
+    def __init__(self, text, fields=None, prefix_words=False):
+        self.tokens = tokenize_query(text)
+        self.pos = 0
+        self.fields = fields
+        self.prefix_words = prefix_words
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return None
+
+    def next(self):
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def parse(self):
+        children = []
+        while self.peek() is not None:
+            pos = self.pos
+            children.append(self.or_expr(self.fields))
+            if self.pos == pos:
+                # Skip the token that could not be parsed (ie. unbalanced
+                # parenthesis).
+                self.next()
+        return And(children)
+
+    def or_expr(self, fields):
+        children = [self.and_expr(fields)]
+        while self.peek() is not None and self.peek().kind == OR:
+            self.next()
+            children.append(self.and_expr(fields))
+        return Or(children)
+
+    def and_expr(self, fields):
+        children = []
+        while True:
+            token = self.peek()
+            if token is None or token.kind in (RPAREN, OR):
+                break
+            if token.kind == AND:
+                self.next()
+                continue
+            children.append(self.not_expr(fields))
+        return And(children)
+
+    def not_expr(self, fields):
+        token = self.peek()
+        if token is not None and token.kind == NOT:
+            self.next()
+            child = self.not_expr(fields)
+            return Not(child) if child is not None else None
+        return self.atom(fields)
+
+    def atom(self, fields):
+        token = self.next()
+        if token is None:
+            return None
+        if token.kind == LPAREN:
+            node = self.or_expr(fields)
+            if self.peek() is not None and self.peek().kind == RPAREN:
+                self.next()
+            return node
+        if token.kind == FIELD:
+            return self.atom([token.value])
+        if token.kind in (WORD, PHRASE):
+            prefix = token.prefix or (self.prefix_words and
+                                      token.kind == WORD)
+            return Term(token.value, tuple(fields) if fields else None,
+                        token.kind == PHRASE, prefix)
+        # Dangling operator, ignore it.
+        return None
+
+
+def parse(text, fields=None, prefix_words=False):
+    """Parse the query `text`, returning its tree.
+
+    :param text: query string
+    :param fields: fields used for the terms without an explicit field
+    restriction (None for all of them)
+    :param prefix_words: whether the words (but not the quoted phrases) match
+    the terms starting with them, as if they ended with `*`
+    :returns: tree of `Term`, `And`, `Or` and `Not` nodes
+    """
+    return Parser(text, fields, prefix_words).parse()
+
+
+def optimize(node):
+    """Normalize the query tree, returning the simplest equivalent tree (or
+    None if the query is empty):
+    * terms without any searchable character are removed.
+    * nested `And`/`Or` of the same kind are flattened, and duplicated
+    children removed.
+    * `And`/`Or` with a single child are replaced by the child.
+    * double negations are removed.
+    * `Not` children are moved to the end of `And`, so they can be applied
+    after the positive terms.
+
+    :param node: query tree
+    :returns: query tree, or None
+    """
+    if node is None:
+        return None
+
+    if isinstance(node, Term):
+        if not WORD_RE.search(node.text):
+            return None
+        return node
+
+    if isinstance(node, Not):
+        child = optimize(node.child)
+        if child is None:
+            return None
+        if isinstance(child, Not):
+            return child.child
+        return Not(child)
+
+    kind = type(node)
+    children = []
+    for child in node.children:
+        child = optimize(child)
+        if child is None:
+            continue
+        for c in (child.children if isinstance(child, kind) else [child]):
+            if c not in children:
+                children.append(c)
+
+    if not children:
+        return None
+    if len(children) == 1:
+        return children[0]
+    if kind is And:
+        children.sort(key=lambda c: isinstance(c, Not))
+    return kind(children)
+
+
+def positive_terms(node):
+    """Return the list of `Term`s of the tree that are not negated, used for
+    ranking the results.
+
+    :param node: query tree
+    :returns: list of terms
+    """
+    if node is None or isinstance(node, Not):
+        return []
+    if isinstance(node, Term):
+        return [node]
+    terms = []
+    for child in node.children:
+        terms.extend(positive_terms(child))
+    return terms
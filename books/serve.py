@@ -0,0 +1,201 @@
+"""Responses for downloading the book files.
+
+If `settings.SENDFILE_BACKEND` is one of the django-sendfile backends that
+delegate the transfer to the web server (`sendfile.backends.nginx` for
+X-Accel-Redirect, `sendfile.backends.xsendfile` for X-Sendfile,
+`sendfile.backends.mod_wsgi`), the response only carries the headers, and the
+server sends the file and handles the Range requests.
+
+Otherwise (the `development` and `simple` backends, which would read the
+whole file in Python), the file is sent by `file_response()`: complete files
+are returned as a `FileResponse`, which the WSGI servers send with
+`wsgi.file_wrapper` (ie. `os.sendfile()`), and single byte ranges (`Range`,
+and `If-Range` for resuming a download only if the file did not change) as
+streamed partial responses.
+
+In both cases the ETag is the sha256 sum of the file, so it does not change
+if the file is moved (see `CONTENT_ADDRESSED_BOOKS`).
+"""
+
+import mimetypes
+import os
+import re
+import stat
+import unicodedata
+
+from django.conf import settings
+from django.http import (FileResponse, Http404, HttpResponse,
+                         HttpResponseNotModified, StreamingHttpResponse)
+from django.utils.encoding import force_text
+from django.utils.http import http_date, parse_http_date_safe, urlquote
+from sendfile import sendfile
+
+mimetypes.add_type('application/epub+zip', '.epub')
+
+# Backends of django-sendfile that send the file from Python.
+PYTHON_BACKENDS = ('sendfile.backends.development', 'sendfile.backends.simple')
+
+CHUNK_SIZE = 64 * 1024
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def content_disposition(filename):
+    """Return the Content-Disposition header of an attachment named
+    `filename`, encoding it as in RFC 6266 if it is not ASCII.
+    """
+    filename = force_text(filename)
+    ascii_filename = unicodedata.normalize('NFKD', filename).encode(
+        'ascii', 'ignore').replace(b'"', b'')
+    parts = ['attachment', 'filename="%s"' % ascii_filename]
+    if ascii_filename != filename:
+        parts.append("filename*=UTF-8''%s" % urlquote(filename))
+    return '; '.join(parts)
+
+
+def parse_range(header, size):
+    """Return the (start, end) positions (inclusive) of the byte range of the
+    `Range` header for a file of `size` bytes, None if the header is not a
+    single valid byte range (so the whole file is sent, as RFC 7233 requires
+    for the invalid ones), or False if the range can not be satisfied.
+    """
+    match = RANGE_RE.match(header.strip()) if header else None
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if not first:
+        # Suffix range: the last bytes.
+        if not int(last):
+            return False
+        return max(size - int(last), 0), size - 1
+    start = int(first)
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        return False
+    return start, min(int(last), size - 1) if last else size - 1
+
+
+def if_range_matches(request, etag, mtime):
+    """Return whether the `If-Range` header of `request` (if any) matches
+    the current version of the file, so the range can be sent.
+    """
+    header = request.META.get('HTTP_IF_RANGE')
+    if not header:
+        return True
+    if header.startswith(('"', 'W/')):
+        # Weak ETags can not be used for ranges.
+        return etag is not None and header == etag
+    # The date must be an exact match (a strong comparison).
+    date = parse_http_date_safe(header)
+    return date is not None and int(mtime) == date
+
+
+def etag_matches(request, etag):
+    """Return whether the `If-None-Match` header of `request` matches."""
+    header = request.META.get('HTTP_IF_NONE_MATCH')
+    if not header or etag is None:
+        return False
+    tags = [tag.strip() for tag in header.split(',')]
+    return '*' in tags or etag in tags or 'W/' + etag in tags
+
+
+def _read_range(f, start, length):
+    try:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+
+def file_response(request, filename, etag=None, mimetype=None):
+    """Return the response for downloading `filename` from Python, handling
+    the conditional and Range requests.
+
+    :param request:
+    :param filename: path of the file
+    :param etag: quoted ETag of the file, or None
+    :param mimetype: Content-Type of the file
+    :returns: HttpResponse
+    """
+    try:
+        f = open(filename, 'rb')
+    except IOError:
+        raise Http404('"%s" does not exist' % filename)
+    st = os.fstat(f.fileno())
+    size, mtime = st[stat.ST_SIZE], st[stat.ST_MTIME]
+
+    byte_range = None
+    if if_range_matches(request, etag, mtime):
+        byte_range = parse_range(request.META.get('HTTP_RANGE'), size)
+
+    if byte_range is False:
+        f.close()
+        response = HttpResponse(status=416)
+        response['Content-Range'] = 'bytes */%d' % size
+    elif byte_range is not None:
+        start, end = byte_range
+        response = StreamingHttpResponse(
+            _read_range(f, start, end - start + 1), status=206,
+            content_type=mimetype)
+        response['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+        response['Content-Length'] = end - start + 1
+    else:
+        response = FileResponse(f, content_type=mimetype)
+        response['Content-Length'] = size
+    response['Last-Modified'] = http_date(mtime)
+    return response
+
+
+def serve_file(request, filename, etag=None, attachment_filename=None,
+               mimetype=None):
+    """Return the response for downloading the file at `filename` with the
+    configured engine (see the module docstring).
+
+    :param request:
+    :param filename: path of the file
+    :param etag: unquoted ETag of the file (ie. its sha256 sum), or None
+    :param attachment_filename: name of the downloaded file (by default,
+    the name of `filename`)
+    :param mimetype: Content-Type of the file (by default, guessed from its
+    name)
+    :returns: HttpResponse
+    """
+    etag = '"%s"' % etag if etag else None
+    if etag_matches(request, etag):
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        return response
+
+    attachment_filename = attachment_filename or os.path.basename(filename)
+    mimetype = (mimetype or mimetypes.guess_type(filename)[0] or
+                'application/octet-stream')
+    if settings.SENDFILE_BACKEND in PYTHON_BACKENDS:
+        response = file_response(request, filename, etag, mimetype)
+    else:
+        response = sendfile(request, filename, mimetype=mimetype)
+    response['Content-Disposition'] = content_disposition(attachment_filename)
+    response['Accept-Ranges'] = 'bytes'
+    if etag:
+        response['ETag'] = etag
+    return response
+
+
+def is_new_download(request, response):
+    """Return whether `response` starts a download, instead of resuming it
+    or not sending the file, so it is only counted once.
+    """
+    if response.status_code == 206:
+        return response['Content-Range'].startswith('bytes 0-')
+    if response.status_code != 200:
+        return False
+    if settings.SENDFILE_BACKEND in PYTHON_BACKENDS:
+        # The Range header was ignored: the whole file is sent.
+        return True
+    header = request.META.get('HTTP_RANGE', '').replace(' ', '')
+    return not header or header.startswith('bytes=0-')
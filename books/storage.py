@@ -1,10 +1,38 @@
+from collections import OrderedDict
+from hashlib import sha256
 import os
 import errno
+import re
+import shutil
 
 from django.conf import settings
 from django.core.files import File
 from django.core.files.move import _samefile
 from django.core.files.storage import FileSystemStorage
+from django.core.files.uploadhandler import MemoryFileUploadHandler, \
+    TemporaryFileUploadHandler
+from django.utils.crypto import get_random_string
+
+# Size of the chunks read when hashing and copying files.
+CHUNK_SIZE = 64 * 1024
+
+# Names of the content addressed files (see `content_address()`).
+CONTENT_ADDRESS_RE = re.compile(
+    r'(?:^|/)([0-9a-f]{2})/([0-9a-f]{2})/\1\2[0-9a-f]{60}(?:\.[^/]*)?$')
+
+
+def content_address(directory, sha256sum, extension='.epub'):
+    """Return the name of the file with the sha256 sum `sha256sum` on the
+    content addressed layout, sharded in two levels of subdirectories of
+    `directory` so none of them holds too many entries:
+    `directory/ab/cd/abcd...ef.epub`.
+    """
+    return '/'.join([directory, sha256sum[:2], sha256sum[2:4],
+                     sha256sum + extension])
+
+
+def is_content_address(name):
+    return CONTENT_ADDRESS_RE.search(name) is not None
 
 
 def file_symlink_safe(old_file_name, new_file_name, allow_overwrite=False):
@@ -41,6 +69,166 @@ class LinkableFile(File):
     pass
 
 
+class StagedFile(File):
+    """`File` for a file that was already written (ie. by `stage_file()`) on
+    the same filesystem as the storage, which is moved into place instead of
+    copied, like Django does with the uploaded temporary files.
+    """
+    def __init__(self, path, name=None):
+        super(StagedFile, self).__init__(None, name or path)
+        self.path = path
+        # Read before the file is moved.
+        self.size = os.path.getsize(path)
+
+    def temporary_file_path(self):
+        return self.path
+
+    def open(self, mode='rb'):
+        self.file = open(self.path, mode)
+        return self
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def stage_file(filename, directory):
+    """Copy `filename` to a new file in `directory`, computing its sha256 sum
+    in the same pass.
+
+    :param filename: path of the file to copy
+    :param directory: directory of the copy, which is created if needed
+    :returns: tuple (path of the copy, sha256 sum)
+    """
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    # Unlike tempfile.mkstemp(), the permissions of the copy honor the umask,
+    # as the ones of a regular copy would.
+    while True:
+        path = os.path.join(directory, '.%s%s' % (
+            get_random_string(), os.path.splitext(filename)[1]))
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL |
+                         getattr(os, 'O_BINARY', 0), 0666)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        else:
+            break
+
+    s = sha256()
+    try:
+        with os.fdopen(fd, 'wb') as dst, open(filename, 'rb') as src:
+            for chunk in iter(lambda: src.read(CHUNK_SIZE), b''):
+                s.update(chunk)
+                dst.write(chunk)
+    except:
+        os.remove(path)
+        raise
+    return path, s.hexdigest()
+
+
+def file_sha256(filename):
+    """Return the sha256 sum of the file at `filename`."""
+    s = sha256()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            s.update(chunk)
+    return s.hexdigest()
+
+
+class DigestCache(object):
+    """Cache of the sha256 sums of files, keyed by their (path, size, mtime):
+    if a file changes, its entry is no longer used.
+
+    The least recently used entries are dropped when there are more than
+    `max_entries`.
+    """
+    def __init__(self, entries=(), max_entries=100000):
+        self.max_entries = max_entries
+        self._digests = OrderedDict()
+        for key, digest in entries:
+            self._set(key, digest)
+
+    @staticmethod
+    def key(filename):
+        st = os.stat(filename)
+        return filename, st.st_size, st.st_mtime
+
+    def _set(self, key, digest):
+        self._digests.pop(key, None)
+        self._digests[key] = digest
+        while len(self._digests) > self.max_entries:
+            self._digests.popitem(last=False)
+
+    def add(self, filename, digest):
+        """Store the `digest` of the current contents of `filename`."""
+        self._set(self.key(filename), digest)
+
+    def _get(self, key):
+        digest = self._digests.pop(key, None)
+        if digest is not None:
+            self._digests[key] = digest
+        return digest
+
+    def get(self, filename):
+        """Return the cached sha256 sum of `filename`, or None."""
+        return self._get(self.key(filename))
+
+    def sha256(self, filename):
+        """Return the sha256 sum of `filename`, reading the file only if it
+        is not cached.
+        """
+        key = self.key(filename)
+        digest = self._get(key)
+        if digest is None:
+            digest = file_sha256(filename)
+            self._set(key, digest)
+        return digest
+
+
+class HashingUploadHandlerMixin(object):
+    """Mixin for the upload handlers, that computes the sha256 sum of the
+    uploaded file while it is received, setting it as the `sha256` attribute
+    of the file.
+    """
+    def new_file(self, *args, **kwargs):
+        self._sha256 = sha256()
+        return super(HashingUploadHandlerMixin, self).new_file(*args,
+                                                               **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        ret = super(HashingUploadHandlerMixin, self).receive_data_chunk(
+            raw_data, start)
+        if ret is None:
+            # The chunk was consumed by this handler.
+            self._sha256.update(raw_data)
+        return ret
+
+    def file_complete(self, file_size):
+        uploaded_file = super(HashingUploadHandlerMixin, self).file_complete(
+            file_size)
+        if uploaded_file is not None:
+            uploaded_file.sha256 = self._sha256.hexdigest()
+        return uploaded_file
+
+
+class HashingMemoryFileUploadHandler(HashingUploadHandlerMixin,
+                                     MemoryFileUploadHandler):
+    pass
+
+
+class HashingTemporaryFileUploadHandler(HashingUploadHandlerMixin,
+                                        TemporaryFileUploadHandler):
+    pass
+
+
 class LinkOrFileSystemStorage(FileSystemStorage):
     """Storage that creates a symbolic link instead of copying the file is
     the file to be saved is a `LinkableFile`.
@@ -55,16 +243,82 @@ class LinkOrFileSystemStorage(FileSystemStorage):
 
         'x/symlink_file' == symbolic link to /x/srcfile
         'x/regular_file' == copy of /x/srcfile
+
+    The files with content addressed names (see `content_address()`) are
+    saved by `_save_content_addressed()` instead.
     """
+    def get_available_name(self, name, max_length=None):
+        # A content addressed name always refers to the same contents, so
+        # it is used even if the file exists.
+        if is_content_address(name):
+            return name
+        return super(LinkOrFileSystemStorage, self).get_available_name(
+            name, max_length)
+
     def _save(self, name, content):
         """Save the object using a symlink, and in case of errors, fall back
         to saving it using a regular copy.
         """
+        if is_content_address(name):
+            return self._save_content_addressed(name, content)
         try:
             return self._save_symlink(name, content)
         except:
             return super(LinkOrFileSystemStorage, self)._save(name, content)
 
+    def _save_content_addressed(self, name, content):
+        """Save the object at the content addressed `name`. If the file
+        exists, it already has the same contents and is kept. Otherwise, the
+        symbolic link (for a `LinkableFile`) or the copy is created on a
+        temporary name in the same directory, and renamed into place, so
+        the file is never seen partially written.
+        """
+        full_path = self.path(name)
+        if os.path.lexists(full_path):
+            return name
+
+        directory = os.path.dirname(full_path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+        if hasattr(content, 'temporary_file_path'):
+            # A staged file is renamed into place directly, unless it is on
+            # another filesystem.
+            try:
+                os.rename(content.temporary_file_path(), full_path)
+            except OSError, e:
+                if e.errno != errno.EXDEV:
+                    raise
+            else:
+                if settings.FILE_UPLOAD_PERMISSIONS is not None:
+                    os.chmod(full_path, settings.FILE_UPLOAD_PERMISSIONS)
+                return name
+
+        tmp_path = os.path.join(directory, '.%s.tmp' % get_random_string())
+        try:
+            if (isinstance(content, LinkableFile) or
+                    type(content).__name__ == 'LinkableFile') and \
+                    os.name == 'posix':
+                os.symlink(content.name, tmp_path)
+            elif hasattr(content, 'temporary_file_path'):
+                shutil.copyfile(content.temporary_file_path(), tmp_path)
+            else:
+                with open(tmp_path, 'wb') as f:
+                    for chunk in content.chunks():
+                        f.write(chunk)
+            if settings.FILE_UPLOAD_PERMISSIONS is not None and \
+                    not os.path.islink(tmp_path):
+                os.chmod(tmp_path, settings.FILE_UPLOAD_PERMISSIONS)
+            os.rename(tmp_path, full_path)
+        finally:
+            if os.path.lexists(tmp_path):
+                os.remove(tmp_path)
+        return name
+
     def _save_symlink(self, name, content):
         """Save the object using a symbolic link. Will raise a `TypeError`
         if `content` is not a `LinkableFile`.
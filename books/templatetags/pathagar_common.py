@@ -46,5 +46,29 @@ def rss_url(list_by, tag=None, q=''):
                      ('?q=%s' % q) if q else '')
 
 
+def cover_thumbnail(book, alias):
+    """Return the URL of the thumbnail `alias` of the cover of `book` (see
+    `books.thumbnails`).
+    """
+    return book.cover_thumbnail_url(alias)
+
+
+def cover_srcset(book, alias):
+    """Return the `srcset` of the JPEG thumbnails `alias` of the cover of
+    `book`, for each pixel density.
+    """
+    return book.cover_thumbnail_srcset(alias)
+
+
+def cover_sources(book, alias):
+    """Return the (type, srcset) of the thumbnails `alias` of the cover of
+    `book` in the other formats, for the <source> elements of a <picture>.
+    """
+    return book.cover_thumbnail_sources(alias)
+
+
 register.filter('can_upload', can_upload)
+register.filter('cover_thumbnail', cover_thumbnail)
+register.filter('cover_srcset', cover_srcset)
+register.filter('cover_sources', cover_sources)
 register.simple_tag(rss_url, name='rss_url')
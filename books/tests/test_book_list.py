@@ -0,0 +1,57 @@
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+import django_comments
+
+from books import models
+
+
+class BookListQueriesTest(TestCase):
+    """Make sure that the number of queries used for rendering a page of
+    books does not depend on the number of books in the page.
+    """
+    fixtures = ['initial_data.json']
+
+    def setUp(self):
+        User.objects.create_user('user', 'user@example.com', 'userpass')
+        self.client.login(username='user', password='userpass')
+
+        language = models.Language.objects.create(code='en', label='English',
+                                                  long_name='English')
+        for i in range(10):
+            book = models.Book.objects.create(
+                title='Book %s' % i, book_file='books/%s.epub' % i,
+                file_sha256sum='%s' % i, a_status_id=1, dc_language=language)
+            book.authors.add(models.Author.objects.create(name='A%s' % i),
+                             models.Author.objects.create(name='B%s' % i))
+            book.publishers.add(
+                models.Publisher.objects.create(name='P%s' % i))
+            book.tags.add('tag%s' % i, 'common')
+            django_comments.get_model().objects.create(
+                content_object=book, site_id=1, comment='Comment %s' % i)
+
+    def _count_queries(self, url_name, books_per_page):
+        # Warm up the per-process caches (content types, site, ...).
+        self.client.get(reverse(url_name))
+        with override_settings(BOOKS_PER_PAGE=books_per_page,
+                               FEED_CACHE=None):
+            with CaptureQueriesContext(connection) as ctx:
+                response = self.client.get(reverse(url_name))
+        self.assertEqual(response.status_code, 200)
+        return len(ctx.captured_queries)
+
+    def test_html_list(self):
+        self.assertEqual(self._count_queries('latest', 2),
+                         self._count_queries('latest', 10))
+
+    def test_html_list_comment_counts(self):
+        response = self.client.get(reverse('latest'))
+        for book in response.context['book_list']:
+            self.assertEqual(book.comment_count, 1)
+
+    def test_opds_catalog(self):
+        self.assertEqual(self._count_queries('latest_feed', 2),
+                         self._count_queries('latest_feed', 10))
@@ -0,0 +1,147 @@
+from datetime import timedelta
+from StringIO import StringIO
+from urlparse import parse_qs, urlparse
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from lxml import etree
+
+from books import changes
+from books import models
+
+ATOM_NS = '{http://www.w3.org/2005/Atom}'
+TOMBSTONES_NS = '{http://purl.org/atompub/tombstones/1.0}'
+
+
+@override_settings(FEED_CACHE=None)
+class ChangesTest(TestCase):
+    fixtures = ['initial_data.json']
+
+    def setUp(self):
+        self.books = [models.Book.objects.create(
+            title='Book %s' % i, book_file='books/%s.epub' % i,
+            file_sha256sum='%s' % i, a_status_id=1) for i in range(5)]
+        User.objects.create_user('user', 'user@example.com', 'userpass')
+
+    def _get(self, **params):
+        response = self.client.get(reverse('changes_feed'), params)
+        self.assertEqual(response.status_code, 200)
+        return etree.fromstring(response.content)
+
+    def _parse(self, feed):
+        """Return the titles of the entries, the refs of the deleted entries
+        and the `since` of the next link of `feed`."""
+        titles = [e.findtext(ATOM_NS + 'title') for e in
+                  feed.findall(ATOM_NS + 'entry')]
+        deleted = [e.get('ref') for e in
+                   feed.findall(TOMBSTONES_NS + 'deleted-entry')]
+        since = None
+        for link in feed.findall(ATOM_NS + 'link'):
+            if link.get('rel') == 'next':
+                since = parse_qs(urlparse(link.get('href')).query)['since'][0]
+        return titles, deleted, since
+
+    def test_login_required(self):
+        response = self.client.get(reverse('changes_feed'))
+        self.assertEqual(response.status_code, 302)
+
+    def test_order(self):
+        self.client.login(username='user', password='userpass')
+        self.books[1].save()
+        titles, deleted, since = self._parse(self._get())
+        self.assertEqual(titles, ['Book 0', 'Book 2', 'Book 3', 'Book 4',
+                                  'Book 1'])
+        self.assertEqual(deleted, [])
+
+        # Nothing changed after the last change: the next link polls from
+        # the same position.
+        titles, deleted, next_since = self._parse(self._get(since=since))
+        self.assertEqual((titles, deleted, next_since), ([], [], since))
+
+    def test_tombstones(self):
+        self.client.login(username='user', password='userpass')
+        since = self._parse(self._get())[2]
+        a_id = str(self.books[2].a_id)
+        self.books[2].delete()
+        self.books[3].save()
+
+        titles, deleted, _ = self._parse(self._get(since=since))
+        self.assertEqual(titles, ['Book 3'])
+        self.assertEqual(deleted, [a_id])
+        self.assertTrue(models.DeletedBook.objects.filter(a_id=a_id).exists())
+
+    @override_settings(BOOKS_PER_PAGE=2)
+    def test_since_cursor(self):
+        self.client.login(username='user', password='userpass')
+        self.books[0].delete()
+        seen, since = [], None
+        for _ in range(10):
+            titles, deleted, since = self._parse(
+                self._get(since=since) if since else self._get())
+            seen.extend(titles + deleted)
+            if not titles and not deleted:
+                break
+        self.assertEqual(seen, ['Book 1', 'Book 2', 'Book 3', 'Book 4',
+                                str(self.books[0].a_id)])
+
+    def test_since_date(self):
+        self.client.login(username='user', password='userpass')
+        since = timezone.now()
+        self.books[4].save()
+        titles, _, _ = self._parse(self._get(since=since.isoformat()))
+        self.assertEqual(titles, ['Book 4'])
+
+        response = self.client.get(reverse('changes_feed'),
+                                   {'since': 'yesterday'})
+        self.assertEqual(response.status_code, 400)
+
+    @override_settings(ALLOW_PUBLIC_BROWSE=True)
+    def test_unpublished(self):
+        self.books[1].a_status_id = 2
+        self.books[1].save()
+        titles, deleted, _ = self._parse(self._get())
+        self.assertEqual(titles, ['Book 0', 'Book 2', 'Book 3', 'Book 4'])
+        self.assertEqual(deleted, [str(self.books[1].a_id)])
+
+        self.client.login(username='user', password='userpass')
+        titles, deleted, _ = self._parse(self._get())
+        self.assertEqual(len(titles), 5)
+        self.assertEqual(deleted, [])
+
+    def test_next_link_escaped(self):
+        self.client.login(username='user', password='userpass')
+        feed = self._get(x='a&b')
+        hrefs = [link.get('href') for link in feed.findall(ATOM_NS + 'link')
+                 if link.get('rel') == 'next']
+        self.assertEqual(len(hrefs), 1)
+        self.assertEqual(parse_qs(urlparse(hrefs[0]).query)['x'], ['a&b'])
+
+    @override_settings(DELETED_BOOKS_RETENTION_DAYS=30)
+    def test_prune_tombstones(self):
+        self.client.login(username='user', password='userpass')
+        self.books[0].delete()
+        self.books[1].delete()
+        models.DeletedBook.objects.filter(
+            a_id=self.books[0].a_id).update(
+            deleted_at=timezone.now() - timedelta(days=31))
+        call_command('prune_tombstones', stdout=StringIO())
+        self.assertEqual(
+            list(models.DeletedBook.objects.values_list('a_id', flat=True)),
+            [str(self.books[1].a_id)])
+
+        # The clients polling from before the retention period must fetch
+        # the whole catalog again.
+        old = (timezone.now() - timedelta(days=31)).isoformat()
+        response = self.client.get(reverse('changes_feed'), {'since': old})
+        self.assertEqual(response.status_code, 410)
+        recent = (timezone.now() - timedelta(days=1)).isoformat()
+        self.assertEqual(len(self._parse(self._get(since=recent))[1]), 1)
+
+    def test_parse_position(self):
+        change = changes.get_changes(limit=1)[0]
+        self.assertEqual(changes.parse_position(change.cursor()), change.key)
+        self.assertRaises(changes.InvalidCursor, changes.parse_position,
+                          'garbage')
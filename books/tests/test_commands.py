@@ -1,4 +1,5 @@
 import filecmp
+import json
 import os
 import tempfile
 import shutil
@@ -8,10 +9,18 @@ from mock import patch
 from django.core.files.storage import FileSystemStorage
 from django.core.management import call_command
 from django.core.management.base import CommandError
-from django.test import TransactionTestCase
+from django.db import OperationalError, connection, transaction
+from django.test import TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.utils.crypto import get_random_string
 
+from books import importer
 from books import models
+from books.storage import content_address
+from books.watcher import Debouncer
+from books.management.commands.addepub import (Command, get_epubs_paths,
+                                                get_staging_dir, parse_epub)
+from books.management.commands.watchepubs import Command as WatchCommand
 import sample_epubs
 
 
@@ -136,6 +145,95 @@ class CommandAddEpubTest(TransactionTestCase):
         self.assertEqual(len(media_books), len(sample_epubs.EPUBS_VALID))
         self.assertEqual(len(media_covers), len(sample_epubs.EPUBS_COVER))
 
+    def test_addepub_jobs(self):
+        """Test the `addepub` command parsing the files in parallel.
+        """
+        src_epubs = [epub.fullpath for epub in sample_epubs.EPUBS_ALL]
+        call_command('addepub', *src_epubs, skip_original_path=True, jobs=2,
+                     batch_size=2)
+
+        media_covers = os.listdir(os.path.join(self.tmp_media_root, 'covers'))
+        self.assertEqual(models.Book.objects.count(),
+                         len(sample_epubs.EPUBS_VALID))
+        for epub in sample_epubs.EPUBS_VALID:
+            book = models.Book.objects.get(book_file__endswith=epub.filename)
+            self.assertEqual(book.original_path, epub.fullpath)
+            self.assertEqual(book.file_sha256sum,
+                             models.sha256_sum(open(epub.fullpath, 'rb')))
+            self.assertEqual(bool(book.cover_img),
+                             epub in sample_epubs.EPUBS_COVER)
+        self.assertEqual(len(media_covers), len(sample_epubs.EPUBS_COVER))
+
+    def test_addepub_batch_queries(self):
+        """Test that the batched import saves the books and their relations
+        as importing them one by one, with a fixed number of queries for each
+        batch.
+        """
+        src_epubs = [epub.fullpath for epub in sample_epubs.EPUBS_VALID]
+        call_command('addepub', *src_epubs)
+        books = models.Book.objects.order_by('pk')
+        expected = [(b.title, b.dc_language_id, bool(b.cover_img),
+                     sorted(a.name for a in b.authors.all()),
+                     sorted(p.name for p in b.publishers.all()),
+                     sorted(t.name for t in b.tags.all())) for b in books]
+        self.assertEqual(len(expected), len(sample_epubs.EPUBS_VALID))
+        self.assertEqual(
+            models.StatusCounter.objects.get(status__status='Published').count,
+            len(expected))
+
+        models.Book.objects.all().delete()
+        command = Command()
+        for filename in src_epubs:
+            command.process_epub(filename)
+        books = models.Book.objects.order_by('pk')
+        self.assertEqual(expected, [
+            (b.title, b.dc_language_id, bool(b.cover_img),
+             sorted(a.name for a in b.authors.all()),
+             sorted(p.name for p in b.publishers.all()),
+             sorted(t.name for t in b.tags.all())) for b in books])
+
+        # Once the related objects exist, the queries do not depend on the
+        # size of the batch: a query for each book would exceed the budget.
+        models.Book.objects.all().delete()
+        batch = [parse_epub(filename, get_staging_dir())
+                 for filename in src_epubs]
+        with transaction.atomic(), \
+                CaptureQueriesContext(connection) as queries:
+            command.import_batch(batch)
+        self.assertEqual(models.Book.objects.count(), len(src_epubs))
+        self.assertLessEqual(len(queries), 25)
+
+    def test_addepub_batch_fallback(self):
+        """Test that the files of a batch that can not be saved at once are
+        imported one by one with the same results.
+        """
+        def summary():
+            return [(b.title, b.dc_language_id, bool(b.cover_img),
+                     sorted(a.name for a in b.authors.all()),
+                     sorted(p.name for p in b.publishers.all()),
+                     sorted(t.name for t in b.tags.all())) for b in
+                    models.Book.objects.order_by('original_path')]
+
+        src_epubs = [epub.fullpath for epub in sample_epubs.EPUBS_VALID]
+        call_command('addepub', *src_epubs)
+        expected = summary()
+        models.Book.objects.all().delete()
+        models.ImportedFile.objects.all().delete()
+
+        save_books = importer.save_books
+
+        def save_single(entries):
+            if len(entries) > 1:
+                raise ValueError('batch failed')
+            save_books(entries)
+
+        with patch('books.importer.save_books', side_effect=save_single):
+            call_command('addepub', *src_epubs)
+        self.assertEqual(summary(), expected)
+        self.assertEqual(
+            len(os.listdir(os.path.join(self.tmp_media_root, 'covers'))),
+            len(sample_epubs.EPUBS_COVER))
+
     def test_addepub_skipping(self):
         """Test the `addepub` `--ignore-original-path` flag.
         """
@@ -158,6 +256,203 @@ class CommandAddEpubTest(TransactionTestCase):
         self.assertEqual(models.Book.objects.count(),
                          len(sample_epubs.EPUBS_VALID))
 
+    def test_addepub_edited_file(self):
+        """Test that a file edited after being imported is not imported
+        again as a new book, by `addepub` nor by `watchepubs`.
+        """
+        src_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, src_dir)
+        for epub in sample_epubs.EPUBS_VALID[:2]:
+            shutil.copy2(epub.fullpath, src_dir)
+        call_command('addepub', src_dir)
+        self.assertEqual(models.Book.objects.count(), 2)
+
+        edited = os.path.join(src_dir, sample_epubs.EPUBS_VALID[0].filename)
+        shutil.copyfile(sample_epubs.EPUBS_VALID[2].fullpath, edited)
+        self.assertEqual(get_epubs_paths([src_dir]), [])
+        WatchCommand().import_ready([edited], {'use_symlink': False,
+                                               'batch_size': 2})
+        self.assertEqual(models.Book.objects.count(), 2)
+        self.assertEqual(
+            models.Book.objects.filter(original_path=edited).count(), 1)
+
+    def test_addepub_manifest(self):
+        """Test that the unchanged files on the import manifest are skipped
+        without querying the books table.
+        """
+        src_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, src_dir)
+        for epub in sample_epubs.EPUBS_VALID:
+            shutil.copy2(epub.fullpath, src_dir)
+        call_command('addepub', src_dir)
+        self.assertEqual(models.ImportedFile.objects.count(),
+                         len(sample_epubs.EPUBS_VALID))
+
+        # Only the manifest is read.
+        with self.assertNumQueries(1):
+            self.assertEqual(get_epubs_paths([src_dir]), [])
+
+        # Modified files are checked again: the touched files with the same
+        # contents are not imported again, and are recorded.
+        path = os.path.join(src_dir, sample_epubs.EPUBS_VALID[0].filename)
+        os.utime(path, (0, 0))
+        self.assertEqual(get_epubs_paths([src_dir]), [])
+        self.assertEqual(models.ImportedFile.objects.get(path=path).mtime, 0)
+        self.assertEqual(models.Book.objects.count(),
+                         len(sample_epubs.EPUBS_VALID))
+
+        # Files imported before the manifest existed are added to it.
+        models.ImportedFile.objects.all().delete()
+        os.utime(path, (1, 1))
+        self.assertEqual(get_epubs_paths([src_dir]), [])
+        self.assertEqual(models.ImportedFile.objects.count(),
+                         len(sample_epubs.EPUBS_VALID))
+        with self.assertNumQueries(1):
+            self.assertEqual(get_epubs_paths([src_dir]), [])
+
+    def test_addepub_hash_once(self):
+        """Test that the files are hashed while they are copied, and that
+        the files on the manifest are not hashed again by `resync`.
+        """
+        src_epubs = [epub.fullpath for epub in sample_epubs.EPUBS_VALID]
+        with patch('books.models.sha256_sum') as mock_sha256, \
+                patch('books.storage.file_sha256') as mock_file_sha256:
+            call_command('addepub', *src_epubs)
+            call_command('resync', *src_epubs)
+        self.assertFalse(mock_sha256.called)
+        self.assertFalse(mock_file_sha256.called)
+
+        for epub in sample_epubs.EPUBS_VALID:
+            book = models.Book.objects.get(book_file__endswith=epub.filename)
+            self.assertEqual(book.file_sha256sum,
+                             models.sha256_sum(open(epub.fullpath, 'rb')))
+        # The copies were moved from the staging directory.
+        self.assertEqual(os.listdir(os.path.join(self.tmp_media_root,
+                                                 '.staging')), [])
+
+    def test_addepub_dry_run_profile(self):
+        """Test that `addepub --dry-run` does not import the files, and the
+        timings reported by `--profile`.
+        """
+        src_epubs = [epub.fullpath for epub in sample_epubs.EPUBS_ALL]
+        profile_path = os.path.join(self.tmp_media_root, 'profile.json')
+        call_command('addepub', *src_epubs, dry_run=True,
+                     profile=profile_path)
+        self.assertEqual(models.Book.objects.count(), 0)
+        self.assertFalse(models.ImportedFile.objects.exists())
+        self.assertEqual(os.listdir(self.tmp_media_root), ['profile.json'])
+
+        with open(profile_path) as f:
+            summary = json.load(f)
+        self.assertTrue(summary['dry_run'])
+        self.assertEqual(summary['counters']['files'], len(src_epubs))
+        for stage in ['walk', 'zip_open', 'opf_parse', 'cover_extract',
+                      'hash', 'db']:
+            self.assertIn(stage, summary['stages'])
+            for key in ['p50_ms', 'p95_ms', 'p99_ms']:
+                self.assertIn(key, summary['stages'][stage])
+        self.assertEqual(summary['stages']['hash']['count'],
+                         len(sample_epubs.EPUBS_VALID))
+
+    def test_addepub_dry_run_manifest(self):
+        """Test that `addepub --dry-run` does not record on the manifest the
+        files of the existing books.
+        """
+        call_command('addepub', sample_epubs.EPUBS_VALID[0].fullpath)
+        # As if imported before the manifest existed.
+        models.ImportedFile.objects.all().delete()
+
+        call_command('addepub', sample_epubs.EPUBS_VALID[0].fullpath,
+                     sample_epubs.EPUBS_VALID[1].fullpath, dry_run=True)
+        self.assertEqual(models.ImportedFile.objects.count(), 0)
+        self.assertEqual(models.Book.objects.count(), 1)
+
+    @override_settings(CONTENT_ADDRESSED_BOOKS=True)
+    def test_addepub_content_addressed(self):
+        """Test the import of the files on the content addressed layout.
+        """
+        epub_a, epub_b = sample_epubs.EPUBS_VALID[:2]
+        call_command('addepub', epub_a.fullpath)
+        call_command('addepub', epub_b.fullpath, use_symlink=True)
+        for epub in [epub_a, epub_b]:
+            book = models.Book.objects.get(original_path=epub.fullpath)
+            self.assertEqual(book.book_file.name, content_address(
+                'books', book.file_sha256sum))
+            self.assertTrue(filecmp.cmp(book.book_file.path, epub.fullpath))
+        self.assertTrue(os.path.islink(book.book_file.path))
+
+    def test_relayout_books(self):
+        """Test moving the existing files to the content addressed layout.
+        """
+        epub_a, epub_b = sample_epubs.EPUBS_VALID[:2]
+        call_command('addepub', epub_a.fullpath)
+        call_command('addepub', epub_b.fullpath, use_symlink=True)
+        names = dict(models.Book.objects.values_list('pk', 'book_file'))
+
+        call_command('relayout_books', dry_run=True)
+        self.assertEqual(
+            names, dict(models.Book.objects.values_list('pk', 'book_file')))
+
+        call_command('relayout_books')
+        for epub in [epub_a, epub_b]:
+            book = models.Book.objects.get(original_path=epub.fullpath)
+            self.assertEqual(book.book_file.name, content_address(
+                'books', book.file_sha256sum))
+            self.assertTrue(filecmp.cmp(book.book_file.path, epub.fullpath))
+            self.assertFalse(os.path.lexists(os.path.join(
+                self.tmp_media_root, names[book.pk])))
+        self.assertTrue(os.path.islink(book.book_file.path))
+
+        # Only the shard directories are left, and running it again does
+        # nothing.
+        call_command('relayout_books')
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(self.tmp_media_root, 'books'))),
+            sorted(set(sha256[:2] for sha256 in models.Book.objects.
+                       values_list('file_sha256sum', flat=True))))
+
+    def test_watchepubs_import(self):
+        """Test the import of the settled files by `watchepubs`.
+        """
+        src_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, src_dir)
+        for epub in sample_epubs.EPUBS_VALID:
+            shutil.copy2(epub.fullpath, src_dir)
+        filenames = sorted(os.path.join(src_dir, epub.filename)
+                           for epub in sample_epubs.EPUBS_VALID)
+        options = {'use_symlink': False, 'batch_size': 2}
+
+        WatchCommand().import_ready(filenames, options)
+        self.assertEqual(models.Book.objects.count(),
+                         len(sample_epubs.EPUBS_VALID))
+
+        # Files reported again without changes are skipped.
+        with self.assertNumQueries(1):
+            WatchCommand().import_ready(filenames, options)
+
+    def test_watchepubs_errors(self):
+        """Test that the files that could not be imported are retried."""
+        src_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, src_dir)
+        shutil.copy2(sample_epubs.EPUBS_VALID[0].fullpath, src_dir)
+        filename = os.path.join(src_dir, sample_epubs.EPUBS_VALID[0].filename)
+        options = {'use_symlink': False, 'batch_size': 2}
+        debouncer = Debouncer(settle=0)
+        debouncer.add([filename])
+        debouncer.ready()
+
+        command = WatchCommand()
+        with patch.object(command, 'import_files',
+                          side_effect=OperationalError('database is locked')):
+            command.import_settled(debouncer, options)
+        self.assertEqual(models.Book.objects.count(), 0)
+        self.assertEqual(len(debouncer), 1)
+
+        debouncer.ready()
+        command.import_settled(debouncer, options)
+        self.assertEqual(models.Book.objects.count(), 1)
+        self.assertEqual(len(debouncer), 0)
+
 
 class CommandResyncTest(TransactionTestCase):
     fixtures = ['initial_data.json']
@@ -199,6 +494,41 @@ class CommandResyncTest(TransactionTestCase):
         print 'Working on %s ...' % new_dir
         return new_dir
 
+    def test_resync_dry_run(self):
+        """Test that `resync --dry-run` does not modify the books.
+        """
+        epub = sample_epubs.EPUBS_VALID[0]
+        call_command('addepub', epub.fullpath)
+        new_source_dir = self._copy_to_newtmp([epub])
+        self.addCleanup(shutil.rmtree, new_source_dir)
+        call_command('resync', new_source_dir, replace_strategy='always-link',
+                     dry_run=True, profile=os.devnull)
+
+        book = models.Book.objects.get()
+        self.assertEqual(book.original_path, epub.fullpath)
+        self.assertFalse(os.path.islink(book.book_file.path))
+
+    def test_resync_batches(self):
+        """Test `resync` hashing the files in parallel, and looking up the
+        books with one query for each batch.
+        """
+        call_command('addepub',
+                     *[epub.fullpath for epub in sample_epubs.EPUBS_VALID])
+        new_source_dir = self._copy_to_newtmp(sample_epubs.EPUBS_VALID)
+        self.addCleanup(shutil.rmtree, new_source_dir)
+        call_command('resync', new_source_dir, jobs=2, batch_size=2)
+        for epub in sample_epubs.EPUBS_VALID:
+            book = models.Book.objects.get(book_file__endswith=epub.filename)
+            self.assertEqual(book.original_path,
+                             os.path.join(new_source_dir, epub.filename))
+
+        with CaptureQueriesContext(connection) as queries:
+            call_command('resync', new_source_dir, dry_run=True,
+                         batch_size=len(sample_epubs.EPUBS_VALID))
+        lookups = [q for q in queries.captured_queries
+                   if '"file_sha256sum" IN' in q['sql']]
+        self.assertEqual(len(lookups), 1)
+
     def test_addepub_nolink(self):
         """Test the `resync` command.
         """
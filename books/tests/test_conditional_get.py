@@ -0,0 +1,63 @@
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.test import TestCase, override_settings
+
+from books import models
+
+
+@override_settings(ALLOW_PUBLIC_BROWSE=True)
+class ConditionalGetTest(TestCase):
+    fixtures = ['initial_data.json']
+
+    def setUp(self):
+        self.book = models.Book.objects.create(
+            title='Book', book_file='books/a.epub', file_sha256sum='a',
+            a_status_id=1)
+
+    def _get(self, url_name, response=None, **kwargs):
+        headers = {}
+        if response is not None:
+            headers['HTTP_IF_NONE_MATCH'] = response['ETag']
+            headers['HTTP_IF_MODIFIED_SINCE'] = response['Last-Modified']
+        return self.client.get(reverse(url_name, kwargs=kwargs), **headers)
+
+    def test_not_modified(self):
+        for url_name in ('root_feed', 'latest_feed', 'tags_feed', 'latest',
+                         'by_title'):
+            response = self._get(url_name)
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.has_header('Last-Modified'))
+            # The listing is not built for answering with 304.
+            with self.assertNumQueries(3):
+                not_modified = self._get(url_name, response)
+            self.assertEqual(not_modified.status_code, 304)
+            self.assertEqual(not_modified.content, b'')
+
+    def test_modified(self):
+        response = self._get('latest_feed')
+        self.book.title = 'Renamed'
+        self.book.save()
+        self.assertEqual(self._get('latest_feed', response).status_code, 200)
+
+        # Deleting a book changes the ETag, even if it was not the newest.
+        other = models.Book.objects.create(
+            title='Other', book_file='books/b.epub', file_sha256sum='b',
+            a_status_id=1)
+        response = self._get('latest_feed')
+        models.Book.objects.filter(pk=self.book.pk).delete()
+        self.assertEqual(self._get('latest_feed', response).status_code, 200)
+
+        # Tags do not change the books, but the version of the catalogs.
+        response = self._get('tags_feed')
+        other.tags.add('poetry')
+        self.assertEqual(self._get('tags_feed', response).status_code, 200)
+
+    def test_etag_varies(self):
+        etags = set([self._get('latest_feed')['ETag'],
+                     self._get('latest')['ETag'],
+                     self.client.get(reverse('latest_feed') +
+                                     '?page=2')['ETag']])
+        User.objects.create_user('user', 'user@example.com', 'userpass')
+        self.client.login(username='user', password='userpass')
+        etags.add(self._get('latest_feed')['ETag'])
+        self.assertEqual(len(etags), 4)
@@ -0,0 +1,56 @@
+from StringIO import StringIO
+
+from django.core.management import call_command
+from django.test import TestCase
+
+from books import counters
+from books import models
+
+
+class StatusCountersTest(TestCase):
+    fixtures = ['initial_data.json']
+
+    def _create_book(self, name, status_id=1):
+        return models.Book.objects.create(
+            title=name, book_file='books/%s.epub' % name,
+            file_sha256sum=name, a_status_id=status_id)
+
+    def test_signals(self):
+        book_a = self._create_book('a')
+        book_b = self._create_book('b')
+        self._create_book('c', status_id=2)
+        self.assertEqual(counters.get_published_counts(), (2, 1))
+
+        # Saving without changing the status keeps the counts.
+        book_a.title = 'A'
+        book_a.save()
+        self.assertEqual(counters.get_published_counts(), (2, 1))
+
+        book_a.a_status_id = 2
+        book_a.save()
+        self.assertEqual(counters.get_published_counts(), (1, 2))
+
+        # Deferred instances are saved without fetching the status.
+        book_b = models.Book.objects.only('title').get(pk=book_b.pk)
+        book_b.title = 'B'
+        book_b.save()
+        self.assertEqual(counters.get_published_counts(), (1, 2))
+
+        models.Book.objects.get(pk=book_a.pk).delete()
+        self.assertEqual(counters.get_published_counts(), (1, 1))
+
+    def test_rebuild(self):
+        self._create_book('a')
+        self._create_book('b', status_id=2)
+        # Queryset updates do not send signals.
+        models.Book.objects.update(a_status_id=2)
+        self.assertEqual(counters.get_published_counts(), (1, 1))
+
+        call_command('rebuild_counters', stdout=StringIO())
+        self.assertEqual(counters.get_published_counts(), (0, 2))
+        self.assertEqual(counters.get_counts(), {1: 0, 2: 2})
+
+    def test_no_count_queries(self):
+        self._create_book('a')
+        with self.assertNumQueries(1):
+            self.assertEqual(counters.get_published_counts(), (1, 0))
@@ -0,0 +1,257 @@
+import os
+import shutil
+import tempfile
+import time
+from StringIO import StringIO
+
+from mock import patch
+import sendfile
+
+from django.contrib.auth.models import User
+from django.core.files.storage import FileSystemStorage
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.db import transaction
+from django.http import HttpResponse
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils.http import http_date
+
+from books import download_cache, downloads
+from books import models
+
+
+@override_settings(ALLOW_PUBLIC_BROWSE=True)
+class DownloadsTest(TestCase):
+    fixtures = ['initial_data.json']
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.log = os.path.join(self.tmp_dir, 'downloads.log')
+        patcher = patch.object(downloads, '_last_flush', [0])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.book_a, self.book_b = [
+            models.Book.objects.create(
+                title=name, book_file='books/%s.epub' % name,
+                file_sha256sum=name, a_status_id=1)
+            for name in ['a', 'b']]
+
+    def _downloads(self, book):
+        return models.Book.objects.get(pk=book.pk).downloads
+
+    @patch('books.views.serve_file', return_value=HttpResponse())
+    def test_download(self, mock_serve_file):
+        a_updated = self.book_a.a_updated
+        url = reverse('book_download', args=[self.book_a.pk])
+        self.client.get(url)
+        self.client.get(url)
+        book = models.Book.objects.get(pk=self.book_a.pk)
+        self.assertEqual(book.downloads, 2)
+        # The catalogs are not modified by a download.
+        self.assertEqual(book.a_updated, a_updated)
+
+    def test_log(self):
+        with override_settings(DOWNLOADS_LOG=self.log,
+                               DOWNLOADS_FLUSH_INTERVAL=3600):
+            # The first download flushes the log.
+            downloads.record(self.book_a.pk)
+            self.assertEqual(self._downloads(self.book_a), 1)
+
+            for book in [self.book_a, self.book_a, self.book_b]:
+                downloads.record(book.pk)
+            self.assertEqual(self._downloads(self.book_a), 1)
+            self.assertEqual(self._downloads(self.book_b), 0)
+
+            # A segment left by an interrupted flush.
+            with open(self.log + '.old.flushing', 'w') as f:
+                f.write('%d\n' % self.book_b.pk)
+
+            call_command('flush_downloads', stdout=StringIO())
+            self.assertEqual(self._downloads(self.book_a), 3)
+            self.assertEqual(self._downloads(self.book_b), 2)
+            self.assertEqual(os.listdir(self.tmp_dir),
+                             ['downloads.log.lock'])
+            self.assertEqual(downloads.flush(), 0)
+
+    def test_log_renamed(self):
+        """Test that the downloads written after the log is renamed go to a
+        new log.
+        """
+        downloads.append(self.log, self.book_a.pk)
+        os.rename(self.log, self.log + '.1' + downloads.SEGMENT_SUFFIX)
+        downloads.append(self.log, self.book_b.pk)
+        with open(self.log) as f:
+            self.assertEqual(f.read(), '%d\n' % self.book_b.pk)
+
+        self.assertEqual(downloads.flush(self.log), 2)
+        self.assertEqual(self._downloads(self.book_a), 1)
+        self.assertEqual(self._downloads(self.book_b), 1)
+
+
+@override_settings(ALLOW_PUBLIC_BROWSE=True,
+                   SENDFILE_BACKEND='sendfile.backends.development')
+class ServeFileTest(TestCase):
+    fixtures = ['initial_data.json']
+
+    def setUp(self):
+        self.tmp_media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_media_root)
+        # See CommandAddEpubTest.
+        path_patcher = patch.object(
+            FileSystemStorage, 'path',
+            lambda instance, name: os.path.join(self.tmp_media_root, name))
+        path_patcher.start()
+        self.addCleanup(path_patcher.stop)
+
+        self.data = b''.join(chr(i % 256) for i in range(100000))
+        os.mkdir(os.path.join(self.tmp_media_root, 'books'))
+        with open(os.path.join(self.tmp_media_root, 'books/a.epub'),
+                  'wb') as f:
+            f.write(self.data)
+        self.book = models.Book.objects.create(
+            title='a', book_file='books/a.epub', file_sha256sum='abc',
+            a_status_id=1)
+        self.url = reverse('book_download', args=[self.book.pk])
+
+    def _downloads(self):
+        return models.Book.objects.get(pk=self.book.pk).downloads
+
+    def test_full(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.data)
+        self.assertEqual(response['Content-Length'], str(len(self.data)))
+        self.assertEqual(response['ETag'], '"abc"')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(response['Content-Type'], 'application/epub+zip')
+        self.assertEqual(response['Content-Disposition'],
+                         'attachment; filename="a.epub"')
+        self.assertEqual(self._downloads(), 1)
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH='"abc"')
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(self._downloads(), 1)
+
+    def test_range(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=0-99')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content),
+                         self.data[:100])
+        self.assertEqual(response['Content-Range'], 'bytes 0-99/100000')
+        self.assertEqual(response['Content-Length'], '100')
+        self.assertEqual(self._downloads(), 1)
+
+        # Resuming the download does not count it again.
+        response = self.client.get(self.url, HTTP_RANGE='bytes=100-',
+                                   HTTP_IF_RANGE='"abc"')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(b''.join(response.streaming_content),
+                         self.data[100:])
+        self.assertEqual(response['Content-Range'],
+                         'bytes 100-99999/100000')
+        self.assertEqual(self._downloads(), 1)
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=-10')
+        self.assertEqual(b''.join(response.streaming_content),
+                         self.data[-10:])
+
+        # The file changed: the whole file is sent.
+        response = self.client.get(self.url, HTTP_RANGE='bytes=100-',
+                                   HTTP_IF_RANGE='"other"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self._downloads(), 2)
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=100000-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */100000')
+
+        # The invalid ranges are ignored.
+        response = self.client.get(self.url, HTTP_RANGE='bytes=5-3')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.data)
+
+        # The dates of If-Range must match exactly.
+        mtime = os.path.getmtime(os.path.join(self.tmp_media_root,
+                                              'books/a.epub'))
+        response = self.client.get(self.url, HTTP_RANGE='bytes=100-',
+                                   HTTP_IF_RANGE=http_date(mtime))
+        self.assertEqual(response.status_code, 206)
+        response = self.client.get(self.url, HTTP_RANGE='bytes=100-',
+                                   HTTP_IF_RANGE=http_date(mtime + 60))
+        self.assertEqual(response.status_code, 200)
+
+    def test_cached(self):
+        log = os.path.join(self.tmp_media_root, 'downloads.log')
+        with override_settings(DOWNLOADS_LOG=log,
+                               DOWNLOADS_FLUSH_INTERVAL=3600), \
+                patch.object(downloads, '_last_flush', [time.time()]):
+            self.client.get(self.url)
+            with self.assertNumQueries(0):
+                response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['ETag'], '"abc"')
+
+        # The cache is updated when the book is saved.
+        self.book.file_sha256sum = 'def'
+        self.book.save()
+        response = self.client.get(self.url)
+        self.assertEqual(response['ETag'], '"def"')
+
+        # The unpublished books can only be downloaded by the logged in
+        # users.
+        self.book.a_status_id = 2
+        self.book.save()
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+        User.objects.create_user('user', 'user@example.com', 'userpass')
+        self.client.login(username='user', password='userpass')
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+
+    def test_nginx(self):
+        # django-sendfile caches the backend.
+        sendfile._get_sendfile.clear()
+        self.addCleanup(sendfile._get_sendfile.clear)
+        with override_settings(SENDFILE_BACKEND='sendfile.backends.nginx',
+                               SENDFILE_ROOT=self.tmp_media_root,
+                               SENDFILE_URL='/protected'):
+            response = self.client.get(self.url, HTTP_RANGE='bytes=100-')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b'')
+        self.assertEqual(response['X-Accel-Redirect'],
+                         '/protected/books/a.epub')
+        self.assertEqual(response['ETag'], '"abc"')
+        # The download is resumed by nginx.
+        self.assertEqual(self._downloads(), 0)
+
+
+class DownloadCacheTest(TransactionTestCase):
+    fixtures = ['initial_data.json']
+
+    def setUp(self):
+        self.tmp_media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_media_root)
+        # See CommandAddEpubTest.
+        path_patcher = patch.object(
+            FileSystemStorage, 'path',
+            lambda instance, name: os.path.join(self.tmp_media_root, name))
+        path_patcher.start()
+        self.addCleanup(path_patcher.stop)
+        self.addCleanup(download_cache.local_cache.clear)
+
+        os.mkdir(os.path.join(self.tmp_media_root, 'books'))
+        open(os.path.join(self.tmp_media_root, 'books/a.epub'), 'wb').close()
+        self.book = models.Book.objects.create(
+            title='a', book_file='books/a.epub', file_sha256sum='abc',
+            a_status_id=1)
+
+    def test_invalidate_on_commit(self):
+        self.assertTrue(download_cache.get_info(self.book.pk).published)
+        with transaction.atomic():
+            self.book.a_status_id = 2
+            self.book.save()
+            # A download served before the commit caches the old row.
+            download_cache.local_cache.set(
+                download_cache._cache_key(self.book.pk),
+                download_cache.load_info(self.book.pk)._replace(
+                    published=True))
+        self.assertFalse(download_cache.get_info(self.book.pk).published)
@@ -0,0 +1,98 @@
+from io import BytesIO
+import os
+
+from django.test import SimpleTestCase
+
+from books.epub import Epub
+from books.epubinfo import EpubInfo
+from books.management.commands.benchmark_epubinfo import (
+    current_epub_info, legacy_epub_info, read_opf)
+import sample_epubs
+
+OPF = b"""<?xml version="1.0"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="2.0">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+    <dc-metadata>
+      <dc:title>Nested title</dc:title>
+      <dc:creator>First</dc:creator>
+    </dc-metadata>
+    <dc:creator>Second</dc:creator>
+    <dc:identifier id="uid">urn:isbn:123</dc:identifier>
+    <meta name="cover" content="cover-jpg"/>
+  </metadata>
+  <manifest>
+    <item id="toc" href="toc.ncx" media-type="application/x-dtbncx+xml"/>
+    <item id="cover" href="cover.xhtml" media-type="application/xhtml+xml"/>
+    <item id="cover-jpg" href="images/cover.jpg" media-type="image/jpeg"/>
+  </manifest>
+  <spine toc="toc"><itemref idref="cover"/></spine>
+  <guide>
+    <reference type="toc" href="toc.xhtml"/>
+  </guide>
+</package>
+"""
+
+
+class EpubCoverTest(SimpleTestCase):
+    def _open(self, epub):
+        epub = Epub(epub.fullpath)
+        self.addCleanup(epub.close)
+        return epub
+
+    def test_in_memory(self):
+        for sample in sample_epubs.EPUBS_VALID:
+            epub = self._open(sample)
+            info, cover, _ = epub.as_model_dict(in_memory=True)
+            self.assertTrue(info['title'])
+            # Nothing is extracted to disk.
+            self.assertIsNone(epub._tempdir)
+            if sample not in sample_epubs.EPUBS_COVER:
+                self.assertIsNone(cover)
+                continue
+
+            self.assertIsNone(cover.path)
+            with open(epub.get_cover_image_path(), 'rb') as f:
+                self.assertEqual(cover.data, f.read())
+            self.assertEqual(cover.open().read(), cover.data)
+
+    def test_disk_fallback(self):
+        for sample in sample_epubs.EPUBS_COVER:
+            epub = self._open(sample)
+            cover = epub.get_cover_image(max_size=0)
+            self.assertIsNone(cover.data)
+            self.assertTrue(os.path.isfile(cover.path))
+
+            # The temporary file outlives the Epub.
+            epub.close()
+            with open(cover.path, 'rb') as f:
+                self.assertEqual(f.read(), cover.open().read())
+            path = cover.path
+            cover.delete()
+            self.assertFalse(os.path.exists(path))
+
+
+class EpubInfoTest(SimpleTestCase):
+    def test_parse(self):
+        info = EpubInfo(BytesIO(OPF))
+        self.assertEqual(info.title, 'Nested title')
+        self.assertEqual(info.creators, ['First', 'Second'])
+        self.assertEqual(info.publishers, [])
+        self.assertIsNone(info.summary)
+        self.assertEqual(info.identifier,
+                         {'id': 'uid', 'value': 'urn:isbn:123'})
+        # The meta element takes precedence over the "cover" item.
+        self.assertEqual(info.cover_image, 'images/cover.jpg')
+        self.assertEqual(info.get_item(info.toc_id)['href'], 'toc.ncx')
+        self.assertEqual(len(info.manifest), 3)
+        self.assertEqual(info.guide, [{'type': 'toc', 'href': 'toc.xhtml'}])
+
+    def test_same_as_legacy(self):
+        for sample in sample_epubs.EPUBS_VALID:
+            opf_data = read_opf(sample.fullpath)
+            self.assertEqual(current_epub_info(opf_data),
+                             legacy_epub_info(opf_data))
+
+    def test_ncx_path(self):
+        epub = Epub(sample_epubs.EPUBS_ALL[1].fullpath)
+        self.addCleanup(epub.close)
+        self.assertEqual(epub._ncx_path, 'EPUB/nav.ncx')
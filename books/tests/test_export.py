@@ -0,0 +1,95 @@
+import gzip
+import json
+import os
+import shutil
+import tempfile
+from StringIO import StringIO
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.test import TestCase
+from django.utils import timezone
+from lxml import etree
+
+from books import export
+from books import models
+
+
+def gunzip(data):
+    return gzip.GzipFile(fileobj=StringIO(data)).read()
+
+
+class ExportTest(TestCase):
+    fixtures = ['initial_data.json']
+
+    def setUp(self):
+        for i in range(5):
+            book = models.Book.objects.create(
+                title='Book %s' % i, book_file='books/%s.epub' % i,
+                file_sha256sum='%s' % i, a_status_id=1 if i else 2)
+            book.authors.add(models.Author.objects.create(name='A%s' % i))
+            book.tags.add('tag%s' % i)
+        self.user = User.objects.create_user('user', 'user@example.com',
+                                             'userpass')
+
+    def _get(self, fmt, **params):
+        self.client.login(username='user', password='userpass')
+        response = self.client.get(reverse('export_catalog',
+                                           kwargs={'fmt': fmt}), params)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        return gunzip(response.getvalue())
+
+    def test_login_required(self):
+        response = self.client.get(reverse('export_catalog',
+                                           kwargs={'fmt': 'jsonl'}))
+        self.assertEqual(response.status_code, 302)
+
+    def test_jsonl(self):
+        books = [json.loads(line) for line in
+                 self._get('jsonl').splitlines()]
+        self.assertEqual([b['title'] for b in books],
+                         ['Book 1', 'Book 2', 'Book 3', 'Book 4'])
+        self.assertEqual(books[0]['authors'], ['A1'])
+        self.assertEqual(books[0]['tags'], ['tag1'])
+
+        # Only staff users can export the unpublished books.
+        self.assertEqual(len(self._get('jsonl', all=1).splitlines()), 4)
+        self.user.is_staff = True
+        self.user.save()
+        self.assertEqual(len(self._get('jsonl', all=1).splitlines()), 5)
+
+    def test_atom(self):
+        feed = etree.fromstring(self._get('atom'))
+        entries = feed.findall('{http://www.w3.org/2005/Atom}entry')
+        self.assertEqual(len(entries), 4)
+
+    def test_since(self):
+        since = timezone.now()
+        book = models.Book.objects.get(title='Book 3')
+        book.save()
+        books = self._get('jsonl', since=since.isoformat()).splitlines()
+        self.assertEqual([json.loads(b)['title'] for b in books], ['Book 3'])
+
+        self.client.login(username='user', password='userpass')
+        response = self.client.get(reverse('export_catalog',
+                                           kwargs={'fmt': 'jsonl'}),
+                                   {'since': 'yesterday'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_chunks(self):
+        books = export.export_queryset()
+        # One query for the books, and one for each relation and chunk.
+        with self.assertNumQueries(1 + 3 * 2):
+            self.assertEqual(len(list(export.iter_books(books, 2))), 4)
+
+    def test_command(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'catalog.jsonl.gz')
+            call_command('export_catalog', path, format='jsonl', all=True)
+            with open(path, 'rb') as f:
+                self.assertEqual(len(gunzip(f.read()).splitlines()), 5)
+        finally:
+            shutil.rmtree(tmpdir)
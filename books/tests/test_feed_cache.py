@@ -0,0 +1,103 @@
+import shutil
+import tempfile
+
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from books import models
+
+
+@override_settings(ALLOW_PUBLIC_BROWSE=True)
+class FeedCacheTest(TestCase):
+    fixtures = ['initial_data.json']
+
+    def setUp(self):
+        caches['feeds'].clear()
+        self.book = models.Book.objects.create(
+            title='Published book', book_file='books/a.epub',
+            file_sha256sum='a', a_status_id=1)
+        models.Book.objects.create(
+            title='Draft book', book_file='books/b.epub',
+            file_sha256sum='b', a_status_id=2)
+
+    def test_cached(self):
+        # Streamed catalogs are stored once they have been sent.
+        content = self.client.get(reverse('latest_feed')).getvalue()
+        # Only the freshness check of the conditional GET is run.
+        with self.assertNumQueries(3):
+            cached = self.client.get(reverse('latest_feed'))
+        self.assertEqual(cached.getvalue(), content)
+        self.assertEqual(cached['Content-Type'], 'application/atom+xml')
+
+        # The query string is part of the key.
+        self.assertNotEqual(self.client.get(reverse('latest_feed') +
+                                            '?q=nothing').getvalue(),
+                            content)
+
+    @override_settings(FEED_CACHE_MAX_SIZE=100)
+    def test_too_big(self):
+        self.client.get(reverse('latest_feed')).getvalue()
+        # The catalog was not stored, and is built again.
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get(reverse('latest_feed')).getvalue()
+        self.assertGreater(len(ctx.captured_queries), 2)
+
+    def test_invalidation(self):
+        self.client.get(reverse('latest_feed'))
+        self.client.get(reverse('tags_feed'))
+
+        self.book.title = 'Renamed book'
+        self.book.save()
+        self.assertIn(b'Renamed book',
+                      self.client.get(reverse('latest_feed')).getvalue())
+
+        self.book.tags.add('poetry')
+        self.assertIn(b'poetry', self.client.get(reverse('tags_feed')).getvalue())
+
+        self.book.authors.add(models.Author.objects.create(name='Someone'))
+        self.assertIn(b'Someone',
+                      self.client.get(reverse('latest_feed')).getvalue())
+
+    def test_other_process(self):
+        """Test that the catalogs are invalidated by the changes made by
+        other processes, which only replace the version on the database.
+        """
+        self.client.get(reverse('latest_feed')).getvalue()
+        models.Book.objects.filter(pk=self.book.pk).update(title='Renamed')
+        models.CatalogVersion.objects.update(version='other')
+        self.assertIn(b'Renamed',
+                      self.client.get(reverse('latest_feed')).getvalue())
+
+    def test_auth_state(self):
+        self.assertNotIn(b'Draft book',
+                         self.client.get(reverse('latest_feed')).getvalue())
+        User.objects.create_user('user', 'user@example.com', 'userpass')
+        self.client.login(username='user', password='userpass')
+        self.assertIn(b'Draft book',
+                      self.client.get(reverse('latest_feed')).getvalue())
+
+
+@override_settings(ALLOW_PUBLIC_BROWSE=True)
+class FileFeedCacheTest(FeedCacheTest):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.settings_override = override_settings(CACHES={
+            'default': {
+                'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            },
+            'feeds': {
+                'BACKEND':
+                    'django.core.cache.backends.filebased.FileBasedCache',
+                'LOCATION': self.cache_dir,
+            },
+        })
+        self.settings_override.enable()
+        super(FileFeedCacheTest, self).setUp()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.cache_dir)
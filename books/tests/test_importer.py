@@ -0,0 +1,68 @@
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from books import counters
+from books import importer
+from books import models
+from books.search_index import get_search_backend
+from books.search_query import parse
+
+
+@override_settings(FEED_CACHE=None)
+class SaveBooksTest(TestCase):
+    fixtures = ['initial_data.json']
+
+    def _entries(self, prefix, count):
+        entries = []
+        for i in range(count):
+            name = '%s%s' % (prefix, i)
+            book = models.Book(title='Book %s' % name,
+                               book_file='books/%s.epub' % name,
+                               file_sha256sum=name, a_status_id=1)
+            entries.append(importer.BookEntry(
+                book, authors=['Author %s' % name, 'Shared Author'],
+                publishers=['Publisher %s' % name],
+                tags=['tag %s' % name, 'shared']))
+        return entries
+
+    def test_save_books(self):
+        models.Author.objects.create(name='Shared Author')
+        importer.save_books(self._entries('a', 3))
+
+        book = models.Book.objects.get(title='Book a1')
+        self.assertEqual(sorted(a.name for a in book.authors.all()),
+                         ['Author a1', 'Shared Author'])
+        self.assertEqual([p.name for p in book.publishers.all()],
+                         ['Publisher a1'])
+        self.assertEqual(sorted(t.name for t in book.tags.all()),
+                         ['shared', 'tag a1'])
+        self.assertTrue(book.a_id)
+        self.assertEqual(models.Author.objects.count(), 4)
+        self.assertEqual(counters.get_published_counts(), (3, 0))
+
+        # The books are indexed.
+        books = get_search_backend().search(models.Book.objects.all(),
+                                            parse('a1'))
+        self.assertEqual([b.pk for b in books], [book.pk])
+
+    def test_constant_queries(self):
+        # Create the shared relations and the counters first.
+        importer.save_books(self._entries('w', 1))
+        with CaptureQueriesContext(connection) as few:
+            importer.save_books(self._entries('a', 2))
+        with CaptureQueriesContext(connection) as many:
+            importer.save_books(self._entries('b', 20))
+        self.assertEqual(len(few), len(many))
+
+    def test_tag_slug_conflict(self):
+        models.Book.objects.create(title='Existing',
+                                   book_file='books/existing.epub',
+                                   file_sha256sum='existing', a_status_id=1).\
+            tags.add('Fiction')
+        entries = self._entries('a', 1)
+        entries[0].tags = ['fiction', 'new tag']
+        importer.save_books(entries)
+        book = models.Book.objects.get(title='Book a0')
+        self.assertEqual(sorted(t.name for t in book.tags.all()),
+                         ['Fiction', 'new tag'])
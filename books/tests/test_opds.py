@@ -0,0 +1,54 @@
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.test import RequestFactory, TestCase
+from pure_pagination import Paginator
+
+from books import models
+from books.opds import generate_catalog, stream_catalog
+from books.pagination import KeysetPaginator
+
+
+class StreamCatalogTest(TestCase):
+    fixtures = ['initial_data.json']
+
+    def setUp(self):
+        self.request = RequestFactory().get('/latest.atom', {'page': '2'})
+        language = models.Language.objects.create(code='en', label='English',
+                                                  long_name='English')
+        for i in range(7):
+            book = models.Book.objects.create(
+                title='Book <%s> & co' % i, summary=u'Summ\xe1ry %s' % i,
+                book_file='books/%s.epub' % i, file_sha256sum='%s' % i,
+                a_status_id=1, dc_language=language, dc_identifier='id%s' % i)
+            book.authors.add(models.Author.objects.create(name='A%s' % i))
+            book.publishers.add(models.Publisher.objects.create(name='P%s' % i))
+        self.queryset = models.Book.objects.select_related(
+            'dc_language').prefetch_related('authors', 'publishers')
+
+    def test_identical_output(self):
+        page_obj = Paginator(self.queryset, 5).page(1)
+        chunks = list(stream_catalog(self.request, page_obj, chunk_size=2))
+        # The header, and one chunk per entry (the last one including the
+        # closing tag).
+        self.assertEqual(len(chunks), 1 + 5)
+        self.assertEqual(b''.join(chunks),
+                         generate_catalog(self.request, page_obj))
+
+        page_obj = KeysetPaginator(self.queryset, 5,
+                                   ['-time_added', '-pk']).page()
+        self.assertEqual(b''.join(stream_catalog(self.request, page_obj)),
+                         generate_catalog(self.request, page_obj))
+
+    def test_chunked_queries(self):
+        page_obj = Paginator(self.queryset, 7).page(1)
+        # The updated date, and 3 queries (books, authors, publishers) for
+        # each chunk.
+        with self.assertNumQueries(1 + 3 * 3):
+            list(stream_catalog(self.request, page_obj, chunk_size=3))
+
+    def test_search_catalog(self):
+        User.objects.create_user('user', 'user@example.com', 'userpass')
+        self.client.login(username='user', password='userpass')
+        response = self.client.get(reverse('latest_feed'), {'q': 'summ*'})
+        self.assertTrue(response.streaming)
+        self.assertEqual(response.getvalue().count(b'<entry>'), 7)
@@ -0,0 +1,97 @@
+import re
+
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from books import models
+from books.pagination import NEXT, encode_cursor
+
+LINK_RE = re.compile(r'<link [^>]*href="([^"]*)"[^>]*rel="(next|previous)"')
+
+
+@override_settings(BOOKS_PER_PAGE=3, FEED_CACHE=None)
+class KeysetPaginationTest(TestCase):
+    fixtures = ['initial_data.json']
+
+    def setUp(self):
+        User.objects.create_user('user', 'user@example.com', 'userpass')
+        self.client.login(username='user', password='userpass')
+
+        # Repeated titles and download counts, for checking the pk is used
+        # as tie-breaker.
+        for i in range(10):
+            models.Book.objects.create(
+                title='Book %s' % (i // 2), book_file='books/%s.epub' % i,
+                file_sha256sum='%s' % i, a_status_id=1, downloads=i % 3)
+
+    def _get(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        content = response.getvalue().decode('utf-8')
+        links = dict((rel, href.replace('&amp;', '&'))
+                     for href, rel in LINK_RE.findall(content))
+        ids = re.findall(r'<id>([0-9a-f-]{36})</id>', content)
+        return ids, links
+
+    def _crawl(self, url_name):
+        url = reverse(url_name)
+        pages = []
+        ids, links = self._get(url)
+        pages.append(ids)
+        self.assertNotIn('previous', links)
+        while 'next' in links:
+            ids, links = self._get(url + links['next'])
+            pages.append(ids)
+
+        # Going back returns the same pages.
+        for expected in reversed(pages[:-1]):
+            ids, links = self._get(url + links['previous'])
+            self.assertEqual(ids, expected)
+        self.assertNotIn('previous', links)
+        return sum(pages, [])
+
+    def _expected(self, *ordering):
+        return ['%s' % a_id for a_id in models.Book.objects.
+                order_by(*ordering).values_list('a_id', flat=True)]
+
+    def test_feeds(self):
+        self.assertEqual(self._crawl('latest_feed'),
+                         self._expected('-time_added', '-pk'))
+        self.assertEqual(self._crawl('by_title_feed'),
+                         self._expected('title', 'pk'))
+        self.assertEqual(self._crawl('most_downloaded_feed'),
+                         self._expected('-downloads', '-pk'))
+
+    def test_no_count(self):
+        self.client.get(reverse('latest_feed'))
+        _, links = self._get(reverse('latest_feed'))
+        with CaptureQueriesContext(connection) as ctx:
+            self._get(reverse('latest_feed') + links['next'])
+        self.assertFalse([q for q in ctx.captured_queries
+                          if 'COUNT(' in q['sql'].upper()])
+
+    def test_invalid_cursor(self):
+        first, _ = self._get(reverse('latest_feed'))
+        ids, _ = self._get(reverse('latest_feed') + '?cursor=foo')
+        self.assertEqual(ids, first)
+
+        # Null values can not be compared with the key fields.
+        for url_name in ['latest_feed', 'most_downloaded_feed']:
+            cursor = encode_cursor(NEXT, [None, None])
+            ids, _ = self._get('%s?cursor=%s' % (reverse(url_name), cursor))
+            self.assertEqual(ids, self._get(reverse(url_name))[0])
+
+    def test_cursor_qstring(self):
+        """Test that the other parameters are kept escaped on the links."""
+        _, links = self._get(reverse('latest_feed') + '?x=a%26b')
+        self.assertIn('x=a%26b', links['next'])
+        self.assertNotIn('x=a&b', links['next'])
+
+    def test_page_numbers(self):
+        # The page number mode is kept for existing links.
+        ids, links = self._get(reverse('latest_feed') + '?page=2')
+        self.assertEqual(ids, self._expected('-time_added', '-pk')[3:6])
+        self.assertIn('page=3', links['next'])
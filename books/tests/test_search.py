@@ -0,0 +1,195 @@
+from mock import patch
+
+from django.test import TestCase
+
+from books import models
+from books import search_index
+from books.search import advanced_search, simple_search
+from books.search_query import And, Not, Or, Term, optimize, parse
+
+
+class QueryParserTest(TestCase):
+    def _parse(self, text, fields=None):
+        return optimize(parse(text, fields))
+
+    def test_terms(self):
+        self.assertEqual(self._parse('verne'),
+                         Term('verne', None, False, False))
+        self.assertEqual(self._parse('jules verne'),
+                         And([Term('jules', None, False, False),
+                              Term('verne', None, False, False)]))
+        self.assertEqual(self._parse('"jules verne" leag*'),
+                         And([Term('jules verne', None, True, False),
+                              Term('leag', None, False, True)]))
+        self.assertEqual(self._parse('verne', ['title']),
+                         Term('verne', ('title',), False, False))
+
+    def test_prefix_words(self):
+        self.assertEqual(optimize(parse('leag "jules verne" x*', None, True)),
+                         And([Term('leag', None, False, True),
+                              Term('jules verne', None, True, False),
+                              Term('x', None, False, True)]))
+
+    def test_fields(self):
+        self.assertEqual(self._parse('author:"jules verne"'),
+                         Term('jules verne', ('authors',), True, False))
+        self.assertEqual(self._parse('title:(a OR b)'),
+                         Or([Term('a', ('title',), False, False),
+                             Term('b', ('title',), False, False)]))
+        # Unknown and escaped keys are regular words.
+        self.assertEqual(self._parse('foo:bar'),
+                         Term('foo:bar', None, False, False))
+        self.assertEqual(self._parse('title\\:bar'),
+                         Term('title:bar', None, False, False))
+
+    def test_operators(self):
+        a, b, c = [Term(t, None, False, False) for t in 'abc']
+        self.assertEqual(self._parse('a OR b c'), Or([a, And([b, c])]))
+        self.assertEqual(self._parse('(a OR b) AND c'), And([Or([a, b]), c]))
+        self.assertEqual(self._parse('NOT a b'), And([b, Not(a)]))
+        self.assertEqual(self._parse('-a NOT NOT b'), And([b, Not(a)]))
+        self.assertEqual(self._parse('a AND (b AND c) a'), And([a, b, c]))
+        # Lowercase and escaped operators are words.
+        self.assertEqual(self._parse('a or \\OR'),
+                         And([a, Term('or', None, False, False),
+                              Term('OR', None, False, False)]))
+
+    def test_malformed(self):
+        a, b = [Term(t, None, False, False) for t in 'ab']
+        self.assertEqual(self._parse(''), None)
+        self.assertEqual(self._parse('AND OR NOT'), None)
+        self.assertEqual(self._parse(') a ((b'), And([a, b]))
+        self.assertEqual(self._parse('a OR'), a)
+        self.assertEqual(self._parse('"a'), Term('a', None, True, False))
+        self.assertEqual(self._parse('title: -- !'), None)
+
+
+class SearchIndexTestMixin(object):
+    """Tests common to all the search backends. Subclasses should define
+    `backend` with the backend instance to be tested.
+    """
+    fixtures = ['initial_data.json']
+
+    def setUp(self):
+        self.backend_patcher = patch.object(search_index, '_backend',
+                                            self.backend)
+        self.backend_patcher.start()
+
+        self.author = models.Author.objects.create(name='Jules Verne')
+        self.publisher = models.Publisher.objects.create(name='Hetzel')
+        self.book_a = self._create_book('Twenty Thousand Leagues',
+                                        'An underwater voyage.')
+        self.book_a.authors.add(self.author)
+        self.book_a.publishers.add(self.publisher)
+        self.book_b = self._create_book('Around the World in Eighty Days',
+                                        'A voyage around the world.')
+        self.book_b.authors.add(self.author)
+        self.book_c = self._create_book('The Time Machine',
+                                        'Eighty thousand years later.')
+
+    def tearDown(self):
+        self.backend_patcher.stop()
+
+    def _create_book(self, title, summary):
+        return models.Book.objects.create(
+            title=title, summary=summary, book_file='books/%s.epub' % title,
+            file_sha256sum=title, a_status_id=1)
+
+    def _search(self, func, *args):
+        return set(func(models.Book.objects.all(), *args))
+
+    def test_advanced_search(self):
+        self.assertEqual(self._search(advanced_search, 'voyage'),
+                         {self.book_a, self.book_b})
+        self.assertEqual(self._search(advanced_search, 'eighty'),
+                         {self.book_b, self.book_c})
+        self.assertEqual(self._search(advanced_search, 'thousand verne'),
+                         {self.book_a})
+        self.assertEqual(self._search(advanced_search, 'title:eighty'),
+                         {self.book_b})
+        self.assertEqual(
+            self._search(advanced_search, 'author:verne AND publisher:hetzel'),
+            {self.book_a})
+        self.assertEqual(self._search(advanced_search, 'nothing'), set())
+
+    def test_query_syntax(self):
+        self.assertEqual(self._search(advanced_search, 'leagues OR time'),
+                         {self.book_a, self.book_c})
+        self.assertEqual(self._search(advanced_search, 'eighty -time'),
+                         {self.book_b})
+        self.assertEqual(self._search(advanced_search, 'NOT verne'),
+                         {self.book_c})
+        self.assertEqual(self._search(advanced_search, 'leag* OR NOT eighty'),
+                         {self.book_a})
+        self.assertEqual(self._search(advanced_search, '"eighty days"'),
+                         {self.book_b})
+        self.assertEqual(self._search(advanced_search, 'author:(jules OR x) '
+                                                       'title:around'),
+                         {self.book_b})
+
+    def test_simple_search(self):
+        self.assertEqual(self._search(simple_search, 'verne', True, False),
+                         set())
+        self.assertEqual(self._search(simple_search, 'verne', False, True),
+                         {self.book_a, self.book_b})
+        self.assertEqual(self._search(simple_search, 'time', True, True),
+                         {self.book_c})
+
+    def test_partial_words(self):
+        """Test that the words match the terms starting with them, as the
+        icontains search did, but the phrases only match whole terms.
+        """
+        self.assertEqual(self._search(advanced_search, 'leag'),
+                         {self.book_a})
+        self.assertEqual(self._search(advanced_search, 'thou vern'),
+                         {self.book_a})
+        self.assertEqual(self._search(advanced_search, '"leag"'), set())
+        self.assertEqual(self._search(simple_search, 'eigh', True, False),
+                         {self.book_b})
+        self.assertEqual(self._search(simple_search, 'vern', False, True),
+                         {self.book_a, self.book_b})
+
+    def test_ranking(self):
+        # A match on the title is more relevant than a match on the summary.
+        results = list(advanced_search(models.Book.objects.all(), 'world'))
+        self.assertEqual(results[0], self.book_b)
+        results = list(advanced_search(models.Book.objects.all(), 'time'))
+        self.assertEqual(results, [self.book_c])
+
+    def test_index_updates(self):
+        # Renaming an author reindexes the books.
+        self.author.name = 'Gabriel Verne'
+        self.author.save()
+        self.assertEqual(self._search(advanced_search, 'gabriel'),
+                         {self.book_a, self.book_b})
+
+        # Removing the m2m relation reindexes the book.
+        self.book_b.authors.remove(self.author)
+        self.assertEqual(self._search(advanced_search, 'gabriel'),
+                         {self.book_a})
+
+        # Deleting a publisher reindexes the books.
+        self.publisher.delete()
+        self.assertEqual(self._search(advanced_search, 'hetzel'), set())
+
+        # Deleting a book removes it from the index.
+        self.book_a.delete()
+        self.assertEqual(self._search(advanced_search, 'gabriel'), set())
+
+    def test_rebuild(self):
+        self.backend.rebuild()
+        self.assertEqual(self._search(advanced_search, 'voyage'),
+                         {self.book_a, self.book_b})
+
+
+class SQLiteFTSBackendTest(SearchIndexTestMixin, TestCase):
+    backend = search_index.SQLiteFTSBackend()
+
+    def setUp(self):
+        if not self.backend.is_available():
+            self.skipTest('SQLite FTS5 is not available')
+        super(SQLiteFTSBackendTest, self).setUp()
+
+
+class InvertedIndexBackendTest(SearchIndexTestMixin, TestCase):
+    backend = search_index.InvertedIndexBackend()
@@ -0,0 +1,133 @@
+import os
+import shutil
+import tempfile
+
+from mock import patch
+
+from django.contrib.auth.models import User
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.core.urlresolvers import reverse
+from django.test import TestCase, override_settings
+
+from books import models
+from books import storage
+import sample_epubs
+
+
+class HashingStorageTest(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.epub = sample_epubs.EPUBS_VALID[0].fullpath
+        with open(self.epub, 'rb') as f:
+            self.sha256 = models.sha256_sum(f)
+
+    def test_stage_file(self):
+        path, sha256 = storage.stage_file(
+            self.epub, os.path.join(self.tmp_dir, 'staging'))
+        self.assertEqual(sha256, self.sha256)
+        with open(path, 'rb') as f, open(self.epub, 'rb') as g:
+            self.assertEqual(f.read(), g.read())
+
+        # The copy is moved by the storage.
+        fs = FileSystemStorage(location=self.tmp_dir)
+        name = fs.save('books/book.epub', storage.StagedFile(path))
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(storage.file_sha256(fs.path(name)), self.sha256)
+
+    def test_digest_cache(self):
+        filename = os.path.join(self.tmp_dir, 'book.epub')
+        shutil.copy2(self.epub, filename)
+        cache = storage.DigestCache()
+        with patch('books.storage.file_sha256',
+                   wraps=storage.file_sha256) as mock_sha256:
+            self.assertEqual(cache.sha256(filename), self.sha256)
+            self.assertEqual(cache.sha256(filename), self.sha256)
+            self.assertEqual(mock_sha256.call_count, 1)
+
+            # A changed file is hashed again.
+            with open(filename, 'ab') as f:
+                f.write(b'\0')
+            self.assertNotEqual(cache.sha256(filename), self.sha256)
+            self.assertEqual(mock_sha256.call_count, 2)
+
+        cache = storage.DigestCache(max_entries=1)
+        cache.add(filename, 'a')
+        cache.add(self.epub, 'b')
+        self.assertIsNone(cache.get(filename))
+        self.assertEqual(cache.get(self.epub), 'b')
+
+    def test_content_addressed(self):
+        fs = storage.LinkOrFileSystemStorage(location=self.tmp_dir)
+        name = storage.content_address('books', self.sha256)
+        self.assertEqual(name, 'books/%s/%s/%s.epub' % (
+            self.sha256[:2], self.sha256[2:4], self.sha256))
+
+        with open(self.epub, 'rb') as f:
+            self.assertEqual(fs.save(name, File(f)), name)
+        # The existing file is kept, instead of saved on another name.
+        with open(self.epub, 'rb') as f:
+            self.assertEqual(fs.save(name, File(f)), name)
+        self.assertEqual(os.listdir(os.path.dirname(fs.path(name))),
+                         [os.path.basename(name)])
+        self.assertEqual(storage.file_sha256(fs.path(name)), self.sha256)
+
+        # Symbolic links.
+        fs.delete(name)
+        with open(self.epub, 'rb') as f:
+            fs.save(name, storage.LinkableFile(f))
+        self.assertEqual(os.readlink(fs.path(name)), self.epub)
+
+        # Staged files are renamed into place.
+        fs.delete(name)
+        path, _ = storage.stage_file(self.epub, self.tmp_dir)
+        fs.save(name, storage.StagedFile(path))
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(storage.file_sha256(fs.path(name)), self.sha256)
+
+
+@override_settings(ALLOW_PUBLIC_ADD_BOOKS=True, FEED_CACHE=None)
+class UploadTest(TestCase):
+    fixtures = ['initial_data.json']
+
+    def setUp(self):
+        self.tmp_media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_media_root)
+        # See CommandAddEpubTest.
+        path_patcher = patch.object(
+            FileSystemStorage, 'path',
+            lambda instance, name: os.path.join(self.tmp_media_root, name))
+        path_patcher.start()
+        self.addCleanup(path_patcher.stop)
+        User.objects.create_user('user', 'user@example.com', 'userpass')
+        self.client.login(username='user', password='userpass')
+
+    def test_upload_hashed_once(self):
+        epub = sample_epubs.EPUBS_VALID[0]
+        url = reverse('book_add')
+        with patch('books.models.sha256_sum') as mock_sha256, \
+                patch('books.storage.file_sha256') as mock_file_sha256:
+            with open(epub.fullpath, 'rb') as f:
+                response = self.client.post(url, {
+                    'add_book_wizard-current_step': '0',
+                    '0-epub_file': f})
+            self.assertEqual(response.status_code, 200)
+            response = self.client.post(url, {
+                'add_book_wizard-current_step': '1',
+                '1-title': 'Uploaded',
+                '1-a_status': 1,
+                '1-downloads': 0})
+            self.assertEqual(response.status_code, 302)
+        self.assertFalse(mock_sha256.called)
+        self.assertFalse(mock_file_sha256.called)
+
+        book = models.Book.objects.get(title='Uploaded')
+        with open(epub.fullpath, 'rb') as f:
+            self.assertEqual(book.file_sha256sum, models.sha256_sum(f))
+        self.assertEqual(storage.file_sha256(book.book_file.path),
+                         book.file_sha256sum)
+        # The file kept by the wizard was moved (the patched path puts it on
+        # the root).
+        self.assertEqual(sorted(os.listdir(self.tmp_media_root)),
+                         ['books', 'covers'])
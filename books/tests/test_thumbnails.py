@@ -0,0 +1,145 @@
+import os
+import shutil
+import tempfile
+from StringIO import StringIO
+
+from mock import patch
+from PIL import Image
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import FileSystemStorage
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.test import TransactionTestCase, override_settings
+
+from books import models
+from books import thumbnails
+import sample_epubs
+
+
+class ThumbnailsTest(TransactionTestCase):
+    fixtures = ['initial_data.json']
+
+    def setUp(self):
+        self.tmp_media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_media_root)
+        # See CommandAddEpubTest.
+        path_patcher = patch.object(
+            FileSystemStorage, 'path',
+            lambda instance, name: os.path.join(self.tmp_media_root, name))
+        path_patcher.start()
+        self.addCleanup(path_patcher.stop)
+
+    def assertThumbnails(self, book):
+        names = book.get_cover_thumbnails()
+        self.assertEqual(names['source'], book.cover_img.name)
+        keys = [models.cover_thumbnail_key(alias, density, extension)
+                for alias in ['opds_thumb', 'thumb']
+                for density in [1, 2]
+                for extension in thumbnails.thumbnail_formats()]
+        self.assertEqual(sorted(names), sorted(keys + ['sha256', 'source']))
+        for key in keys:
+            self.assertTrue(names[key].startswith('thumbnails/'))
+            self.assertTrue(os.path.exists(
+                os.path.join(self.tmp_media_root, names[key])))
+        for alias in ['opds_thumb', 'thumb']:
+            self.assertEqual(book.cover_thumbnail_url(alias),
+                             book.cover_img.storage.url(names[alias]))
+        # The thumbnails are bounded by the size of the alias.
+        image = Image.open(os.path.join(self.tmp_media_root,
+                                        names['opds_thumb@2x']))
+        self.assertEqual(image.format, 'JPEG')
+        self.assertLessEqual(image.size[0], 240)
+        self.assertLessEqual(image.size[1], 360)
+
+    def test_addepub(self):
+        """Test that the thumbnails are generated when the books are
+        imported.
+        """
+        epubs = [epub.fullpath for epub in sample_epubs.EPUBS_COVER]
+        call_command('addepub', *epubs, stdout=StringIO())
+        books = models.Book.objects.exclude(cover_img='')
+        self.assertEqual(len(books), len(epubs))
+        for book in books:
+            self.assertThumbnails(book)
+
+    @override_settings(COVER_THUMBNAILS_ASYNC=False)
+    def test_save(self):
+        epub = sample_epubs.EPUBS_COVER[0]
+        call_command('addepub', epub.fullpath, batch_size=1,
+                     stdout=StringIO())
+        book = models.Book.objects.get()
+        self.assertThumbnails(book)
+
+        # Until the thumbnails are generated, the cover is used.
+        models.Book.objects.update(cover_thumbnails='')
+        book = models.Book.objects.get()
+        self.assertEqual(book.cover_thumbnail_url('thumb'),
+                         book.cover_img.url)
+        call_command('generate_thumbnails', stdout=StringIO())
+        self.assertThumbnails(models.Book.objects.get())
+
+        # Removing the cover removes the thumbnails.
+        book.cover_img = None
+        book.save()
+        book = models.Book.objects.get()
+        self.assertEqual(book.cover_thumbnails, '')
+        self.assertIsNone(book.cover_thumbnail_url('thumb'))
+
+    @override_settings(COVER_THUMBNAILS_ASYNC=False)
+    def test_shared_covers(self):
+        """Test that the thumbnails of identical covers are generated once,
+        and are not generated again if they exist.
+        """
+        call_command('addepub', sample_epubs.EPUBS_COVER[0].fullpath,
+                     stdout=StringIO())
+        book = models.Book.objects.get()
+        with open(book.cover_img.path, 'rb') as f:
+            data = f.read()
+        for i in range(2):
+            other = models.Book.objects.create(
+                title='copy', book_file='books/%s.epub' % i,
+                file_sha256sum='%s' % i, a_status_id=1)
+            other.cover_img.save('copy.png', ContentFile(data), save=False)
+            models.Book.objects.filter(pk=other.pk).update(
+                cover_img=other.cover_img.name)
+
+        with patch('books.thumbnails.process_image',
+                   wraps=thumbnails.process_image) as mock_process:
+            call_command('generate_thumbnails', all=True, stdout=StringIO())
+        self.assertEqual(mock_process.call_count, 0)
+        books = models.Book.objects.all()
+        self.assertEqual(len(books), 3)
+        for other in books:
+            self.assertThumbnails(other)
+            self.assertEqual(other.cover_thumbnail_url('thumb'),
+                             book.cover_thumbnail_url('thumb'))
+
+    @override_settings(ALLOW_PUBLIC_BROWSE=True)
+    def test_links(self):
+        call_command('addepub', sample_epubs.EPUBS_COVER[0].fullpath,
+                     stdout=StringIO())
+        book = models.Book.objects.get()
+        srcset = book.cover_thumbnail_srcset('thumb')
+        self.assertEqual(srcset, '%s 1x, %s 2x' % (
+            book.cover_thumbnail_url('thumb'), book.cover_img.storage.url(
+                book.get_cover_thumbnails()['thumb@2x'])))
+
+        response = self.client.get(reverse('latest'))
+        self.assertContains(response, 'srcset="%s"' % srcset)
+
+        response = self.client.get(reverse('latest_feed'))
+        self.assertContains(
+            response, '<link href="%s" rel="http://opds-spec.org/image/'
+            'thumbnail"' % book.cover_thumbnail_url('opds_thumb'))
+
+    def test_queue(self):
+        queue = thumbnails.ThumbnailQueue()
+        with patch('books.thumbnails.generate_thumbnails') as mock_generate:
+            queue.put([1, 2])
+            queue.join()
+            queue.put([3])
+            queue.join()
+        generated = [pk for call in mock_generate.call_args_list
+                     for pk in call[0][0]]
+        self.assertEqual(generated, [1, 2, 3])
@@ -0,0 +1,76 @@
+import os
+import shutil
+import tempfile
+from unittest import skipUnless
+
+from django.test import SimpleTestCase
+
+from books.watcher import Debouncer, InotifyWatcher, PollingWatcher
+
+
+class WatcherTestMixin(object):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+
+    def _write(self, name, data='data'):
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, 'ab') as f:
+            f.write(data)
+        return path
+
+    def test_changes(self):
+        watcher = self.get_watcher()
+        self.addCleanup(watcher.close)
+        self.assertEqual(watcher.changes(0), set())
+
+        book = self._write('book.epub')
+        self._write('notes.txt')
+        self.assertEqual(watcher.changes(1), set([book]))
+
+        # Files on new subdirectories are reported.
+        os.mkdir(os.path.join(self.tmp_dir, 'sub'))
+        other = self._write(os.path.join('sub', 'other.epub'))
+        changes = watcher.changes(1)
+        if not changes:
+            changes = watcher.changes(1)
+        self.assertEqual(changes, set([other]))
+
+        # Changed files are reported again.
+        self._write('book.epub', 'more data')
+        os.utime(book, (0, 0))
+        self.assertEqual(watcher.changes(1), set([book]))
+
+
+class PollingWatcherTest(WatcherTestMixin, SimpleTestCase):
+    def get_watcher(self):
+        return PollingWatcher([self.tmp_dir], interval=0)
+
+
+@skipUnless(InotifyWatcher.is_available(), 'inotify is not available')
+class InotifyWatcherTest(WatcherTestMixin, SimpleTestCase):
+    def get_watcher(self):
+        return InotifyWatcher([self.tmp_dir])
+
+
+class DebouncerTest(SimpleTestCase):
+    def test_ready(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, 'book.epub')
+        with open(path, 'wb') as f:
+            f.write('partial')
+
+        debouncer = Debouncer(settle=2)
+        debouncer.add([path, os.path.join(tmp_dir, 'missing.epub')])
+        self.assertEqual(debouncer.ready(now=100), [])
+        self.assertEqual(len(debouncer), 1)
+        self.assertEqual(debouncer.ready(now=101), [])
+
+        # The file is still being written: wait again.
+        with open(path, 'ab') as f:
+            f.write(' and the rest')
+        self.assertEqual(debouncer.ready(now=102), [])
+        self.assertEqual(debouncer.ready(now=103), [])
+        self.assertEqual(debouncer.ready(now=104), [path])
+        self.assertEqual(len(debouncer), 0)
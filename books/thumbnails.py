@@ -0,0 +1,250 @@
+"""Thumbnails of the book covers.
+
+The thumbnails of all the `THUMBNAIL_ALIASES` for `Book.cover_img` are
+generated with the easy-thumbnails processors when the cover is saved (by
+`addepub`, the upload wizard, the admin or the edit view), and their names
+are stored on `Book.cover_thumbnails`, so the book lists and the catalogs
+only need to build their URLs (see `Book.cover_thumbnail_url()`), without
+checking the storage or resizing images while rendering the pages.
+
+Each alias is generated for each of `settings.COVER_THUMBNAIL_DENSITIES` (for
+the `srcset` of the lists), as an optimized JPEG and in the formats of
+`settings.COVER_THUMBNAIL_FORMATS` that Pillow can write. The thumbnails are
+named after the sha256 sum of the cover and the options of the alias (see
+`thumbnail_name()`), so the books with the same cover share them, and the
+existing ones are not generated again. They are not deleted with the covers.
+
+The thumbnails are generated by a worker thread of the process that saved
+the book, after the transaction is committed, unless
+`settings.COVER_THUMBNAILS_ASYNC` is False. Until they are ready, the
+original cover is used. The `generate_thumbnails` command generates the
+missing ones (ie. for the books imported before, or when a process was
+stopped before generating them).
+"""
+
+from functools import partial
+from hashlib import sha1, sha256
+import json
+import logging
+import Queue
+import threading
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import close_old_connections, connection, transaction
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from easy_thumbnails.alias import aliases
+from easy_thumbnails.conf import settings as thumbnail_settings
+from easy_thumbnails.engine import (generate_source_image, process_image,
+                                    save_image)
+from PIL import Image
+
+from books import feed_cache
+from books.models import Book, cover_thumbnail_key
+from books.storage import CHUNK_SIZE, content_address
+
+logger = logging.getLogger(__name__)
+
+# Target of the aliases of the covers.
+ALIAS_TARGET = 'books.Book.cover_img'
+
+# Number of books updated at once by the worker.
+BATCH_SIZE = 100
+
+
+def thumbnail_formats():
+    """Return the extensions of the formats of the thumbnails: those of
+    `settings.COVER_THUMBNAIL_FORMATS` that Pillow can write, and 'jpg'.
+    """
+    Image.init()
+    extensions = [extension for extension in settings.COVER_THUMBNAIL_FORMATS
+                  if Image.EXTENSION.get('.' + extension) in Image.SAVE]
+    return extensions + ['jpg']
+
+
+def thumbnail_name(sha256sum, alias, options, density, extension):
+    """Return the name of the thumbnail `alias` (with the `options`) of the
+    cover with the sha256 sum `sha256sum`, for the pixel `density` and the
+    format `extension`. The name changes with the options of the alias.
+    """
+    fingerprint = sha1(repr(sorted(options.items()))).hexdigest()[:8]
+    suffix = '' if density == 1 else '@%dx' % density
+    return content_address(
+        thumbnail_settings.THUMBNAIL_BASEDIR or 'thumbnails', sha256sum,
+        '.%s-%s%s.%s' % (alias, fingerprint, suffix, extension))
+
+
+def cover_sha256(cover):
+    """Return the sha256 sum of the `cover` (a `FieldFile`)."""
+    s = sha256()
+    cover.open('rb')
+    try:
+        for chunk in cover.chunks(CHUNK_SIZE):
+            s.update(chunk)
+    finally:
+        cover.close()
+    return s.hexdigest()
+
+
+def make_variants(cover, sha256sum):
+    """Generate the thumbnails of the `cover` (with the sha256 sum
+    `sha256sum`) that do not exist on its storage yet, returning the names
+    of all of them by their key on `Book.cover_thumbnails`.
+    """
+    storage = cover.storage
+    names, missing = {}, []
+    for alias, options in aliases.all(target=ALIAS_TARGET).items():
+        for density in settings.COVER_THUMBNAIL_DENSITIES:
+            for extension in thumbnail_formats():
+                name = thumbnail_name(sha256sum, alias, options, density,
+                                      extension)
+                names[cover_thumbnail_key(alias, density, extension)] = name
+                if not storage.exists(name):
+                    missing.append((name, options, density))
+    if not missing:
+        return names
+
+    source = generate_source_image(cover, {}, fail_silently=False)
+    if source is None:
+        raise ValueError('%s is not an image' % cover.name)
+    for name, options, density in missing:
+        width, height = options['size']
+        image = process_image(
+            source, dict(options, size=(width * density, height * density)))
+        data = save_image(image, filename=name, quality=options.get(
+            'quality', thumbnail_settings.THUMBNAIL_QUALITY))
+        storage.save(name, ContentFile(data.read()))
+    return names
+
+
+def make_thumbnails(cover, made=None):
+    """Generate the thumbnails of the `cover` (the `cover_img` of a book),
+    returning the value for `Book.cover_thumbnails`. If the image can not be
+    read, only the name of the cover is stored, so it is used for all the
+    sizes.
+
+    :param cover: `FieldFile` of the cover
+    :param made: dict of the thumbnails already made by the sha256 sum of
+    their covers (ie. for the other books of a batch), which is updated
+    """
+    made = {} if made is None else made
+    thumbnails = {'source': cover.name}
+    try:
+        sha256sum = cover_sha256(cover)
+        if sha256sum not in made:
+            made[sha256sum] = make_variants(cover, sha256sum)
+        thumbnails.update(made[sha256sum])
+        thumbnails['sha256'] = sha256sum
+    except Exception:
+        logger.exception('Error while generating the thumbnails of %s',
+                         cover.name)
+        thumbnails = {'source': cover.name}
+    return json.dumps(thumbnails, sort_keys=True)
+
+
+def generate_thumbnails(book_ids):
+    """Generate and store the thumbnails of the covers of the books
+    `book_ids`.
+
+    :param book_ids: list of book pks
+    :returns: number of books updated
+    """
+    updated = 0
+    made = {}
+    books = Book.objects.filter(pk__in=book_ids).exclude(cover_img='').\
+        only('pk', 'cover_img')
+    for book in books:
+        # The cover might have been replaced meanwhile.
+        updated += Book.objects.filter(
+            pk=book.pk, cover_img=book.cover_img.name).update(
+            cover_thumbnails=make_thumbnails(book.cover_img, made))
+    if updated:
+        # The catalogs and the ETags of the lists include the thumbnails.
+        feed_cache.bump_version()
+    return updated
+
+
+class ThumbnailQueue(object):
+    """Queue of the books whose thumbnails are generated by a daemon worker
+    thread, started when needed.
+    """
+    def __init__(self):
+        self._queue = Queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def put(self, book_ids):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run,
+                                                name='thumbnails')
+                self._thread.daemon = True
+                self._thread.start()
+        for pk in book_ids:
+            self._queue.put(pk)
+
+    def join(self):
+        """Wait until the thumbnails of the queued books are generated."""
+        self._queue.join()
+
+    def _run(self):
+        while True:
+            book_ids = [self._queue.get()]
+            while len(book_ids) < BATCH_SIZE:
+                try:
+                    book_ids.append(self._queue.get_nowait())
+                except Queue.Empty:
+                    break
+            try:
+                generate_thumbnails(book_ids)
+            except Exception:
+                logger.exception('Error while generating thumbnails')
+            finally:
+                close_old_connections()
+                for _ in book_ids:
+                    self._queue.task_done()
+
+
+queue = ThumbnailQueue()
+
+
+def _can_use_worker():
+    """Return whether the database can be used from the worker thread: an
+    in-memory SQLite database (ie. of the tests) can only be shared between
+    connections by some versions.
+    """
+    return not (connection.vendor == 'sqlite' and
+                connection.is_in_memory_db(connection.settings_dict['NAME'])
+                and not connection.features.can_share_in_memory_db)
+
+
+def enqueue(book_ids):
+    """Generate the thumbnails of the books `book_ids` once the current
+    transaction is committed, on the worker thread if
+    `settings.COVER_THUMBNAILS_ASYNC`.
+
+    :param book_ids: list of book pks
+    """
+    book_ids = list(book_ids)
+    if not book_ids:
+        return
+    if settings.COVER_THUMBNAILS_ASYNC and _can_use_worker():
+        transaction.on_commit(partial(queue.put, book_ids))
+    else:
+        transaction.on_commit(partial(generate_thumbnails, book_ids))
+
+
+# Signal handler for generating the thumbnails of the saved covers.
+@receiver(post_save, sender=Book)
+def book_thumbnails_handler(**kwargs):
+    instance = kwargs['instance']
+    if 'cover_img' in instance.get_deferred_fields():
+        return
+    source = instance.get_cover_thumbnails().get('source')
+    if instance.cover_img:
+        if instance.cover_img.name != source:
+            enqueue([instance.pk])
+    elif source:
+        Book.objects.filter(pk=instance.pk).update(cover_thumbnails='')
+        instance.cover_thumbnails = ''
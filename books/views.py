@@ -19,35 +19,70 @@ import logging
 import os
 
 from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
 from django.core.files import File
 from django.core.files.storage import FileSystemStorage
 from django.core.paginator import InvalidPage
 from django.core.urlresolvers import reverse
 from django.db.models import Count
-from django.http import HttpResponse, HttpResponseForbidden
+from django.http import (Http404, HttpResponse, HttpResponseBadRequest,
+                         HttpResponseForbidden, HttpResponseGone,
+                         StreamingHttpResponse)
 from django.shortcuts import get_object_or_404, redirect, render
+from django.utils.encoding import force_text
 from django.views.generic import FormView, View
 from django.views.generic.detail import DetailView, SingleObjectMixin
 from django.views.generic.edit import DeleteView, UpdateView
 from django.views.generic.list import ListView
 
+import django_comments
 from dal import autocomplete
 from formtools.wizard.views import SessionWizardView
 from pure_pagination import Paginator, EmptyPage
 from pure_pagination.mixins import PaginationMixin
-from sendfile import sendfile
 from taggit.models import Tag
 
+import changes
+import counters
+import download_cache
+import downloads
+import export
+from decorators import catalog_condition
+from feed_cache import cache_feed
 from forms import (AuthorEditForm, BookAddTagsForm, BookEditForm)
 from models import Author, Book, Language, Publisher, Status
-from opds import (generate_catalog, generate_root_catalog,
-                  generate_tags_catalog)
+from opds import (generate_changes_catalog, generate_root_catalog,
+                  generate_tags_catalog, stream_catalog)
 from opds import page_qstring
+from pagination import InvalidCursor, KeysetPaginator
 from search import simple_search, advanced_search
+from serve import is_new_download, serve_file
+from storage import StagedFile
 
 logger = logging.getLogger(__name__)
 
 
+def _add_comment_counts(books):
+    """Set the `comment_count` attribute of each Book in `books`, fetching
+    the counts with a single aggregate query (instead of one
+    `get_comment_count` query for each Book).
+
+    :param books: list of Books
+    """
+    counts = {}
+    if books:
+        comments = django_comments.get_model().objects.filter(
+            content_type=ContentType.objects.get_for_model(Book),
+            object_pk__in=[force_text(book.pk) for book in books],
+            site__pk=settings.SITE_ID,
+            is_public=True,
+            is_removed=False)
+        counts = dict(comments.values_list('object_pk').
+                      annotate(Count('pk')).order_by())
+    for book in books:
+        book.comment_count = counts.get(force_text(book.pk), 0)
+
+
 class AuthorAutocomplete(autocomplete.Select2QuerySetView):
     def get_queryset(self):
         # Don't forget to filter out results depending on the visitor !
@@ -114,6 +149,17 @@ class AddBookWizard(SessionWizardView):
             self.instance = Book()
         return self.instance
 
+    def get_form_kwargs(self, step=None):
+        """Pass the sha256 sum of the uploaded file to the first form when it
+        is validated again by done(), so the file is not hashed again.
+        """
+        kwargs = super(AddBookWizard, self).get_form_kwargs(step)
+        if step == '0' and self.steps.current != '0':
+            sha256sum = self.storage.extra_data.get('file_sha256sum')
+            if sha256sum:
+                kwargs['sha256sum'] = sha256sum
+        return kwargs
+
     def process_step_files(self, form):
         """Append the values appended by the first form to storage.extra_data.
 
@@ -181,10 +227,17 @@ class AddBookWizard(SessionWizardView):
         :returns:
         """
         uploaded_file = form_list[0].cleaned_data['epub_file']
-        # Set file related parameters.
-        self.instance.book_file = uploaded_file
+        # Set file related parameters (the sha256 hash first, as the name of
+        # the file can depend on it). The file kept by the wizard is moved to
+        # the storage instead of copied.
         self.instance.file_sha256sum = self.storage.\
             extra_data['file_sha256sum']
+        path = getattr(uploaded_file.file, 'name', None)
+        if path and os.path.isfile(path):
+            self.instance.book_file.save(uploaded_file.name, StagedFile(path),
+                                         save=False)
+        else:
+            self.instance.book_file = uploaded_file
         self.instance.original_path = self.storage.extra_data['original_path']
         if self.request.user.is_authenticated():
             self.instance.uploader = self.request.user
@@ -223,9 +276,13 @@ class AuthorDetailView(DetailView):
 
     def get_context_data(self, **kwargs):
         context = super(AuthorDetailView, self).get_context_data(**kwargs)
-        context['book_list'] = self.object.books.all()
+        context['book_list'] = list(
+            self.object.books.all().prefetch_related('authors', 'publishers',
+                                                     'tags'))
         # context['book_list'] = Book.objects.filter(authors=self.object)
         context['allow_user_comments'] = settings.ALLOW_USER_COMMENTS
+        if settings.ALLOW_USER_COMMENTS:
+            _add_comment_counts(context['book_list'])
 
         return context
 
@@ -327,30 +384,90 @@ class BookDisplay(DetailView):
 
 
 def download_book(request, book_id):
-    """Return the epub file for a Book with `book_id` using sendfile. It
-    returns the file stored in media by Django.
+    """Return the epub file for a Book with `book_id` (see `books.serve`),
+    supporting conditional and Range requests. It returns the file stored in
+    media by Django. The information of the file is usually taken from
+    `books.download_cache`, without querying the database.
     TODO: decide if in some cases the original file should be returned instead.
-    TODO: currently the downloaded file name is the same as the stored file.
-    Decide if it should be standardized to something else instead.
 
     :param request:
     :param book_id:
     :returns:
     """
-    book = get_object_or_404(Book, pk=book_id)
-    # filename = os.path.join(settings.MEDIA_ROOT, book.original_path.name)
-    # filename = unicode(os.path.abspath(book.original_path))  # unicode?
-    filename = book.book_file.path
+    info = download_cache.get_info(book_id)
+    # The unpublished books are only available to the logged in users, as
+    # on the book lists.
+    if info is None or not (info.published or
+                            request.user.is_authenticated()):
+        raise Http404('No book matches the given query.')
+
+    response = serve_file(request, info.path, etag=info.sha256,
+                          attachment_filename=info.attachment_filename,
+                          mimetype=info.mimetype)
 
     # TODO, currently the downloads counter is incremented when the
     # download is requested, without knowing if the file sending was
-    # successful:
-    book.downloads += 1
-    book.save()
+    # successful. Resumed downloads are not counted again.
+    if is_new_download(request, response):
+        downloads.record(int(book_id))
+    return response
+
 
-    return sendfile(request, filename, attachment=True)
+@catalog_condition
+def changes_feed(request):
+    """Return the OPDS feed of the changes of the catalog after the `since`
+    parameter (a date, or the cursor of the `next` link of a previous
+    request), with tombstones for the removed books.
 
+    :param request:
+    :returns:
+    """
+    position = None
+    if request.GET.get('since'):
+        try:
+            position = changes.parse_position(request.GET['since'])
+        except InvalidCursor:
+            return HttpResponseBadRequest('Invalid since parameter.')
+        if changes.is_expired(position):
+            return HttpResponseGone('The deletions before the since '
+                                    'parameter are no longer kept: fetch '
+                                    'the whole catalog again.')
+
+    change_list = changes.get_changes(
+        position, published_only=not request.user.is_authenticated())
+    catalog = generate_changes_catalog(request, change_list)
+    return HttpResponse(catalog, content_type='application/atom+xml')
+
+
+def export_catalog(request, fmt):
+    """Stream the whole catalog (or the books updated after the `since`
+    parameter) as a gzip-compressed OPDS feed or JSON lines file, for mirrors
+    and offline copies. Unpublished books are included for staff users that
+    request them with the `all` parameter.
 
+    :param request:
+    :param fmt: export format, a key of `export.FORMATS`
+    :returns:
+    """
+    since = request.GET.get('since')
+    if since:
+        try:
+            since = export.parse_since(since)
+        except ValueError as e:
+            return HttpResponseBadRequest(str(e))
+    published_only = not (request.user.is_staff and 'all' in request.GET)
+
+    books = export.export_queryset(since or None, published_only)
+    response = StreamingHttpResponse(
+        export.iter_gzip(export.iter_export(books, fmt)),
+        content_type='application/gzip')
+    response['Content-Disposition'] = \
+        'attachment; filename="catalog.%s.gz"' % fmt
+    return response
+
+
+@catalog_condition
+@cache_feed
 def tags(request, qtype=None):
     """
 
@@ -370,10 +487,17 @@ def tags(request, qtype=None):
     return render(request, 'books/tag_list.html', context)
 
 
-def _book_list(request, queryset, qtype=None, list_by='latest', **kwargs):
+def _book_list(request, queryset, qtype=None, list_by='latest', keyset=None,
+               **kwargs):
     """
     Filter the books, paginate the result, and return either a HTML
     book list, or a atom+xml OPDS catalog.
+
+    If `keyset` is given (a unique ordering of the list, ie.
+    `['-time_added', '-pk']`), the OPDS catalogs are paginated with cursors
+    instead of page numbers, so the cost of each page does not depend on its
+    position and no COUNT is needed. Page numbers are still used for the HTML
+    list, for search results and when requested with the `page` parameter.
     """
     q = request.GET.get('q')
     search_all = request.GET.get('search-all') == 'on'
@@ -383,11 +507,6 @@ def _book_list(request, queryset, qtype=None, list_by='latest', **kwargs):
     if not request.user.is_authenticated():
         queryset = queryset.filter(a_status=settings.BOOK_PUBLISHED)
 
-    published_count = Book.objects.\
-        filter(a_status=settings.BOOK_PUBLISHED).count()
-    unpublished_count = Book.objects.\
-        exclude(a_status=settings.BOOK_PUBLISHED).count()
-
     # If no search options are specified, assumes search all, the
     # advanced search will be used:
     if not search_all and not search_title and not search_author:
@@ -402,6 +521,24 @@ def _book_list(request, queryset, qtype=None, list_by='latest', **kwargs):
             queryset = simple_search(queryset, q,
                                      search_title, search_author)
 
+    # Fetch the related objects for the whole page at once, instead of once
+    # per book while rendering.
+    queryset = queryset.select_related('dc_language')
+    if qtype == 'feed':
+        queryset = queryset.prefetch_related('authors', 'publishers')
+    else:
+        queryset = queryset.prefetch_related('authors', 'publishers', 'tags')
+
+    if qtype == 'feed' and keyset and q is None and \
+            'page' not in request.GET:
+        paginator = KeysetPaginator(queryset, settings.BOOKS_PER_PAGE, keyset)
+        try:
+            page_obj = paginator.page(request.GET.get('cursor'))
+        except InvalidCursor:
+            page_obj = paginator.page()
+        return StreamingHttpResponse(stream_catalog(request, page_obj),
+                                     content_type='application/atom+xml')
+
     paginator = Paginator(queryset, settings.BOOKS_PER_PAGE)
     page = int(request.GET.get('page', '1'))
 
@@ -415,10 +552,16 @@ def _book_list(request, queryset, qtype=None, list_by='latest', **kwargs):
 
     # Return OPDS Atom Feed:
     if qtype == 'feed':
-        catalog = generate_catalog(request, page_obj)
-        return HttpResponse(catalog, content_type='application/atom+xml')
+        return StreamingHttpResponse(stream_catalog(request, page_obj),
+                                     content_type='application/atom+xml')
 
     # Return HTML page:
+    page_obj.object_list = list(page_obj.object_list)
+    if settings.ALLOW_USER_COMMENTS:
+        _add_comment_counts(page_obj.object_list)
+
+    published_count, unpublished_count = counters.get_published_counts()
+
     extra_context = dict(kwargs)
     extra_context.update({
         'book_list': page_obj.object_list,
@@ -441,6 +584,8 @@ def home(request):
     return redirect('latest')
 
 
+@catalog_condition
+@cache_feed
 def root(request, qtype=None):
     """Return the root catalog for navigation
 
@@ -452,21 +597,31 @@ def root(request, qtype=None):
     return HttpResponse(root_catalog, content_type='application/atom+xml')
 
 
+@catalog_condition
+@cache_feed
 def latest(request, qtype=None):
     queryset = Book.objects.all()
-    return _book_list(request, queryset, qtype, list_by='latest')
+    return _book_list(request, queryset, qtype, list_by='latest',
+                      keyset=['-time_added', '-pk'])
 
 
+@catalog_condition
+@cache_feed
 def by_title(request, qtype=None):
     queryset = Book.objects.all().order_by('title')
-    return _book_list(request, queryset, qtype, list_by='by-title')
+    return _book_list(request, queryset, qtype, list_by='by-title',
+                      keyset=['title', 'pk'])
 
 
+@catalog_condition
+@cache_feed
 def by_author(request, qtype=None):
     queryset = Book.objects.all().order_by('authors')
     return _book_list(request, queryset, qtype, list_by='by-author')
 
 
+@catalog_condition
+@cache_feed
 def by_tag(request, tag, qtype=None):
     """ displays a book list by the tag argument
     :param request:
@@ -480,9 +635,12 @@ def by_tag(request, tag, qtype=None):
     # Get a list of books that have the requested tag
     queryset = Book.objects.filter(tags=tag_instance)
     return _book_list(request, queryset, qtype, list_by='by-tag',
-                      tag=tag_instance)
+                      keyset=['-time_added', '-pk'], tag=tag_instance)
 
 
+@catalog_condition
+@cache_feed
 def most_downloaded(request, qtype=None):
     queryset = Book.objects.all().order_by('-downloads')
-    return _book_list(request, queryset, qtype, list_by='most-downloaded')
+    return _book_list(request, queryset, qtype, list_by='most-downloaded',
+                      keyset=['-downloads', '-pk'])
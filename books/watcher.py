@@ -0,0 +1,253 @@
+"""Watching of directories for new or changed EPUBs, for `watchepubs`.
+
+On Linux the directories are watched with inotify (through ctypes, so no
+extra dependency is needed), with a watch for each subdirectory. Elsewhere,
+or if inotify is not available, the directories are walked periodically and
+the files compared with the previous walk by their stat signature.
+
+The watchers only report the candidate paths: as the files may still be
+being written when reported, the `Debouncer` holds them until their
+signature has not changed for a while.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import time
+
+from books.importer import file_signature
+
+EXTENSION = '.epub'
+
+# inotify constants, from <sys/inotify.h>.
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+_EVENT = struct.Struct('iIII')
+
+
+def _is_epub(path):
+    return os.path.splitext(path)[1] == EXTENSION
+
+
+def walk_epubs(path):
+    """Yield the absolute paths of the EPUBs under `path` (a directory or a
+    file).
+    """
+    if os.path.isdir(path):
+        for root, _, files in os.walk(path):
+            for name in files:
+                if _is_epub(name):
+                    yield os.path.abspath(os.path.join(root, name))
+    elif os.path.isfile(path) and _is_epub(path):
+        yield os.path.abspath(path)
+
+
+class PollingWatcher(object):
+    """Watcher that walks the directories every `interval` seconds, reporting
+    the files that were added or changed since the previous walk.
+    """
+    def __init__(self, paths, interval=5.0):
+        self.paths = paths
+        self.interval = interval
+        self._signatures = self._walk()
+
+    def _walk(self):
+        signatures = {}
+        for path in self.paths:
+            for filename in walk_epubs(path):
+                try:
+                    signatures[filename] = file_signature(filename)
+                except OSError:
+                    pass
+        return signatures
+
+    def changes(self, timeout=None):
+        """Wait for the next walk, and return the set of EPUBs that were added
+        or changed.
+
+        :param timeout: maximum time to wait, defaults to `interval`
+        :returns: set of paths
+        """
+        time.sleep(self.interval if timeout is None else
+                   min(timeout, self.interval))
+        signatures = self._walk()
+        changed = set(filename for filename, signature in signatures.items()
+                      if self._signatures.get(filename) != signature)
+        self._signatures = signatures
+        return changed
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    """Watcher using the Linux inotify API."""
+    _libc = None
+
+    @classmethod
+    def is_available(cls):
+        if not sys.platform.startswith('linux'):
+            return False
+        if cls._libc is None:
+            try:
+                libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                   use_errno=True)
+                libc.inotify_init1
+            except (OSError, AttributeError):
+                return False
+            cls._libc = libc
+        return True
+
+    def __init__(self, paths):
+        if not self.is_available():
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self.paths = paths
+        self._fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self._watches = {}
+        try:
+            for path in paths:
+                if os.path.isdir(path):
+                    self._add_tree(path)
+        except OSError:
+            self.close()
+            raise
+
+    def _add_watch(self, directory):
+        path = directory
+        if isinstance(path, unicode):
+            path = path.encode(sys.getfilesystemencoding())
+        wd = self._libc.inotify_add_watch(self._fd, path, WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(),
+                          'inotify_add_watch failed for %s' % directory)
+        self._watches[wd] = directory
+
+    def _add_tree(self, directory):
+        """Watch `directory` and its subdirectories."""
+        for root, _, _ in os.walk(directory):
+            self._add_watch(os.path.abspath(root))
+
+    def _read_events(self):
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return
+            raise
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            yield wd, mask, name.decode(sys.getfilesystemencoding())
+
+    def changes(self, timeout=None):
+        """Wait up to `timeout` seconds (forever if None) for events, and
+        return the set of EPUBs that were created, written or moved into the
+        watched directories.
+
+        :param timeout: maximum time to wait
+        :returns: set of paths
+        """
+        changed = set()
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return changed
+
+        for wd, mask, name in self._read_events():
+            if mask & IN_Q_OVERFLOW:
+                # Some events were lost: report all the files.
+                for path in self.paths:
+                    changed.update(walk_epubs(path))
+                continue
+            if mask & IN_IGNORED:
+                self._watches.pop(wd, None)
+                continue
+            directory = self._watches.get(wd)
+            if directory is None:
+                continue
+            path = os.path.join(directory, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    # Watch the new directory, and report the files that
+                    # were added before the watch.
+                    self._add_tree(path)
+                    changed.update(walk_epubs(path))
+            elif _is_epub(name):
+                changed.add(path)
+        return changed
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+def get_watcher(paths, polling=False, interval=5.0):
+    """Return an `InotifyWatcher` for `paths` if inotify is available and
+    `polling` is False, or a `PollingWatcher` otherwise.
+    """
+    if not polling and InotifyWatcher.is_available():
+        try:
+            return InotifyWatcher(paths)
+        except OSError:
+            # ie. the limit of watches was reached.
+            pass
+    return PollingWatcher(paths, interval)
+
+
+class Debouncer(object):
+    """Hold the reported paths until their signature has not changed for
+    `settle` seconds, so partially written files are not imported.
+    """
+    def __init__(self, settle=2.0):
+        self.settle = settle
+        # Pending paths, mapped to their signature and the time it was seen
+        # for the first time.
+        self._pending = {}
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, paths):
+        for path in paths:
+            self._pending.setdefault(path, (None, None))
+
+    def ready(self, now=None):
+        """Return the list of pending paths that are ready, removing them (and
+        the ones that no longer exist) from the pending ones.
+
+        :param now: current time, defaults to `time.time()`
+        :returns: list of paths
+        """
+        now = time.time() if now is None else now
+        ready = []
+        for path, (signature, since) in self._pending.items():
+            try:
+                current = file_signature(path)
+            except OSError:
+                del self._pending[path]
+                continue
+            if current != signature:
+                self._pending[path] = (current, now)
+            elif now - since >= self.settle:
+                del self._pending[path]
+                ready.append(path)
+        return sorted(ready)
@@ -152,6 +152,13 @@ MEDIA_URL = '/static_media/'
 
 MEDIA_ROOT = os.path.join(BASE_DIR, 'static_media')
 
+# The default upload handlers, computing the sha256 sum of the uploaded books
+# while they are received.
+FILE_UPLOAD_HANDLERS = [
+    'books.storage.HashingMemoryFileUploadHandler',
+    'books.storage.HashingTemporaryFileUploadHandler',
+]
+
 # Other settings
 LOGIN_REDIRECT_URL = '/'
 
@@ -162,6 +169,12 @@ INTERNAL_IPS = ['127.0.0.1']
 
 # -- Third-party apps settings.
 # sendfile
+# The books are downloaded with this backend (see books.serve). Behind Nginx
+# or Apache, use 'sendfile.backends.nginx' (X-Accel-Redirect) or
+# 'sendfile.backends.xsendfile' (X-Sendfile) so the web server sends the
+# files, setting SENDFILE_ROOT to MEDIA_ROOT and SENDFILE_URL to the internal
+# location that serves it. With the 'development' and 'simple' backends the
+# files are sent by the WSGI server (with Range support).
 SENDFILE_BACKEND = 'sendfile.backends.development'
 
 # taggit
@@ -174,8 +187,12 @@ THUMBNAIL_ALIASES = {
     '': {
         'thumb': {'size': (100, 100), 'crop': False},
     },
+    'books.Book.cover_img': {
+        'opds_thumb': {'size': (120, 180), 'crop': False, 'quality': 75},
+    },
 }
-THUMBNAIL_DEBUG = True
+THUMBNAIL_BASEDIR = 'thumbnails'
+THUMBNAIL_DEBUG = False
 
 # django-guardian
 ANONYMOUS_USER_ID = -1
@@ -214,6 +231,77 @@ ALLOW_USER_EDIT = False
 
 ALLOW_USER_COMMENTS = True
 
+# Store the book files by their content, on sharded paths based on their
+# sha256 sum (books/ab/cd/abcd...ef.epub) instead of their uploaded names.
+# The existing files can be moved to this layout with the `relayout_books`
+# command.
+CONTENT_ADDRESSED_BOOKS = False
+
+# File where the downloads are logged by the server processes, for adding
+# them to the books in batches (at most every DOWNLOADS_FLUSH_INTERVAL
+# seconds, or with the `flush_downloads` command), or None for adding each
+# download when the book is requested. It must be writable by the server and
+# shared by all its processes, and not be under MEDIA_ROOT.
+DOWNLOADS_LOG = None
+DOWNLOADS_FLUSH_INTERVAL = 10
+
+# Generate the thumbnails of the covers on a worker thread after the book is
+# saved, instead of while saving it (see books.thumbnails).
+COVER_THUMBNAILS_ASYNC = True
+
+# Formats of the thumbnails generated besides JPEG, in order of preference,
+# if Pillow can write them (ie. it was built with libwebp), and the pixel
+# densities of the `srcset` of the covers on the lists.
+COVER_THUMBNAIL_FORMATS = ['avif', 'webp']
+COVER_THUMBNAIL_DENSITIES = [1, 2]
+
+# The paths and checksums of the downloaded books are kept on a cache of each
+# process (so the downloads do not query the database), with the most recent
+# DOWNLOAD_CACHE_LOCAL_SIZE books, for DOWNLOAD_CACHE_LOCAL_TIMEOUT seconds
+# (as the changes made from other processes are not notified to it).
+# DOWNLOAD_CACHE is the entry of CACHES also used for sharing them between
+# the processes, for DOWNLOAD_CACHE_TIMEOUT seconds, or None. It must be a
+# backend shared by all the processes (ie. memcached), not the local memory
+# one: its entries would not be removed when the books are changed from
+# another process.
+DOWNLOAD_CACHE = None
+DOWNLOAD_CACHE_TIMEOUT = 60
+DOWNLOAD_CACHE_LOCAL_SIZE = 1000
+DOWNLOAD_CACHE_LOCAL_TIMEOUT = 30
+
+# Full-text search backend. If the backend is not available for the database
+# (SQLite FTS5 is required by the default one), the portable
+# 'books.search_index.InvertedIndexBackend' is used instead.
+SEARCH_BACKEND = 'books.search_index.SQLiteFTSBackend'
+
+# Days the tombstones of the deleted books are kept for the changes feed
+# (see books.changes), or None for keeping them forever. The older ones are
+# removed by `python manage.py prune_tombstones`, and the clients polling
+# from before that time must fetch the whole catalog again.
+DELETED_BOOKS_RETENTION_DAYS = 180
+
+# Entry of CACHES used for storing the rendered OPDS catalogs, or None for
+# disabling the cache. The entries are invalidated through a version stamp
+# stored on the database, so any cache backend is safe: with the default
+# LocMemCache each server process renders and keeps its own copy, while
+# 'django.core.cache.backends.filebased.FileBasedCache' shares them between
+# the processes and keeps them across restarts.
+FEED_CACHE = 'feeds'
+
+# Catalogs bigger than this size (in bytes) are streamed without caching them.
+FEED_CACHE_MAX_SIZE = 1024 * 1024
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'feeds': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'pathagar-feeds',
+        'TIMEOUT': 24 * 60 * 60,
+    },
+}
+
 
 # -- Local settings.
 # Deployment-specific variables are imported from local_settings.py
@@ -2,6 +2,7 @@ from django.conf import settings
 from django.conf.urls import include, url
 from django.conf.urls.static import static
 from django.contrib import admin
+from django.contrib.auth.decorators import login_required
 from django.contrib.staticfiles.urls import staticfiles_urlpatterns
 
 from books import views
@@ -44,6 +45,14 @@ urlpatterns = [
         login_or_public_browse_required(views.most_downloaded),
         {'qtype': u'feed'}, 'most_downloaded_feed'),
 
+    # Changes of the catalog:
+    url(r'^changes.atom$', login_or_public_browse_required(views.changes_feed),
+        name='changes_feed'),
+
+    # Bulk export of the catalog:
+    url(r'^export\.(?P<fmt>atom|jsonl)\.gz$',
+        login_required(views.export_catalog), name='export_catalog'),
+
     # Tag list:
     url(r'^tags/$', login_or_public_browse_required(views.tags),
         {}, 'tags'),